@@ -0,0 +1,156 @@
+""" Cross-check of parcel_batch.cape_cin against a scalar integration.
+
+_scalar_cape_cin works through one sounding with plain loops and its own
+numerics: the LCL by bisection on the dry adiabat (cape_cin iterates a
+fixed point), the moist pseudo-adiabat by midpoint steps in pressure
+(cape_cin takes RK4 steps in ln(p)), and the crossings and areas level by
+level. The physics (metpy's constants, saturation vapor pressure, the
+virtual temperature of a parcel that keeps its surface mixing ratio below
+the LCL and is saturated above it) is the same, so both should agree to
+the accuracy of the integrations.
+
+From the Part1 folder:
+    python check_parcel_batch.py
+"""
+import math
+
+import numpy as np
+
+from parcel_batch import (CP_D, EPSILON, KAPPA, LV, RD, ZERO_DEGC,
+                          cape_cin, saturation_mixing_ratio,
+                          virtual_temperature)
+
+
+def _moist_slope(pressure, temperature):
+    """ dT/dp (K/hPa) of the pseudo-adiabat
+    """
+    rs = float(saturation_mixing_ratio(pressure, temperature))
+    return ((RD * temperature + LV * rs)
+            / (CP_D + LV * LV * rs * EPSILON / (RD * temperature**2))
+            / pressure)
+
+
+def _scalar_cape_cin(pressure, temperature, dewpoint, step=0.05):
+    """ CAPE and CIN (J/kg) of one complete sounding (hPa, degC, surface
+    first), moist adiabat steps of at most step hPa
+    """
+    p = [float(value) for value in pressure]
+    t = [float(value) + ZERO_DEGC for value in temperature]
+    td = [float(value) + ZERO_DEGC for value in dewpoint]
+    w0 = float(saturation_mixing_ratio(p[0], td[0]))
+
+    def dry(level):
+        return t[0] * (level / p[0])**KAPPA
+
+    # the parcel saturates where its saturation mixing ratio falls to w0
+    low, high = p[-1], p[0]
+    for _ in range(100):
+        middle = 0.5 * (low + high)
+        if saturation_mixing_ratio(middle, dry(middle)) > w0:
+            high = middle
+        else:
+            low = middle
+    p_lcl = 0.5 * (low + high)
+
+    state_p, state_t = p_lcl, dry(p_lcl)
+    y = []
+    for level, t_level, td_level in zip(p, t, td):
+        if level >= p_lcl:
+            parcel, w = dry(level), w0
+        else:
+            n = max(1, math.ceil((state_p - level) / step))
+            h = (level - state_p) / n
+            for _ in range(n):
+                half = state_t + h / 2 * _moist_slope(state_p, state_t)
+                state_t += h * _moist_slope(state_p + h / 2, half)
+                state_p += h
+            state_p = level
+            parcel = state_t
+            w = float(saturation_mixing_ratio(level, parcel))
+        env = virtual_temperature(
+            t_level, float(saturation_mixing_ratio(level, td_level)))
+        y.append(virtual_temperature(parcel, w) - env)
+
+    # levels and zero crossings, linear in ln(p)
+    log_p = [math.log(level) for level in p]
+    points = [(log_p[0], y[0])]
+    lfc = el = None
+    for k in range(len(p) - 1):
+        if y[k] * y[k + 1] < 0:
+            x = (y[k + 1] * log_p[k] - y[k] * log_p[k + 1]) / (
+                y[k + 1] - y[k])
+            points.append((x, 0.0))
+            if y[k + 1] > 0 and lfc is None and math.exp(x) < p_lcl:
+                lfc = x
+            if y[k + 1] < 0:
+                el = x
+        points.append((log_p[k + 1], y[k + 1]))
+    if lfc is None:
+        if not any(value > 0 for level, value in zip(p, y)
+                   if level < p_lcl):
+            return 0.0, 0.0
+        lfc = math.log(p_lcl)
+    if el is None or el > lfc:
+        el = log_p[-1]
+
+    cape = cin = 0.0
+    for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+        area = 0.5 * (y0 + y1) * (x0 - x1)
+        if x0 <= lfc + 1e-12 and x1 >= el - 1e-12:
+            cape += area
+        if x1 >= lfc - 1e-12:
+            cin += area
+    return float(RD * cape), float(min(RD * cin, 0.0))
+
+
+def standard_sounding(surface_temperature=30.0, surface_dewpoint=20.0,
+                      top=100.0, spacing=25.0):
+    """ Pressure (hPa), temperature and dewpoint (degC) from 1000 hPa to
+    top: 6.5 K/km lapse rate up to 200 hPa and isothermal above, dewpoint
+    depression growing from the surface value to 30 K at the top
+    """
+    pressure = np.arange(1000.0, top - spacing / 2, -spacing)
+    exponent = RD * 0.0065 / 9.80665
+    t0 = surface_temperature + ZERO_DEGC
+    temperature = t0 * (np.maximum(pressure, 200.0) / 1000.0)**exponent
+    depression = (surface_temperature - surface_dewpoint
+                  + (30 - surface_temperature + surface_dewpoint)
+                  * (1 - pressure / 1000.0) / (1 - top / 1000.0))
+    temperature = temperature - ZERO_DEGC
+    return pressure, temperature, temperature - depression
+
+
+def check_scalar(tolerance=0.01, surfaces=((30.0, 20.0), (25.0, 18.0),
+                                           (32.0, 24.0))):
+    """ cape_cin against _scalar_cape_cin on standard soundings with the
+    (temperature, dewpoint) surfaces, degC.
+
+    Returns a list of dictionaries with the surface, both CAPE and CIN
+    values and passed (relative difference within tolerance, CIN to
+    1 J/kg at least).
+    """
+    results = []
+    for surface_temperature, surface_dewpoint in surfaces:
+        p, t, td = standard_sounding(surface_temperature, surface_dewpoint)
+        batch = cape_cin(p, t, td)[0]
+        cape, cin = _scalar_cape_cin(p, t, td)
+        passed = (abs(batch['cape'] - cape) <= tolerance * abs(cape)
+                  and abs(batch['cin'] - cin)
+                  <= max(tolerance * abs(cin), 1.0))
+        results.append(dict(surface_temperature=surface_temperature,
+                            surface_dewpoint=surface_dewpoint,
+                            cape=float(batch['cape']), scalar_cape=cape,
+                            cin=float(batch['cin']), scalar_cin=cin,
+                            passed=bool(passed)))
+    return results
+
+
+if __name__ == '__main__':
+    results = check_scalar()
+    for r in results:
+        print('surface {:4.1f}/{:4.1f} degC  CAPE {:8.1f} vs {:8.1f}  '
+              'CIN {:7.1f} vs {:7.1f}  {}'.format(
+                  r['surface_temperature'], r['surface_dewpoint'],
+                  r['cape'], r['scalar_cape'], r['cin'], r['scalar_cin'],
+                  'ok' if r['passed'] else 'FAIL'))
+    raise SystemExit(0 if all(r['passed'] for r in results) else 1)
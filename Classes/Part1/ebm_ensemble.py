@@ -0,0 +1,218 @@
+""" Zero-dimensional energy balance model for large ensembles.
+
+Lec6a_zero-dim-ebm steps one temperature at a time,
+    T(n+1) = T(n) + dt / C * (ASR - OLR(T(n))),
+with alpha and tau fixed inside ASR and OLR. Here every ensemble member has
+its own albedo, transmissivity, heat capacity and initial temperature (any
+arrays that broadcast together), a forcing series F (W/m2) is added to the
+net flux, and all members are advanced at once.
+
+The default step is implicit (backward Euler): each sub-step h solves
+    T(n+1) + h / C * tau * sigma * T(n+1)^4 = T(n) + h / C * (ASR + F)
+with a few vectorized Newton iterations. It is stable for any h, where the
+explicit step of the notebook oscillates and blows up for
+h > 2 C / (4 tau sigma T^3). Stable is not accurate, though: one backward
+Euler step per year puts the e-folding time of a 10 m mixed layer (0.38
+yr) at 0.87 yr. So each dt is split into sub-steps of a per-member length,
+controlled by step doubling to a local error of tolerance (K), and grown
+again once the member is near equilibrium. With the default 1e-3 K the
+e-folding time is within 0.2% for both 10 m and 100 m of water.
+
+Only the requested diagnostics are kept, never the trajectories, and the
+members are processed in chunks; a per-member forcing stays a broadcast
+view of what was passed in and is gathered one step of one chunk at a
+time, so memory does not grow with the number of steps.
+
+Example:
+    members = 10**6
+    alpha = np.random.normal(0.30, 0.02, members)
+    tau = np.random.normal(0.61, 0.01, members)
+    C = np.random.choice([4e7, 4e8], members)  # 10 m and 100 m of water
+    forcing = np.linspace(0, 3.7, 100)  # W/m2 ramp over 100 years
+    result = run_ensemble(288., alpha, tau, C, forcing)
+    result['final_temperature'], result['efolding_time'] / YEAR
+"""
+import numpy as np
+
+SIGMA = 5.67E-8  # S-B constant
+Q_GLOBAL = 341.3  # the insolation, W/m2
+YEAR = 60. * 60. * 24. * 365.  # one year expressed in seconds
+
+DIAGNOSTICS = ('final_temperature', 'equilibrium_temperature',
+               'efolding_time', 'mean_temperature', 'max_temperature',
+               'min_temperature')
+
+
+def equilibrium_temperature(alpha, Q=Q_GLOBAL, tau=0.61, forcing=0):
+    """ Temperature where ASR + forcing = OLR, broadcast over all inputs
+    """
+    return (((1 - alpha) * Q + forcing) / (tau * SIGMA))**(1 / 4)
+
+
+def _implicit_step(T, rate, k, tolerance=1e-9, max_iterations=50):
+    """ Backward Euler step: root of g(x) = x + k x^4 - (T + rate).
+
+    g is increasing and convex, so every Newton iterate after the first
+    lies above the root and the next ones decrease monotonically onto it.
+    Starting from the old temperature this takes two or three iterations.
+    """
+    s = T + rate
+    x = T.copy()
+    for _ in range(max_iterations):
+        x3 = x**3
+        step = (x + k * x3 * x - s) / (1 + 4 * k * x3)
+        x -= step
+        if np.max(np.abs(step)) <= tolerance * np.max(x):
+            break
+    return x
+
+
+def _adaptive_step(T, source, loss, h, dt, tolerance, min_step, record):
+    """ Advance T by dt with backward Euler sub-steps; source is (ASR + F)
+    / C and loss tau sigma / C. h is each member's sub-step length.
+    record(start, length, T before, T after) is called for the accepted
+    sub-steps (length 0 for members that did not take one), start counted
+    from the beginning of the step. Returns T and the h for the next step.
+
+    Each sub-step is compared with two of half the length. Their
+    difference is the local error of the halves (backward Euler is first
+    order) and their Richardson combination is kept. A sub-step is
+    accepted when the difference is within tolerance (or h is down to
+    min_step), and h is scaled towards the length that just meets it.
+    """
+    elapsed = np.zeros(T.shape)
+    while True:
+        length = np.minimum(h, dt - elapsed)
+        active = length > 0
+        if not active.any():
+            return T, h
+        full = _implicit_step(T, length * source, length * loss)
+        half = _implicit_step(T, length / 2 * source, length / 2 * loss)
+        half = _implicit_step(half, length / 2 * source, length / 2 * loss)
+        error = np.abs(half - full)
+        accept = active & ((error <= tolerance) | (length <= min_step))
+        T_new = np.where(accept, 2 * half - full, T)
+        record(elapsed, np.where(accept, length, 0), T, T_new)
+        T = T_new
+        elapsed = np.where(accept, elapsed + length, elapsed)
+        # at most fivefold growth, e.g. near equilibrium where error is 0
+        scale = np.clip(0.9 * np.sqrt(tolerance / error), 0.2, 5)
+        h = np.where(active, np.maximum(length * scale, min_step), h)
+
+
+def _run_chunk(T0, alpha, tau, C, Q, forcing, index, dt, method,
+               diagnostics, tolerance):
+    """ Diagnostics of one chunk of members, all arrays of the chunk shape.
+    forcing is (n_steps, ...) and broadcasts to the whole ensemble; index
+    picks the chunk's members out of one of its steps (None when forcing
+    is one series for all members).
+    """
+    T = T0.copy()
+    asr = (1 - alpha) * Q
+    loss = tau * SIGMA / C
+    n_steps = len(forcing)
+
+    def step_forcing(n):
+        return forcing[n] if index is None else forcing[n][index]
+
+    # e-folding towards the equilibrium of the final forcing
+    T_eq = equilibrium_temperature(alpha, Q, tau, step_forcing(-1))
+    distance = T - T_eq
+    efolding = np.full(T.shape, np.nan)
+    total = np.zeros(T.shape) if 'mean_temperature' in diagnostics else None
+    highest = T.copy() if 'max_temperature' in diagnostics else None
+    lowest = T.copy() if 'min_temperature' in diagnostics else None
+    h = np.full(T.shape, float(dt))
+
+    def record(start, length, before, after):
+        # first time the distance to equilibrium falls below 1/e of the
+        # initial one, interpolated in time inside the (sub-)step
+        if 'efolding_time' not in diagnostics:
+            return
+        before = (before - T_eq) / distance
+        after = (after - T_eq) / distance
+        crossed = np.isnan(efolding) & (length > 0) & (after <= np.exp(-1))
+        fraction = np.clip((before - np.exp(-1)) / (before - after), 0, 1)
+        efolding[crossed] = (n * dt + start + fraction * length)[crossed]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for n in range(n_steps):
+            source = (asr + step_forcing(n)) / C
+            if method == 'implicit':
+                T, h = _adaptive_step(T, source, loss, h, dt, tolerance,
+                                      dt * 1e-6, record)
+            else:
+                T_new = T + dt * (source - loss * T**4)
+                record(0, np.full(T.shape, float(dt)), T, T_new)
+                T = T_new
+            if total is not None:
+                total += T
+            if highest is not None:
+                np.maximum(highest, T, out=highest)
+            if lowest is not None:
+                np.minimum(lowest, T, out=lowest)
+
+    values = dict(final_temperature=T, equilibrium_temperature=T_eq,
+                  efolding_time=efolding, max_temperature=highest,
+                  min_temperature=lowest)
+    if total is not None:
+        values['mean_temperature'] = total / n_steps
+    return {name: values[name] for name in diagnostics}
+
+
+def run_ensemble(T0, alpha, tau, heat_capacity, forcing=0, Q=Q_GLOBAL,
+                 dt=YEAR, n_steps=None, method='implicit',
+                 diagnostics=DIAGNOSTICS, chunk_size=2**16, tolerance=1e-3):
+    """ Integrate the EBM for all members and return the diagnostics.
+
+    T0 (K), alpha, tau, heat_capacity (J/m2/K) and Q (W/m2) broadcast to
+    the ensemble shape. forcing (W/m2) is a series with one value per step
+    along its first axis; further axes broadcast against the ensemble, e.g.
+    forcing of shape (n_steps, n_members) for one scenario per member. A
+    scalar forcing needs n_steps. method is 'implicit' (backward Euler
+    sub-steps with a local error of tolerance, K, stable for any dt) or
+    'explicit' (the notebook's step_forward, one step per dt).
+
+    Returns a dict of the requested names in DIAGNOSTICS, each of the
+    ensemble shape: final_temperature, equilibrium_temperature (for the
+    last forcing value), efolding_time (s until the distance to that
+    equilibrium first falls below 1/e of the initial one, NaN if never),
+    and the mean, max and min over the steps.
+    """
+    if method not in ('implicit', 'explicit'):
+        raise ValueError("method must be 'implicit' or 'explicit'")
+    unknown = set(diagnostics) - set(DIAGNOSTICS)
+    if unknown:
+        raise ValueError('unknown diagnostics: {}'.format(sorted(unknown)))
+    forcing = np.asarray(forcing, dtype=float)
+    if forcing.ndim == 0:
+        if n_steps is None:
+            raise ValueError('n_steps is needed for a constant forcing')
+        forcing = forcing[None]
+    n_steps = len(forcing) if n_steps is None else n_steps
+    forcing = np.broadcast_to(forcing, (n_steps,) + forcing.shape[1:])
+
+    members = np.broadcast_arrays(*[np.asarray(value, dtype=float) for value
+                                    in (T0, alpha, tau, heat_capacity, Q)])
+    shape = np.broadcast_shapes(members[0].shape, forcing.shape[1:])
+    members = [np.broadcast_to(value, shape).ravel() for value in members]
+    one_series = forcing[0].size == 1
+    if one_series:
+        forcing = forcing.reshape(n_steps, 1)
+    else:
+        # a broadcast view; each step of a chunk is gathered when it is used
+        trailing = (1,) * (len(shape) - forcing.ndim + 1) + forcing.shape[1:]
+        forcing = np.broadcast_to(forcing.reshape((n_steps,) + trailing),
+                                  (n_steps,) + shape)
+
+    size = members[0].size
+    out = {name: np.empty(size) for name in diagnostics}
+    for start in range(0, size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        index = None if one_series else np.unravel_index(
+            np.arange(start, min(start + chunk_size, size)), shape)
+        result = _run_chunk(*[value[chunk] for value in members], forcing,
+                            index, dt, method, diagnostics, tolerance)
+        for name in diagnostics:
+            out[name][chunk] = result[name]
+    return {name: value.reshape(shape) for name, value in out.items()}
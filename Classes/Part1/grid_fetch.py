@@ -0,0 +1,405 @@
+""" Fetching, consolidating and animating multi-year gridded data.
+
+Lec4b_Tutorial_Python_Geospatial downloads the CPC precipitation years one
+after the other with urllib.request.urlretrieve, opens each year on its
+own before combining them, and writes the animation by reading the saved
+PNG frames back with cv2. Here
+
+- `fetch` downloads a list of sources (http(s) URLs, file:// URLs or
+  local paths, so a mirror directory or a local HTTP server can stand in
+  for the archive) on a bounded thread pool into a local mirror
+  directory. Downloads go to '<name>.part' and resume from where they
+  stopped (HTTP Range requests), every file's size and sha256 are kept
+  in the mirror's manifest.json, files already present are skipped, and
+  expected checksums, when given, are verified.
+- `consolidate` appends the files along time into one chunked zarr store,
+  one file at a time, recording which files it holds in a JSON file next
+  to the store, so an interrupted run continues with the next file (a
+  partly appended file is cut off again).
+- `render_video` draws frames on a process pool and writes them to the
+  cv2.VideoWriter in order as they arrive, without PNG files in between.
+
+Example:
+    paths = fetch(cpc_precip_urls(range(1991, 2021)), 'cpc_mirror',
+                  max_workers=8)
+    data = consolidate(paths, 'cpc_precip.zarr',
+                       chunks=dict(time=365, lat=60, lon=60))
+    monthly = data.precip.resample(time='1M').sum()
+    render_video(plot_field, [monthly[i] for i in range(len(monthly))],
+                 'precip_monthly.mp4', fps=4,
+                 options=dict(cmap='Blues', vmin=0, vmax=400))
+"""
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+
+import numpy as np
+import xarray as xr
+
+CPC_PRECIP_URL = 'https://downloads.psl.noaa.gov/Datasets/cpc_us_precip/RT/'
+BLOCK_SIZE = 2**20
+
+
+def cpc_precip_urls(years, base=CPC_PRECIP_URL):
+    """ Sources of the CPC US precipitation years, as in the notebook;
+    base can be a mirror URL or directory
+    """
+    return [urllib.parse.urljoin(base if base.endswith('/') else base + '/',
+                                 'precip.V1.0.{}.nc'.format(year))
+            if '://' in base else
+            os.path.join(base, 'precip.V1.0.{}.nc'.format(year))
+            for year in years]
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _total_size(response, partial):
+    """ Full size of an HTTP resource from Content-Range (a 206) or
+    Content-Length (a 200), None when the server does not say
+    """
+    if partial:
+        total = (response.headers.get('Content-Range') or '').rpartition(
+            '/')[2]
+    else:
+        total = response.headers.get('Content-Length')
+    return int(total) if total and total.isdigit() else None
+
+
+def _open_source(source, offset, timeout):
+    """ Readable stream of source from byte offset, the offset it really
+    starts at (0 when a server ignores the range) and the full size of
+    source (None if unknown)
+    """
+    scheme = urllib.parse.urlparse(source).scheme
+    if scheme in ('http', 'https', 'ftp'):
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        request = urllib.request.Request(source, headers=headers)
+        try:
+            response = urllib.request.urlopen(request, timeout=timeout)
+        except urllib.error.HTTPError as error:
+            if error.code != 416 or not offset:
+                raise
+            # range not satisfiable: start over
+            return _open_source(source, 0, timeout)
+        partial = getattr(response, 'status', None) == 206
+        return (response, offset if partial else 0,
+                _total_size(response, partial))
+    path = (urllib.request.url2pathname(urllib.parse.urlparse(source).path)
+            if scheme == 'file' else source)
+    handle = open(path, 'rb')
+    handle.seek(offset)
+    return handle, offset, os.path.getsize(path)
+
+
+class _Manifest:
+    """ manifest.json of a mirror directory: name -> source, size, sha256
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'manifest.json')
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as handle:
+                self.entries = json.load(handle)
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def set(self, name, entry):
+        with self.lock:
+            self.entries[name] = entry
+            self._save()
+
+    def remove(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self._save()
+
+    def _save(self):
+        with open(self.path + '.tmp', 'w') as handle:
+            json.dump(self.entries, handle, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def _fetch_one(source, target, manifest, expected, verify, retries,
+               retry_wait, timeout):
+    """ Download source to target unless it is there already; returns
+    'present' or 'fetched'
+    """
+    name = os.path.basename(target)
+    entry = manifest.get(name)
+    if os.path.exists(target):
+        size = os.path.getsize(target)
+        if entry is None or entry['size'] != size or verify:
+            digest = _sha256(target)
+        else:
+            digest = entry['sha256']
+        if expected is None or digest == expected:
+            if entry is None or entry['sha256'] != digest:
+                manifest.set(name, dict(source=source, size=size,
+                                        sha256=digest))
+            return 'present'
+        # the manifest must not list it if the download below fails
+        os.remove(target)
+        manifest.remove(name)
+
+    part = target + '.part'
+    for attempt in range(retries + 1):
+        try:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            stream, offset, total = _open_source(source, offset, timeout)
+            digest = hashlib.sha256()
+            with stream, open(part, 'r+b' if offset else 'w+b') as handle:
+                # the hash continues over what is already there
+                for block in iter(lambda: handle.read(BLOCK_SIZE), b''):
+                    digest.update(block)
+                handle.seek(offset)
+                handle.truncate()
+                try:
+                    for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+                        handle.write(block)
+                        digest.update(block)
+                except http.client.IncompleteRead as error:
+                    raise OSError(str(error)) from error
+                size = handle.tell()
+            if total is not None and size < total:
+                # the connection dropped: keep the .part file, the retry
+                # asks for the rest
+                raise OSError('{} ended after {} of {} bytes'.format(
+                    source, size, total))
+            digest = digest.hexdigest()
+            if expected is not None and digest != expected:
+                os.remove(part)
+                raise ValueError('checksum mismatch for {}'.format(source))
+            os.replace(part, target)
+            manifest.set(name, dict(source=source,
+                                    size=os.path.getsize(target),
+                                    sha256=digest))
+            return 'fetched'
+        except (OSError, ValueError):
+            if attempt == retries:
+                raise
+            time.sleep(retry_wait * 2**attempt)
+
+
+def fetch(sources, directory, max_workers=4, checksums=None, verify=False,
+          retries=3, retry_wait=1.0, timeout=60, progress=None):
+    """ Mirror sources (URLs or paths) into directory on up to max_workers
+    threads and return the local paths, in the order of sources.
+
+    A file already in the mirror is skipped; its sha256 is taken from the
+    manifest, or computed when verify is set or the file is not in the
+    manifest yet. checksums maps file names (or sources) to expected
+    sha256 hex digests: a present file that does not match is fetched
+    again, a download that does not match is an error. Failed downloads
+    are retried with exponential waits, keeping what was received. When
+    sources still fail, a RuntimeError lists them after all the others
+    are done. progress, if given, is called with (source, status, done,
+    total).
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = _Manifest(directory)
+    checksums = checksums or {}
+    targets = [os.path.join(directory, os.path.basename(
+        urllib.parse.urlparse(source).path) or source) for source in sources]
+
+    failed = {}
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(
+            _fetch_one, source, target, manifest,
+            checksums.get(os.path.basename(target), checksums.get(source)),
+            verify, retries, retry_wait, timeout): source
+            for source, target in zip(sources, targets)}
+        for future in as_completed(futures):
+            source = futures[future]
+            done += 1
+            try:
+                status = future.result()
+            except (OSError, ValueError) as error:
+                failed[source] = error
+                status = 'failed'
+            if progress is not None:
+                progress(source, status, done, len(futures))
+    if failed:
+        raise RuntimeError('could not fetch {} of {} sources: {}'.format(
+            len(failed), len(targets),
+            '; '.join('{}: {}'.format(*item) for item in failed.items())))
+    return targets
+
+
+def _truncate(store, dim, length):
+    """ Cut the arrays of a zarr store along dim back to length
+    """
+    import zarr
+    group = zarr.open_group(store, mode='r+')
+    for _, array in group.arrays():
+        # zarr format 2 keeps the names in an attribute, format 3 in the
+        # array metadata
+        dims = list(array.attrs.get('_ARRAY_DIMENSIONS') or getattr(
+            getattr(array, 'metadata', None), 'dimension_names', None) or [])
+        if dim in dims and array.shape[dims.index(dim)] > length:
+            shape = list(array.shape)
+            shape[dims.index(dim)] = length
+            array.resize(shape)
+
+
+def consolidate(paths, store, dim='time', chunks=None, variables=None):
+    """ Append the datasets in paths along dim, in the order of their
+    first dim value, into the zarr store and return it opened (lazily,
+    without dask).
+
+    chunks maps dimension names to chunk lengths of the store (default:
+    each file's length along dim, whole other dimensions). variables
+    limits the data variables. The files in the store and its length
+    along dim are kept in '<store>.json' next to it (to_zarr rewrites the
+    store's own attributes before it writes data); files listed there are
+    skipped, so new years can be added later. dim must keep increasing
+    along the store: a ValueError is raised, before anything is written,
+    when a new file starts at or before the end of the store or of the
+    file before it (consolidate into a new store then).
+    """
+    paths = [os.path.abspath(os.fspath(path)) for path in paths]
+    store = os.fspath(store).rstrip('/' + os.sep)
+    state_path = store + '.json'
+    sources, length = [], 0
+    if os.path.exists(store) and os.path.exists(state_path):
+        with open(state_path) as handle:
+            state = json.load(handle)
+        sources, length = state['sources'], state['length']
+    todo = [path for path in paths if path not in sources]
+    first, last = {}, {}
+    for path in todo:
+        with xr.open_dataset(path) as data:
+            first[path] = data[dim].values[0]
+            last[path] = data[dim].values[-1]
+    todo.sort(key=first.get)
+
+    end, end_name = None, store
+    if sources and todo:
+        with xr.open_dataset(store, engine='zarr', chunks=None,
+                             consolidated=False) as data:
+            end = data[dim].values[length - 1]
+    for path in todo:
+        if end is not None and not first[path] > end:
+            raise ValueError(
+                '{} starts at {} {}, not after the end of {} ({}); '
+                'consolidate into a new store'.format(
+                    path, dim, first[path], end_name, end))
+        end, end_name = last[path], path
+
+    for path in todo:
+        with xr.open_dataset(path) as data:
+            if variables is not None:
+                data = data[list(variables)]
+            if not sources:
+                encoding = {}
+                for name, variable in data.data_vars.items():
+                    sizes = dict(variable.sizes, **(chunks or {}))
+                    encoding[name] = dict(chunks=tuple(
+                        min(sizes[d], variable.sizes[d])
+                        if d != dim else sizes[d] for d in variable.dims))
+                data.to_zarr(store, mode='w', encoding=encoding,
+                             consolidated=False)
+            else:
+                # a run stopped during an append leaves a partial file
+                _truncate(store, dim, length)
+                data.to_zarr(store, mode='a', append_dim=dim,
+                             consolidated=False)
+            length += data.sizes[dim]
+        sources.append(path)
+        with open(state_path + '.tmp', 'w') as handle:
+            json.dump(dict(sources=sources, length=length), handle)
+        os.replace(state_path + '.tmp', state_path)
+    return xr.open_dataset(store, engine='zarr', chunks=None,
+                           consolidated=False)
+
+
+def plot_field(field, cmap='plasma', vmin=None, vmax=None, title=None,
+               label=None, figsize=(9, 5), dpi=100):
+    """ Figure of a 2D DataArray (lat, lon) in the style of the notebook's
+    frames; the default draw function of render_video
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=figsize, dpi=dpi, facecolor='w')
+    plt.subplots_adjust(left=0.075, right=0.895, bottom=0.1, top=0.93)
+    plt.pcolormesh(field[field.dims[1]], field[field.dims[0]], field,
+                   cmap=cmap, vmin=vmin, vmax=vmax)
+    if title is None and 'time' in field.coords:
+        title = str(np.datetime_as_string(field.time.values, unit='D'))
+    plt.title(title, fontsize=14)
+    cax = fig.add_axes([0.91, 0.12, 0.02, 0.8])
+    bar = plt.colorbar(cax=cax, orientation='vertical')
+    if label is not None:
+        bar.set_label(label=label, size=13)
+    return fig
+
+
+def _render(draw, item, options):
+    """ Worker: draw one frame and return it as a BGR uint8 image
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig = draw(item, **options)
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba())[..., 2::-1].copy()
+    plt.close(fig)
+    return image
+
+
+def render_video(draw, items, path, fps=4, max_workers=None, options=None,
+                 fourcc='mp4v'):
+    """ Video of draw(item, **options) (a matplotlib figure; draw must be
+    a module level function) for each of items, rendered on a process
+    pool and written in order as frames complete. At most two frames per
+    worker are in flight. Frames of another size than the first are
+    resized. Returns the number of frames written.
+    """
+    import cv2
+    options = options or {}
+    max_workers = max_workers or os.cpu_count() or 1
+    writer = None
+    count = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        items = iter(items)
+        while True:
+            while len(pending) < 2 * max_workers:
+                item = next(items, pending)
+                if item is pending:
+                    break
+                pending.append(executor.submit(_render, draw, item, options))
+            if not pending:
+                break
+            image = pending.popleft().result()
+            if writer is None:
+                size = (image.shape[1], image.shape[0])
+                writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc),
+                                         fps, size)
+            elif (image.shape[1], image.shape[0]) != size:
+                image = cv2.resize(image, size)
+            writer.write(image)
+            count += 1
+    if writer is not None:
+        writer.release()
+    return count
@@ -0,0 +1,293 @@
+""" Surface parcel LCL, LFC, EL, CAPE and CIN for many soundings at once.
+
+metpy.calc.cape_cin works on one profile and integrates the moist adiabat
+of each with solve_ivp. Here soundings are rows of (n_soundings,
+n_levels) arrays, NaN padded so each row can have its own (ragged)
+pressure levels, as returned by SoundingArchive.profiles. All rows are
+processed together:
+
+- LCL by the fixed point iteration of metpy.calc.lcl,
+- parcel temperature on each sounding's levels: dry adiabat below the LCL,
+  moist pseudo-adiabat above it by RK4 steps in ln(p), level by level for
+  all rows at once,
+- LFC (lowest), EL (highest), CAPE and CIN with the definitions of
+  metpy.calc.cape_cin (metpy 1.5): virtual temperature of parcel and
+  environment, crossings interpolated linearly in ln(p), and levels with
+  a missing pressure, temperature or dewpoint dropped.
+
+Inputs are hPa and degC, as siphon's data frames.
+
+Example:
+    pressure, temperature, dewpoint = archive.profiles(rows)
+    result = cape_cin(pressure, temperature, dewpoint)
+    result['cape'], result['cin'], result['lfc_pressure']
+"""
+import numpy as np
+
+# metpy.constants
+RD = 287.04749097718457  # J/(kg K)
+CP_D = 1004.6662184201462  # J/(kg K)
+LV = 2500840.0  # J/kg
+EPSILON = 0.6219569100577033
+KAPPA = RD / CP_D
+SAT_PRESSURE_0C = 6.112  # hPa
+ZERO_DEGC = 273.15
+
+PARCEL_FIELDS = [('lcl_pressure', float), ('lcl_temperature', float),
+                 ('lfc_pressure', float), ('el_pressure', float),
+                 ('cape', float), ('cin', float)]
+
+
+def saturation_vapor_pressure(temperature):
+    """ hPa, of temperature in K
+    """
+    return SAT_PRESSURE_0C * np.exp(
+        17.67 * (temperature - ZERO_DEGC) / (temperature - 29.65))
+
+
+def saturation_mixing_ratio(pressure, temperature):
+    e = saturation_vapor_pressure(temperature)
+    return EPSILON * e / (pressure - e)
+
+
+def dewpoint(vapor_pressure):
+    """ K, of vapor pressure in hPa
+    """
+    value = np.log(vapor_pressure / SAT_PRESSURE_0C)
+    return ZERO_DEGC + 243.5 * value / (17.67 - value)
+
+
+def virtual_temperature(temperature, mixing_ratio):
+    return (temperature * (mixing_ratio + EPSILON)
+            / (EPSILON * (1 + mixing_ratio)))
+
+
+def lcl(pressure, temperature, dewpoint_temperature, tolerance=1e-10,
+        max_iterations=100):
+    """ LCL pressure (hPa) and temperature (K) of parcels at pressure (hPa)
+    with temperature and dewpoint (K), as metpy.calc.lcl
+    """
+    w = saturation_mixing_ratio(pressure, dewpoint_temperature)
+    p = pressure.copy()
+    failed = np.zeros(p.shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iterations):
+            td = dewpoint(p * w / (EPSILON + w))
+            p_new = pressure * (td / temperature)**(1 / KAPPA)
+            failed |= np.isnan(p_new)
+            p_new = np.where(np.isnan(p_new), p, p_new)
+            done = np.abs(p_new - p) <= tolerance * np.abs(p)
+            p = p_new
+            if done.all():
+                break
+    p = np.where(failed, np.nan, p)
+    p = np.where(np.isclose(p, pressure), pressure, p)
+    return p, dewpoint(p * w / (EPSILON + w))
+
+
+def _moist_rate(log_p, temperature):
+    """ dT/dln(p) of the pseudo-adiabat, metpy.calc.moist_lapse
+    """
+    rs = saturation_mixing_ratio(np.exp(log_p), temperature)
+    return ((RD * temperature + LV * rs)
+            / (CP_D + LV * LV * rs * EPSILON / (RD * temperature**2)))
+
+
+def parcel_temperature(pressure, temperature, dewpoint_temperature,
+                       max_step=0.01):
+    """ Parcel temperature (K) on the levels of each row of pressure (hPa,
+    decreasing along rows, NaN padded) for the surface (first column)
+    parcel with temperature and dewpoint (K), as metpy.calc.parcel_profile.
+    max_step is the largest RK4 step in ln(p).
+    """
+    p0 = pressure[:, 0]
+    t0 = temperature
+    p_lcl, _ = lcl(p0, t0, dewpoint_temperature)
+    with np.errstate(invalid='ignore'):
+        profile = t0[:, None] * (pressure / p0[:, None])**KAPPA
+        moist = pressure < p_lcl[:, None]
+        # a profile that ends at its LCL is dry throughout
+        moist &= ~np.isclose(np.nanmin(pressure, axis=1), p_lcl)[:, None]
+
+    log_p = np.log(p_lcl)
+    state = t0 * (p_lcl / p0)**KAPPA
+    for level in range(pressure.shape[1]):
+        active = moist[:, level]
+        if not active.any():
+            continue
+        target = np.log(pressure[:, level])
+        span = np.where(active, target - log_p, 0)
+        n_steps = int(np.ceil(np.max(np.abs(span)) / max_step))
+        h = span / max(n_steps, 1)
+        for _ in range(n_steps):
+            k1 = _moist_rate(log_p, state)
+            k2 = _moist_rate(log_p + h / 2, state + h / 2 * k1)
+            k3 = _moist_rate(log_p + h / 2, state + h / 2 * k2)
+            k4 = _moist_rate(log_p + h, state + h * k3)
+            state = state + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+            log_p = log_p + h
+        log_p = np.where(active, target, log_p)
+        profile[active, level] = state[active]
+    return profile
+
+
+def _crossings(log_p, difference):
+    """ ln(p) where difference crosses zero between levels k and k + 1,
+    NaN where it does not, and the sign it crosses to, as
+    metpy.calc.find_intersections
+    """
+    sign = np.sign(difference)
+    # a crossing onto zero is counted with the next segment
+    found = (sign[:, :-1] != sign[:, 1:]) & (sign[:, 1:] != 0)
+    d0, d1 = difference[:, :-1], difference[:, 1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = (d1 * log_p[:, :-1] - d0 * log_p[:, 1:]) / (d1 - d0)
+    return np.where(found, x, np.nan), np.where(found, sign[:, 1:], 0)
+
+
+def _first(values, mask):
+    """ First masked value of each row, NaN when none
+    """
+    index = np.argmax(mask, axis=1)
+    out = np.take_along_axis(values, index[:, None], 1)[:, 0]
+    return np.where(mask.any(axis=1), out, np.nan)
+
+
+def _last(values, mask):
+    index = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+    out = np.take_along_axis(values, index[:, None], 1)[:, 0]
+    return np.where(mask.any(axis=1), out, np.nan)
+
+
+def _close_or(relation, a, b):
+    return relation(a, b) | np.isclose(a, b)
+
+
+def _compact(mask, *arrays):
+    """ Rows with the masked values moved to the front (order kept), NaN
+    after
+    """
+    order = np.argsort(~mask, axis=1, kind='stable')
+    mask = np.take_along_axis(mask, order, 1)
+    return [np.where(mask, np.take_along_axis(array, order, 1), np.nan)
+            for array in arrays]
+
+
+def _cape_cin_chunk(pressure, temperature, dewpoint_c):
+    """ PARCEL_FIELDS of one chunk of soundings
+    """
+    n, width = pressure.shape
+    out = np.zeros(n, dtype=PARCEL_FIELDS)
+    valid = (np.isfinite(pressure) & np.isfinite(temperature)
+             & np.isfinite(dewpoint_c))
+    p, t, td = _compact(valid, pressure, temperature + ZERO_DEGC,
+                        dewpoint_c + ZERO_DEGC)
+    count = valid.sum(axis=1)
+    usable = count >= 2
+    if not usable.all():
+        out[~usable] = (np.nan, np.nan, np.nan, np.nan, 0, 0)
+        p, t, td, count = p[usable], t[usable], td[usable], count[usable]
+    if not len(p):
+        return out
+    levels = np.isfinite(p)
+    last = count - 1
+    rows = np.arange(len(p))
+
+    p_lcl, t_lcl = lcl(p[:, 0], t[:, 0], td[:, 0])
+    parcel = parcel_temperature(p, t[:, 0], td[:, 0])
+
+    # virtual temperatures, as cape_cin: the parcel keeps its surface
+    # mixing ratio below the LCL and is saturated above it
+    with np.errstate(invalid='ignore'):
+        below = p > p_lcl[:, None]
+        parcel_w = np.where(below,
+                            saturation_mixing_ratio(p[:, :1], td[:, :1]),
+                            saturation_mixing_ratio(p, parcel))
+        t_env = virtual_temperature(t, saturation_mixing_ratio(p, td))
+        parcel = virtual_temperature(parcel, parcel_w)
+        y = parcel - t_env
+    log_p = np.log(p)
+    x, direction = _crossings(log_p, y)
+    segment = np.arange(width - 1)[None, :]
+    in_profile = levels[:, 1:]
+
+    # LFC, which='bottom'
+    skip_first = np.isclose(parcel[:, 0], t_env[:, 0])
+    first_segment = np.where(skip_first, 1, 0)[:, None]
+    increasing = (direction > 0) & in_profile & (segment >= first_segment)
+    decreasing = (direction < 0) & in_profile & (segment >= 1)
+    lfc_lcl, _ = lcl(p[:, 0], parcel[:, 0], td[:, 0])
+    with np.errstate(invalid='ignore'):
+        cross_p = np.exp(x)
+        above_lcl = increasing & (cross_p < lfc_lcl[:, None])
+        # no crossing above the LCL: the LFC is the LCL if the parcel is
+        # warmer anywhere above it (no crossing at all), or if it turned
+        # warmer below the LCL and does not cool again before it (metpy
+        # raises when it never cools again; the LCL is used then too)
+        warmer = (levels & (p < lfc_lcl[:, None])
+                  & ~_close_or(np.less, parcel, t_env)).any(axis=1)
+        lowest_el = np.where(decreasing.any(axis=1), np.min(
+            np.where(decreasing, cross_p, np.inf), axis=1), 0)
+        lfc_is_lcl = np.where(increasing.any(axis=1),
+                              lowest_el <= lfc_lcl, warmer)
+    lfc = np.where(above_lcl.any(axis=1), _first(cross_p, above_lcl),
+                   np.where(lfc_is_lcl, lfc_lcl, np.nan))
+
+    # EL, which='top'
+    env_lcl, _ = lcl(p[:, 0], t_env[:, 0], td[:, 0])
+    top_el = _last(cross_p, decreasing)
+    with np.errstate(invalid='ignore'):
+        el = np.where((parcel[rows, last] <= t_env[rows, last])
+                      & (top_el < env_lcl), top_el, np.nan)
+    limit = np.where(np.isnan(el), p[rows, last], el)
+
+    # levels and the zero crossings above the first segment, in ln(p)
+    crossing = np.where(segment >= 1, x, np.nan)
+    joined_x = np.full((len(p), 2 * width - 1), np.nan)
+    joined_y = np.zeros_like(joined_x)
+    joined_x[:, 0::2] = log_p
+    joined_x[:, 1::2] = crossing
+    joined_y[:, 0::2] = y
+    joined_x, joined_y = _compact(np.isfinite(joined_x), joined_x, joined_y)
+    joined_p = np.exp(joined_x)
+    area = 0.5 * (joined_y[:, :-1] + joined_y[:, 1:]) * (
+        joined_x[:, :-1] - joined_x[:, 1:])
+    with np.errstate(invalid='ignore'):
+        cape_points = (_close_or(np.less, joined_p, lfc[:, None])
+                       & _close_or(np.greater, joined_p, limit[:, None]))
+        cin_points = _close_or(np.greater, joined_p, lfc[:, None])
+    cape = RD * np.nansum(np.where(cape_points[:, :-1] & cape_points[:, 1:],
+                                   area, 0), axis=1)
+    cin = RD * np.nansum(np.where(cin_points[:, :-1] & cin_points[:, 1:],
+                                  area, 0), axis=1)
+    no_lfc = np.isnan(lfc)
+
+    result = out[usable] if not usable.all() else out
+    result['lcl_pressure'] = p_lcl
+    result['lcl_temperature'] = t_lcl - ZERO_DEGC
+    result['lfc_pressure'] = lfc
+    result['el_pressure'] = el
+    result['cape'] = np.where(no_lfc, 0, cape)
+    result['cin'] = np.where(no_lfc, 0, np.minimum(cin, 0))
+    out[usable] = result
+    return out
+
+
+def cape_cin(pressure, temperature, dewpoint, chunk_size=2048):
+    """ Surface parcel LCL (hPa, degC), LFC and EL (hPa, NaN when there is
+    none), CAPE and CIN (J/kg) of each row of pressure (hPa), temperature
+    and dewpoint (degC), as a structured array of PARCEL_FIELDS.
+
+    Rows go from the surface up, NaN padded after their last level.
+    Soundings with fewer than two complete levels get NaN levels and zero
+    CAPE and CIN.
+    """
+    pressure, temperature, dewpoint = (
+        np.atleast_2d(np.asarray(value, dtype=float))
+        for value in (pressure, temperature, dewpoint))
+    out = np.zeros(len(pressure), dtype=PARCEL_FIELDS)
+    for start in range(0, len(pressure), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        out[chunk] = _cape_cin_chunk(pressure[chunk], temperature[chunk],
+                                     dewpoint[chunk])
+    return out
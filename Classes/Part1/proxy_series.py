@@ -0,0 +1,275 @@
+""" Lag correlation of long climate records (ice cores, proxy stacks).
+
+Lec6b_long_climate_CO2_data puts CO2 and temperature on a common 100 yr
+grid with np.interp and takes the lag from np.correlate(co2, temp,
+'full'), which is O(n^2), not normalized, and NaN as soon as one value is
+(the temperature is interpolated with right=np.nan). Here
+
+- `read_table` reads the Excel/CSV sources once and keeps them as a
+  binary column file (.npz) keyed by the file and the read options, so
+  repeat loads take milliseconds instead of re-parsing the workbook,
+- `resample` interpolates any number of records onto a grid, NaN outside
+  each record,
+- `lag_correlation` gives the Pearson correlation of the overlapping,
+  non-missing pairs at every lag, for whole records or sliding windows of
+  them and with moving block bootstrap confidence bands, in one batched
+  call. All lags come from a handful of FFT cross-correlations of the
+  series, their squares and their missing value masks, O(n log n) per
+  window and replicate.
+
+Example:
+    temp = read_table('temperature_dataset.xlsx', sheet_name=3)
+    co2 = read_table('ghg-concentrations_fig-1_CO2ppm.csv', skiprows=6)
+    grid = np.arange(-800000, -3000, 100)
+    series = resample(
+        [co2['Year (negative values = BC)'], -temp['Age (yr BP)']],
+        [co2['EPICA Dome C and  Vostok Station,  Antarctica'],
+         temp['Temperature Anomaly (°C) ']], grid)
+    result = lag_correlation(series[0], series[1], max_lag=100,
+                             spacing=100, n_boot=1000)
+    best = np.nanargmax(result['correlation'])
+    result['lag'][best], result['lower'][best], result['upper'][best]
+"""
+import hashlib
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy import fft
+
+
+def _cache_path(path, cache_dir, options):
+    """ Cache file of path (its name, size and modification time) read
+    with options
+    """
+    status = os.stat(path)
+    key = json.dumps([os.path.abspath(path), status.st_size,
+                      status.st_mtime_ns, options], sort_keys=True,
+                     default=repr)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest()
+                        + '.npz')
+
+
+def _save_frames(path, frames):
+    """ Frames (dict of name: DataFrame) as one array per column; text
+    columns as strings with a missing value mask
+    """
+    arrays = {}
+    meta = []
+    for i, (name, frame) in enumerate(frames.items()):
+        index = 0
+        if not frame.index.equals(pd.RangeIndex(len(frame))):
+            index = frame.index.nlevels
+            frame = frame.reset_index()
+        text = []
+        for j, (_, column) in enumerate(frame.items()):
+            key = '{}/{}'.format(i, j)
+            if pd.api.types.is_numeric_dtype(column) and column.hasnans:
+                arrays[key] = column.to_numpy(dtype=float, na_value=np.nan)
+            elif (pd.api.types.is_numeric_dtype(column)
+                  or pd.api.types.is_datetime64_any_dtype(column)):
+                arrays[key] = column.to_numpy()
+            else:
+                arrays[key] = column.astype(str).to_numpy(dtype=str)
+                arrays[key + '/missing'] = column.isna().to_numpy()
+                text.append(j)
+        meta.append(dict(name=name, columns=list(frame.columns), text=text,
+                         index=index))
+    arrays['meta'] = np.array(json.dumps(meta, default=str))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write then rename, so a partial file is never a cache
+    with open(path + '.tmp', 'wb') as handle:
+        np.savez(handle, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def _load_frames(path):
+    frames = {}
+    with np.load(path) as arrays:
+        for i, entry in enumerate(json.loads(arrays['meta'][()])):
+            columns = {}
+            for j in range(len(entry['columns'])):
+                key = '{}/{}'.format(i, j)
+                values = arrays[key]
+                if j in entry['text']:
+                    values = values.astype(object)
+                    values[arrays[key + '/missing']] = np.nan
+                columns[j] = values
+            frame = pd.DataFrame(columns)
+            frame.columns = entry['columns']
+            if entry['index']:
+                frame = frame.set_index(entry['columns'][:entry['index']])
+            frames[entry['name']] = frame
+    return frames
+
+
+def read_table(path, sheet_name=0, cache_dir=None, **kwargs):
+    """ pd.read_excel (.xls, .xlsx, .ods) or pd.read_csv of path with
+    kwargs, through a cache in cache_dir (default: .cache next to path).
+
+    sheet_name is that of read_excel (ignored for CSV): a name or position
+    gives one DataFrame, a list or None a dict of them. The cache is
+    refreshed when the file changes.
+    """
+    path = os.fspath(path)
+    excel = path.lower().endswith(('.xls', '.xlsx', '.xlsm', '.ods'))
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                 '.cache')
+    options = dict(kwargs, sheet_name=sheet_name if excel else None)
+    cache = _cache_path(path, cache_dir, options)
+    single = not excel or isinstance(sheet_name, (str, int))
+    if os.path.exists(cache):
+        frames = _load_frames(cache)
+    else:
+        if excel:
+            frames = pd.read_excel(path, sheet_name=sheet_name, **kwargs)
+            if single:
+                frames = {sheet_name: frames}
+        else:
+            frames = {os.path.basename(path): pd.read_csv(path, **kwargs)}
+        _save_frames(cache, frames)
+    return next(iter(frames.values())) if single else frames
+
+
+def resample(time, values, grid):
+    """ Records values (one per row, or a list of 1D arrays) at times time
+    (one per record, or one for all) linearly interpolated onto grid, as a
+    (n_records, len(grid)) array (1D for one record).
+
+    Missing values are skipped and grid points outside the finite part of
+    a record are NaN at both ends. Times may be in either order (ages).
+    """
+    grid = np.asarray(grid, dtype=float)
+    one = np.ndim(values[0]) == 0
+    if one:
+        values = [values]
+    if np.ndim(time[0]) == 0:
+        time = [time] * len(values)
+    out = np.full((len(values), len(grid)), np.nan)
+    for row, (t, v) in enumerate(zip(time, values)):
+        t, v = np.asarray(t, dtype=float), np.asarray(v, dtype=float)
+        finite = np.isfinite(t) & np.isfinite(v)
+        order = np.argsort(t[finite], kind='stable')
+        t, v = t[finite][order], v[finite][order]
+        if len(t):
+            out[row] = np.interp(grid, t, v, left=np.nan, right=np.nan)
+    return out[0] if one else out
+
+
+def _centred(values, mask):
+    """ values minus their mean along the last axis, zero where missing
+    """
+    values = np.where(mask, values, 0)
+    count = np.maximum(mask.sum(axis=-1, keepdims=True), 1)
+    return np.where(mask, values - values.sum(axis=-1, keepdims=True) / count,
+                    0)
+
+
+def _block_weights(rng, shape, length):
+    """ Moving block bootstrap counts of each of shape[-1] time steps, for
+    every replicate of the leading shape: ceil(n / length) blocks of
+    length consecutive steps at random starts, cut to n steps.
+    """
+    n = shape[-1]
+    length = min(length, n)
+    rows = int(np.prod(shape[:-1]))
+    n_blocks = -(-n // length)
+    starts = rng.integers(0, n - length + 1, (rows, n_blocks))
+    steps = (starts[:, :, None] + np.arange(length)).reshape(rows, -1)[:, :n]
+    steps = steps + n * np.arange(rows)[:, None]
+    return np.bincount(steps.ravel(), minlength=rows * n).reshape(shape)
+
+
+def _correlation(x_hat, y, mask_y, weights, nfft, max_lag, min_count):
+    """ Correlation and pair count at lags -max_lag..max_lag from the FFTs
+    of the x side (x, x^2, mask) and the y side, each pair counted weights
+    times
+    """
+    def correlate(a_hat, b_hat):
+        c = fft.irfft(a_hat * np.conj(b_hat), nfft)
+        return np.concatenate((c[..., nfft - max_lag:], c[..., :max_lag + 1]),
+                              axis=-1)
+
+    y_hat = fft.rfft(np.stack((weights * y, weights * y * y,
+                               weights * mask_y)), nfft)
+    count = np.rint(correlate(x_hat[2], y_hat[2]))
+    sum_x = correlate(x_hat[0], y_hat[2])
+    sum_xx = correlate(x_hat[1], y_hat[2])
+    sum_y = correlate(x_hat[2], y_hat[0])
+    sum_yy = correlate(x_hat[2], y_hat[1])
+    sum_xy = correlate(x_hat[0], y_hat[0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var_x = sum_xx - sum_x**2 / count
+        var_y = sum_yy - sum_y**2 / count
+        r = (sum_xy - sum_x * sum_y / count) / np.sqrt(var_x * var_y)
+    # round off leaves tiny variances where a series is constant
+    flat = (var_x <= 1e-10 * sum_xx) | (var_y <= 1e-10 * sum_yy)
+    r[(count < min_count) | flat] = np.nan
+    return np.clip(r, -1, 1), count
+
+
+def lag_correlation(x, y, max_lag, spacing=1, window=None, step=None,
+                    min_count=10, n_boot=0, block=None, alpha=0.05,
+                    seed=None, boot_chunk=16):
+    """ Pearson correlation of x[t + lag] with y[t] over the pairs where
+    both are finite, for lag = -max_lag..max_lag steps: a positive lag
+    means x follows y.
+
+    x and y are evenly spaced series along the last axis (spacing apart,
+    e.g. from resample); leading axes broadcast, so many records go in one
+    call. With window, the correlation is computed in windows of that many
+    steps starting every step (default window) steps. Lags with fewer than
+    min_count pairs are NaN.
+
+    With n_boot, the pairs are resampled n_boot times by moving blocks of
+    block steps (default about n^(1/3), for autocorrelated series) and the
+    alpha/2 and 1 - alpha/2 quantiles of the replicate correlations are
+    the confidence band. Replicates are done boot_chunk at a time.
+
+    Returns a dict: lag (in units of spacing), correlation and count
+    (..., [n_windows,] n_lags), window_start (indices, with window) and
+    lower and upper (with n_boot).
+    """
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=float),
+                               np.asarray(y, dtype=float))
+    out = dict(lag=np.arange(-max_lag, max_lag + 1) * spacing)
+    if window is not None:
+        step = window if step is None else step
+        starts = np.arange(0, x.shape[-1] - window + 1, step)
+        x = np.lib.stride_tricks.sliding_window_view(x, window, -1)[
+            ..., starts, :]
+        y = np.lib.stride_tricks.sliding_window_view(y, window, -1)[
+            ..., starts, :]
+        out['window_start'] = starts
+    n = x.shape[-1]
+    nfft = fft.next_fast_len(n + max_lag, real=True)
+
+    # centred and zero filled; the mask counts the pairs
+    mask_x, mask_y = np.isfinite(x), np.isfinite(y)
+    x, y = _centred(x, mask_x), _centred(y, mask_y)
+    mask_x, mask_y = mask_x.astype(float), mask_y.astype(float)
+    x_hat = fft.rfft(np.stack((x, x * x, mask_x)), nfft)
+    out['correlation'], out['count'] = _correlation(
+        x_hat, y, mask_y, 1, nfft, max_lag, min_count)
+
+    if n_boot:
+        rng = np.random.default_rng(seed)
+        block = (max(int(round(n**(1 / 3))), 1) if block is None
+                 else block)
+        replicates = []
+        for start in range(0, n_boot, boot_chunk):
+            size = min(boot_chunk, n_boot - start)
+            weights = _block_weights(rng, (size,) + y.shape, block)
+            r, _ = _correlation(x_hat[:, None], y, mask_y, weights, nfft,
+                                max_lag, min_count)
+            replicates.append(r)
+        replicates = np.concatenate(replicates)
+        with warnings.catch_warnings():
+            # lags without enough pairs are NaN in every replicate
+            warnings.simplefilter('ignore', RuntimeWarning)
+            out['lower'], out['upper'] = np.nanquantile(
+                replicates, [alpha / 2, 1 - alpha / 2], axis=0)
+    return out
@@ -0,0 +1,204 @@
+""" Streaming weighted running means with a reduction, for multi-file
+datasets larger than memory.
+
+Lec4_ntcdf_climate_data computes
+
+    (d.so.rolling(time=3, center=True).construct('roll')
+     .dot(weights).mean('lon'))
+
+on open_mfdataset(...), where construct builds a window-sized copy of the
+whole field before it is reduced. `RollingReduction` does the same in one
+pass over time chunks: each chunk is read once, the window is summed with
+shifted slices of the chunk (no window copy), the reduce dimensions are
+averaged (NaN skipped, as .mean), and the time steps the next window needs
+(the halo) are carried over from the previous chunk instead of read again.
+Peak memory is about three chunks.
+
+Reduced chunks are written to an on-disk store (one .npy per chunk) keyed
+by the input files (path, size, modification time) and the operation, so a
+repeated or interrupted run only computes what is missing.
+
+Example:
+    files = sorted(glob.glob('so_Omon_ORAreanalysis_ORAS4*'))
+    reduction = RollingReduction(files, 'so', weights=[0.25, 0.5, 0.25],
+                                 reduce_dims='lon', cache_dir='cache')
+    out = reduction.compute(progress=True)
+    out.sel(time='1985-05').plot(robust=True, yincrease=False)
+    reduction.timings  # read, compute and write seconds of each chunk
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import xarray as xr
+
+
+class RollingReduction:
+    """ Weighted rolling window over dim followed by a mean over
+    reduce_dims, for variable in files concatenated along dim (in the
+    given order).
+
+    center follows xarray's rolling: the window of step t covers
+    t - w//2 ... t + w - 1 - w//2 when centred, t - w + 1 ... t otherwise,
+    and steps whose window leaves the data are NaN. A NaN anywhere in a
+    window makes the weighted sum NaN (as construct().dot()); the mean
+    over reduce_dims then skips it. chunk_size is in steps of dim.
+    """
+
+    def __init__(self, files, variable, weights=(0.25, 0.5, 0.25),
+                 dim='time', reduce_dims='lon', center=True, chunk_size=12,
+                 cache_dir=None):
+        self.files = [os.fspath(path) for path in files]
+        self.variable = variable
+        self.weights = np.asarray(weights, dtype=float)
+        self.dim = dim
+        self.reduce_dims = ([reduce_dims] if isinstance(reduce_dims, str)
+                            else list(reduce_dims))
+        self.center = center
+        self.chunk_size = chunk_size
+        self.cache_dir = cache_dir
+        window = self.weights.size
+        self.left = window // 2 if center else window - 1
+        self.right = window - 1 - self.left
+        self.timings = []
+
+        # metadata only: steps per file, coordinates of the output
+        self.steps = []
+        times = []
+        for path in self.files:
+            with xr.open_dataset(path) as data:
+                array = data[variable]
+                self.steps.append(array.sizes[dim])
+                times.append(array[dim].values)
+                if len(self.steps) == 1:
+                    self.dims = [name for name in array.dims
+                                 if name not in self.reduce_dims]
+                    self.dims.remove(dim)
+                    self.coords = {name: array[name].values
+                                   for name in self.dims
+                                   if name in array.coords}
+                    self.attrs = dict(array.attrs)
+        self.time = np.concatenate(times)
+        self.n_steps = len(self.time)
+        self.n_chunks = -(-self.n_steps // chunk_size)
+
+    def key(self):
+        """ Cache key of the input files and the operation
+        """
+        files = []
+        for path in self.files:
+            status = os.stat(path)
+            files.append([os.path.abspath(path), status.st_size,
+                          status.st_mtime_ns])
+        operation = dict(files=files, variable=self.variable,
+                         weights=self.weights.tolist(), dim=self.dim,
+                         reduce_dims=self.reduce_dims, center=self.center,
+                         chunk_size=self.chunk_size)
+        return hashlib.sha1(json.dumps(operation).encode()).hexdigest()
+
+    def _read(self, start, stop):
+        """ Steps start:stop of the variable, dim first, across files
+        """
+        pieces = []
+        offset = 0
+        for path, steps in zip(self.files, self.steps):
+            low, high = max(start - offset, 0), min(stop - offset, steps)
+            if low < high:
+                with xr.open_dataset(path) as data:
+                    array = data[self.variable].isel({self.dim: slice(low,
+                                                                      high)})
+                    pieces.append(array.transpose(
+                        self.dim, *self.dims, *self.reduce_dims).values)
+            offset += steps
+        return np.concatenate(pieces) if len(pieces) > 1 else pieces[0]
+
+    def _reduce(self, block, n_out):
+        """ Weighted window sums of the n_out steps of block that have
+        their whole window in it, averaged over the reduce dimensions
+        """
+        total = self.weights[0] * block[:n_out]
+        for shift, weight in enumerate(self.weights[1:], 1):
+            total += weight * block[shift:shift + n_out]
+        axes = tuple(range(total.ndim - len(self.reduce_dims), total.ndim))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            count = np.sum(~np.isnan(total), axis=axes)
+            return np.nansum(total, axis=axes) / count
+
+    def compute(self, progress=False):
+        """ The reduced DataArray (dim and the remaining dimensions).
+
+        Cached chunks are loaded, missing ones computed and stored. With
+        progress, one line per chunk is printed; self.timings holds the
+        read, compute and write seconds of each computed chunk.
+        """
+        store = None
+        if self.cache_dir is not None:
+            store = os.path.join(self.cache_dir, self.key())
+            os.makedirs(store, exist_ok=True)
+        self.timings = []
+        chunks = []
+        buffer = None  # steps buffer_start: of the data read so far
+        buffer_start = 0
+        for index in range(self.n_chunks):
+            start = index * self.chunk_size
+            stop = min(start + self.chunk_size, self.n_steps)
+            path = (None if store is None
+                    else os.path.join(store, 'chunk_{:05d}.npy'.format(index)))
+            if path is not None and os.path.exists(path):
+                chunks.append(np.load(path))
+                buffer = None
+                if progress:
+                    print('chunk {}/{} cached'.format(index + 1,
+                                                      self.n_chunks))
+                continue
+
+            tic = time.perf_counter()
+            # the window of steps start:stop needs low:high
+            low = max(start - self.left, 0)
+            high = min(stop + self.right, self.n_steps)
+            if buffer is None or buffer_start > low:
+                buffer = self._read(low, high)
+            else:
+                # halo carried over from the previous chunk
+                have = buffer_start + len(buffer)
+                buffer = buffer[low - buffer_start:]
+                if have < high:
+                    buffer = np.concatenate((buffer, self._read(have, high)))
+            buffer_start = low
+            read = time.perf_counter() - tic
+
+            tic = time.perf_counter()
+            # NaN padding where the window leaves the data
+            block = buffer
+            pad_low = low - (start - self.left)
+            pad_high = (stop + self.right) - high
+            if pad_low or pad_high:
+                block = np.pad(buffer, [(pad_low, pad_high)]
+                               + [(0, 0)] * (buffer.ndim - 1),
+                               constant_values=np.nan)
+            reduced = self._reduce(block, stop - start)
+            compute = time.perf_counter() - tic
+
+            tic = time.perf_counter()
+            if path is not None:
+                # write then rename, so a partial file is never a chunk
+                np.save(path + '.tmp.npy', reduced)
+                os.replace(path + '.tmp.npy', path)
+            write = time.perf_counter() - tic
+            chunks.append(reduced)
+            self.timings.append(dict(chunk=index, steps=stop - start,
+                                     read=read, compute=compute,
+                                     write=write))
+            if progress:
+                print('chunk {}/{} steps {}-{} read {:.2f} s compute {:.2f} s'
+                      ' write {:.2f} s'.format(index + 1, self.n_chunks,
+                                               start, stop - 1, read,
+                                               compute, write))
+
+        coords = dict(self.coords)
+        coords[self.dim] = self.time
+        return xr.DataArray(np.concatenate(chunks), dims=[self.dim]
+                            + self.dims, coords=coords, attrs=self.attrs,
+                            name=self.variable)
@@ -0,0 +1,316 @@
+""" Offline store of upper air soundings.
+
+skew_T_parcels_plots requests one sounding at a time from the IGRA2 and
+Wyoming web services. `SoundingArchive` ingests the text archives those
+services are built on (IGRA2 station data files, plain or zipped, and
+saved Wyoming TEXT:LIST pages) into one directory of column files:
+
+    index.npy                  one record per sounding: station, time,
+                               lat, lon, elevation and its segment and
+                               rows in that segment's columns
+    segments/00000/            the levels of one ingest, back to back:
+        pressure.npy, ...      float32 columns
+    segments/00001/ ...
+
+Each ingest writes its levels to a new segment and rewrites only the
+index, so adding a year of a station does not copy the archive. A
+sounding ingested again (same station and time) points to its newest
+copy; the old levels stay in their segment, unused. Soundings are sorted
+by station and time in the index, and the columns are opened
+memory-mapped, so selecting by station and time is a binary search and
+only the selected levels are read. Units follow siphon's data frames:
+hPa, m, degC, degrees and m/s.
+
+Example:
+    archive = SoundingArchive('soundings')
+    archive.ingest_igra(glob.glob('igra2/*-data.txt.zip'))
+    rows = archive.select('USM00072797', '1990-01-01', '2020-12-31')
+    pressure, temperature, dewpoint = archive.profiles(rows)
+    parcels = parcel_batch.cape_cin(pressure, temperature, dewpoint)
+"""
+import os
+import re
+import zipfile
+
+import numpy as np
+
+COLUMNS = ('pressure', 'height', 'temperature', 'dewpoint', 'direction',
+           'speed')
+INDEX_FIELDS = [('station', 'U11'), ('time', 'datetime64[s]'),
+                ('latitude', float), ('longitude', float),
+                ('elevation', float), ('segment', np.int32),
+                ('start', np.int64), ('count', np.int32)]
+
+KNOT = 0.514444  # m/s
+
+# IGRA2 data records, 0-based column slices and scale; -9999 and -8888
+# are missing and removed values
+_IGRA_FIELDS = dict(pressure=(9, 15, 0.01), height=(16, 21, 1),
+                    temperature=(22, 27, 0.1), dewpoint_depression=(34, 39,
+                                                                    0.1),
+                    direction=(40, 45, 1), speed=(46, 51, 0.1))
+
+_WYOMING_HEADER = re.compile(
+    r'<h2>\s*(\w+).*?Observations at (\d\d)Z (\d\d) (\w{3}) (\d{4})')
+# lines of the 'Station information and sounding indices' block
+_WYOMING_INFO = re.compile(r'^\s*Station (identifier|number|latitude|'
+                           r'longitude|elevation):\s*(\S+)', re.M)
+_PRE = re.compile(r'<pre>(.*?)</pre>', re.S | re.I)
+_MONTHS = dict(Jan=1, Feb=2, Mar=3, Apr=4, May=5, Jun=6, Jul=7, Aug=8,
+               Sep=9, Oct=10, Nov=11, Dec=12)
+
+
+def _read_text(path):
+    """ Text of a file, or of the first member of a zip file
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            return archive.read(archive.namelist()[0]).decode('latin-1')
+    with open(path, encoding='latin-1') as handle:
+        return handle.read()
+
+
+def _fixed_width(lines, start, stop, scale):
+    """ Float column of fixed width integer fields, missing codes to NaN
+    """
+    field = np.array([line[start:stop] for line in lines], dtype='S')
+    values = np.char.strip(field)
+    values[values == b''] = b'-9999'
+    values = values.astype(np.int64)
+    out = values * float(scale)
+    out[(values == -9999) | (values == -8888)] = np.nan
+    return out
+
+
+def read_igra(path):
+    """ Soundings of one IGRA2 station data file: index records and
+    columns (see INDEX_FIELDS and COLUMNS)
+    """
+    lines = _read_text(path).splitlines()
+    headers = [i for i, line in enumerate(lines) if line.startswith('#')]
+    index = np.zeros(len(headers), dtype=INDEX_FIELDS)
+    data_lines = []
+    for record, i in zip(index, headers):
+        line = lines[i]
+        count = int(line[32:36])
+        year, month, day = int(line[13:17]), int(line[18:20]), int(line[21:23])
+        hour, release = int(line[24:26]), int(line[27:31])
+        if hour == 99:
+            # nominal hour missing, use the release time if there is one
+            hour = release // 100 if release != 9999 else 0
+        record['station'] = line[1:12].strip()
+        record['time'] = np.datetime64('{:04d}-{:02d}-{:02d}T{:02d}'.format(
+            year, month, day, hour))
+        record['latitude'] = int(line[55:62]) / 1e4
+        record['longitude'] = int(line[63:71]) / 1e4
+        # the station list has the elevation, the data headers do not
+        record['elevation'] = np.nan
+        record['count'] = count
+        data_lines.extend(lines[i + 1:i + 1 + count])
+    index['start'] = np.cumsum(index['count']) - index['count']
+
+    values = {name: _fixed_width(data_lines, *field)
+              for name, field in _IGRA_FIELDS.items()}
+    values['dewpoint'] = (values['temperature']
+                          - values.pop('dewpoint_depression'))
+    return index, values
+
+
+def read_wyoming(path):
+    """ Soundings of a saved Wyoming TEXT:LIST page (one or more
+    stations and times): index records and columns. Station, latitude,
+    longitude and elevation come from the station information block
+    after each table; the station is the identifier (e.g. GRB) when the
+    page has one, else the WMO number.
+    """
+    text = _read_text(path)
+    records = []
+    columns = {name: [] for name in COLUMNS}
+    headers = list(_WYOMING_HEADER.finditer(text))
+    for match, following in zip(headers, headers[1:] + [None]):
+        number, hour, day, month, year = match.groups()
+        data = _PRE.search(text, match.end())
+        block = data.group(1)
+        info = _PRE.search(text, data.end())
+        if info is None or (following is not None
+                            and info.start() > following.start()):
+            info = {}
+        else:
+            info = dict(_WYOMING_INFO.findall(info.group(1)))
+        rows = []
+        dashes = 0
+        for line in block.splitlines():
+            if line.startswith('-----'):
+                dashes += 1
+            elif dashes >= 2 and line.strip():
+                rows.append(line)
+        if not rows:
+            continue
+        # seven character columns PRES HGHT TEMP DWPT RELH MIXR DRCT SKNT
+        table = {name: [] for name in COLUMNS}
+        for line in rows:
+            fields = [line[k:k + 7].strip() for k in range(0, 56, 7)]
+            fields = [float(field) if field else np.nan for field in fields]
+            for name, value in zip(('pressure', 'height', 'temperature',
+                                    'dewpoint'), fields[:4]):
+                table[name].append(value)
+            table['direction'].append(fields[6])
+            table['speed'].append(fields[7] * KNOT)
+        for name in COLUMNS:
+            columns[name].extend(table[name])
+        records.append((
+            info.get('identifier') or info.get('number', number),
+            np.datetime64('{}-{:02d}-{}T{}'.format(
+                year, _MONTHS[month], day, hour)),
+            float(info.get('latitude', 'nan')),
+            float(info.get('longitude', 'nan')),
+            float(info.get('elevation', 'nan')), 0, 0, len(rows)))
+    index = np.array(records, dtype=INDEX_FIELDS)
+    index['start'] = np.cumsum(index['count']) - index['count']
+    return index, {name: np.array(value, dtype=float)
+                   for name, value in columns.items()}
+
+
+class SoundingArchive:
+    """ Column store of soundings in directory path (created on the first
+    ingest). The index is memory-mapped on open, the columns of each
+    segment when they are first read.
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self._open()
+
+    def _open(self):
+        index_path = os.path.join(self.path, 'index.npy')
+        self._segments = {}
+        if not os.path.exists(index_path):
+            self.index = np.zeros(0, dtype=INDEX_FIELDS)
+            return
+        self.index = np.load(index_path, mmap_mode='r')
+        if self.index.dtype != np.dtype(INDEX_FIELDS):
+            raise ValueError('{} is not a segmented sounding archive, '
+                             'ingest its sources again'.format(self.path))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, 'segments', '{:05d}'.format(segment))
+
+    def _columns(self, segment):
+        """ The memory-mapped columns of one segment
+        """
+        if segment not in self._segments:
+            path = self._segment_path(segment)
+            self._segments[segment] = {
+                name: np.load(os.path.join(path, name + '.npy'),
+                              mmap_mode='r') for name in COLUMNS}
+        return self._segments[segment]
+
+    def __len__(self):
+        return len(self.index)
+
+    def ingest_igra(self, paths):
+        """ Add IGRA2 station data files (.txt or .zip)
+        """
+        self._add([read_igra(path) for path in np.atleast_1d(paths)])
+
+    def ingest_wyoming(self, paths):
+        """ Add saved Wyoming TEXT:LIST pages
+        """
+        self._add([read_wyoming(path) for path in np.atleast_1d(paths)])
+
+    def _add(self, parts):
+        """ Write (index, columns) parts as a new segment and merge their
+        records into the index; a sounding of the same station and time
+        replaces the stored one
+        """
+        if not sum(len(part[0]) for part in parts):
+            return
+        segments = os.path.join(self.path, 'segments')
+        os.makedirs(segments, exist_ok=True)
+        segment = 1 + max([int(name) for name in os.listdir(segments)
+                           if name.isdigit()], default=-1)
+
+        new = np.concatenate([part[0] for part in parts])
+        offsets = np.cumsum([0] + [len(part[1]['pressure'])
+                                   for part in parts[:-1]])
+        new['start'] += np.repeat(offsets, [len(part[0]) for part in parts])
+        new['segment'] = segment
+        # a segment is complete once its directory has its final name
+        path = self._segment_path(segment)
+        os.makedirs(path + '.tmp', exist_ok=True)
+        for name in COLUMNS:
+            np.save(os.path.join(path + '.tmp', name + '.npy'), np.concatenate(
+                [np.asarray(part[1][name], dtype=np.float32)
+                 for part in parts]))
+        os.replace(path + '.tmp', path)
+
+        # newest copy of each (station, time), sorted by station and time
+        index = np.concatenate([np.asarray(self.index), new])
+        order = np.lexsort((-np.arange(len(index)), index['time'],
+                            index['station']))
+        index = index[order]
+        keep = np.ones(len(index), dtype=bool)
+        keep[1:] = ((index['station'][1:] != index['station'][:-1])
+                    | (index['time'][1:] != index['time'][:-1]))
+        # the old index is still mapped, so write a new one and swap
+        self._save('index', index[keep])
+        self._open()
+
+    def _save(self, name, values):
+        path = os.path.join(self.path, name + '.npy')
+        np.save(path + '.tmp.npy', values)
+        os.replace(path + '.tmp.npy', path)
+
+    def stations(self):
+        return np.unique(self.index['station'])
+
+    def select(self, station=None, start=None, end=None):
+        """ Positions of the soundings of station (one or a list, all by
+        default) from start to end (inclusive, anything np.datetime64
+        takes)
+        """
+        index = self.index
+        if station is None:
+            positions = np.arange(len(index))
+        else:
+            # soundings are sorted by station, so each is one block
+            positions = np.concatenate([np.arange(
+                np.searchsorted(index['station'], name, 'left'),
+                np.searchsorted(index['station'], name, 'right'))
+                for name in np.atleast_1d(station)])
+        times = index['time'][positions]
+        keep = np.ones(len(positions), dtype=bool)
+        if start is not None:
+            keep &= times >= np.datetime64(start, 's')
+        if end is not None:
+            keep &= times <= np.datetime64(end, 's')
+        return positions[keep]
+
+    def sounding(self, position):
+        """ Columns of one sounding, as a dict of arrays
+        """
+        record = self.index[position]
+        rows = slice(record['start'], record['start'] + record['count'])
+        columns = self._columns(int(record['segment']))
+        return {name: np.asarray(columns[name][rows], dtype=float)
+                for name in COLUMNS}
+
+    def profiles(self, positions, columns=('pressure', 'temperature',
+                                           'dewpoint')):
+        """ Columns of many soundings as (n_soundings, max_levels) float
+        arrays, NaN after the last level of each sounding
+        """
+        records = self.index[np.atleast_1d(positions)]
+        count = records['count'].astype(np.int64)
+        width = count.max() if len(count) else 0
+        level = np.arange(width)
+        valid = level[None, :] < count[:, None]
+        rows = np.where(valid, records['start'][:, None] + level[None, :], 0)
+        out = [np.full(rows.shape, np.nan) for _ in columns]
+        for segment in np.unique(records['segment']):
+            mine = records['segment'] == segment
+            stored = self._columns(int(segment))
+            for name, values in zip(columns, out):
+                values[mine] = np.where(valid[mine],
+                                        stored[name][rows[mine]], np.nan)
+        return out
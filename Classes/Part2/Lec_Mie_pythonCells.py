@@ -115,6 +115,15 @@ ax.set_xlabel('Diameter (nm)', fontsize=14)
 ax.set_ylabel('Single Scattering Albedo', fontsize=14)
 ax.legend()
 
+# %% [markdown]
+# For very large scans (10^5 or more diameters) the python loop gets slow. The `mie_batch.py` file in this folder does the same `AutoMieQ` calculation for whole arrays of diameters, wavelengths and refractive indices at once. The output is a structured array with the same names as the `asDict=True` dictionary.
+
+# %%
+import mie_batch
+
+q_batch = mie_batch.batch_auto_mie_q(m, wavelength, diameter)
+print('max difference in Qext to the loop: ', np.max(np.abs(q_batch['Qext'] - Qext)))
+
 # %% [markdown]
 # Writing *for* loops is good for clarity, but we can let PyMieScatt do the work for us. Using `MieQ_withDiameterRange(m, wavelength, nMedium=1.0, diameterRange=(10,1000), nd=1000, logD=False)`
 #  https://pymiescatt.readthedocs.io/en/latest/forward.html#MieQ_withDiameterRange
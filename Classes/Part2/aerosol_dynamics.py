@@ -0,0 +1,367 @@
+""" Sectional condensation and coagulation dynamics for large bin counts.
+
+Lec_condensation_nucleation integrates particula's `Rates` with odeint: the
+coagulation gain and loss integrals are rebuilt from the full kernel matrix
+on every right hand side call, and the result holds every output time. Here
+the particle number per bin on a geometric radius grid is advanced with:
+
+- a coagulation kernel built once per (bin grid, environment) and cached,
+  stored as the exact near diagonal band plus a low rank factorization
+  K ~ U V^T of the whole matrix,
+- fixed pivot sectional coagulation (Kumar and Ramkrishna, 1996): the
+  particles formed by a pair are split over the two bins around their
+  volume so number and volume are conserved. On a geometric grid the split
+  of a pair only depends on the bin offset, so pairs far apart in size are
+  summed with cumulative sums of the low rank factors, O(n r) per step
+  instead of O(n^2),
+- upwind finite volume condensation, taken implicitly (a tridiagonal solve)
+  so growth across many bins per step stays stable and positive,
+- adaptive steps from step doubling, and a generator that yields the
+  distribution only at the requested output times.
+
+The kernel is particula's hard sphere Brownian kernel (neutral particles).
+The condensation growth speed follows particula's vapor flux, but converts
+mass flux to dr/dt with 4 pi r^2 rho; particula's particle_growth uses
+2 / (pi r^2 rho), which is 8 times faster.
+
+Example:
+    radius = np.logspace(-9, -5.5, 1000)  # m, bin centres
+    dynamics = AerosolDynamics(radius, vapor_concentration=1e-9)
+    number = lognormal_number(radius, 100e-9, 1.4, 1e10)  # per m^3 per bin
+    for time, number in dynamics.simulate(number, [600, 1800, 3600]):
+        plt.semilogx(radius, number / dynamics.log_widths)  # dN/dlogr
+"""
+from collections import OrderedDict
+
+import numpy as np
+from scipy.linalg import solve_banded
+
+import mie_profile
+from gas_properties import (ArrayEnvironment, BOLTZMANN_CONSTANT,
+                            GAS_CONSTANT)
+
+AVOGADRO_NUMBER = 6.02214076e23  # 1/mol
+
+# (grid, environment) -> kernel band and low rank factors
+_KERNEL_CACHE = OrderedDict()
+CACHE_STATS = {'hits': 0, 'misses': 0}
+MAX_CACHE = 8
+
+
+def lognormal_number(radius, geo_mean, geo_std_dev, number_of_particles):
+    """ Number per bin of a lognormal mode on the geometric radius grid
+    """
+    radius = np.asarray(radius, dtype=float)
+    log_width = np.log(radius[1] / radius[0])
+    log_sigma = np.log(geo_std_dev)
+    return (number_of_particles * log_width / (np.sqrt(2 * np.pi) * log_sigma)
+            * np.exp(-np.log(radius / geo_mean)**2 / (2 * log_sigma**2)))
+
+
+def coagulation_kernel(radius, other_radius, temperature, viscosity,
+                       mean_free_path, density=1000):
+    """ Hard sphere Brownian coagulation kernel (m^3/s) of neutral
+    particles, as particula's coagulation(), broadcast over the radii (m)
+    """
+    def friction(r):
+        knudsen = mean_free_path / r
+        slip = 1 + knudsen * (1.257 + 0.4 * np.exp(-1.1 / knudsen))
+        return 6 * np.pi * viscosity * r / slip
+
+    f1, f2 = friction(radius), friction(other_radius)
+    m1 = 4 / 3 * np.pi * radius**3 * density
+    m2 = 4 / 3 * np.pi * other_radius**3 * density
+    reduced_friction = f1 * f2 / (f1 + f2)
+    reduced_mass = m1 * m2 / (m1 + m2)
+    radius_sum = radius + other_radius
+    # diffusive Knudsen number and the dimensionless kernel of
+    # particula.util.approx_coagulation (hard sphere)
+    kd = (np.sqrt(temperature * BOLTZMANN_CONSTANT * reduced_mass)
+          / reduced_friction / radius_sum)
+    h = ((4 * np.pi * kd**2 + 25.836 * kd**3
+          + np.sqrt(8 * np.pi) * 11.211 * kd**4)
+         / (1 + 3.502 * kd + 7.211 * kd**2 + 11.211 * kd**3))
+    return h * reduced_friction * radius_sum**3 / reduced_mass
+
+
+def _low_rank(kernel, tolerance, rank=16):
+    """ Symmetric factors U, V (n, r) with |U V^T - K| <= tolerance * K
+    for every element, the rank doubled until it is
+    """
+    n = len(kernel)
+    generator = np.random.default_rng(0)
+    while True:
+        rank = min(rank, n)
+        basis = np.linalg.qr(kernel @ generator.standard_normal((n, rank)))[0]
+        # one power iteration sharpens the basis for the decaying spectrum
+        basis = np.linalg.qr(kernel @ basis)[0]
+        values, vectors = np.linalg.eigh(basis.T @ kernel @ basis)
+        vectors = basis @ vectors
+        error = np.max(np.abs((vectors * values) @ vectors.T - kernel)
+                       / kernel)
+        if error <= tolerance or rank == n:
+            return vectors * values, vectors
+        rank *= 2
+
+
+def _split(ratio, offset):
+    """ Fixed pivot target shift s and share a of the lower target bin for
+    the pair (i, i - offset) on a grid of volume ratio between bins
+    """
+    total = 1 + ratio**-offset.astype(float)  # (v_i + v_j) / v_i
+    shift = np.floor(np.log(total) / np.log(ratio) + 1e-12).astype(int)
+    lower = ratio**shift
+    share = (lower * ratio - total) / (lower * ratio - lower)
+    return shift, np.clip(share, 0, 1)
+
+
+@mie_profile.staged('coagulation kernel build')
+def _kernel_model(radius, environment, density, tolerance):
+    """ Cached coagulation model of a grid: band, its fixed pivot split
+    and the low rank factors
+    """
+    key = (radius.tobytes(), float(environment.temperature),
+           float(environment.dynamic_viscosity()),
+           float(environment.mean_free_path()), float(density),
+           float(tolerance))
+    cached = _KERNEL_CACHE.get(key)
+    if cached is not None:
+        CACHE_STATS['hits'] += 1
+        _KERNEL_CACHE.move_to_end(key)
+        return cached
+    CACHE_STATS['misses'] += 1
+
+    n = radius.size
+    ratio = (radius[1] / radius[0])**3
+    kernel = coagulation_kernel(
+        radius[:, None], radius[None, :], environment.temperature,
+        environment.dynamic_viscosity(), environment.mean_free_path(),
+        density)
+    # offsets up to band_width land above bin i (s >= 1), all further
+    # ones split between bins i and i + 1 with share 1 - v_j/(v_i (q - 1))
+    band_width = min(n - 1, max(0, int(np.floor(
+        -np.log(ratio - 1) / np.log(ratio))) if ratio < 2 else 0))
+    offset = np.arange(band_width + 1)
+    shift, share = _split(ratio, offset)
+    rows = np.arange(n)
+    band = np.where(rows[None, :] >= offset[:, None],
+                    kernel[rows[None, :], np.maximum(
+                        rows[None, :] - offset[:, None], 0)], 0)
+    band[0] *= 0.5  # a pair of equal bins is counted once
+    # offsets are grouped by target shift; the weights sum the lower and
+    # upper bin shares of each group in one product
+    group_shift, group = np.unique(shift, return_inverse=True)
+    weights = np.zeros((2, group_shift.size, band_width + 1))
+    weights[0, group, offset] = share
+    weights[1, group, offset] = 1 - share
+    u, v = _low_rank(kernel, tolerance)
+    model = dict(ratio=ratio, band=band,
+                 group_weights=weights.reshape(-1, band_width + 1),
+                 group_shift=group_shift,
+                 u=u, v=v, far_offset=band_width + 1)
+    _KERNEL_CACHE[key] = model
+    while len(_KERNEL_CACHE) > MAX_CACHE:
+        _KERNEL_CACHE.popitem(last=False)
+    return model
+
+
+def clear_cache():
+    """ Drop the cached kernel models
+    """
+    _KERNEL_CACHE.clear()
+
+
+class AerosolDynamics:
+    """ Condensation, coagulation, nucleation and first order losses of the
+    particle number per bin (1/m^3) on the geometric grid of bin centre
+    radius (m).
+
+    environment is a scalar gas_properties.ArrayEnvironment (default air at
+    298.15 K, 1 atm). Vapor properties follow particula's Vapor defaults in
+    SI units: concentration and saturation_concentration in kg/m^3,
+    molecular weight in kg/mol. particle_formation_rate (1/m^3/s) enters
+    the smallest bin. loss_rate (1/s, scalar or per bin) covers dilution
+    and wall loss. The kernel factors are accurate to kernel_tolerance
+    (relative, per element).
+
+    Particles are kept on the grid: condensation has no flux through the
+    ends, and coagulation beyond the largest bin is added to it (number
+    conserved, volume lost), so the grid should reach past the largest
+    particles of interest.
+    """
+
+    def __init__(self, radius, environment=None, particle_density=1000,
+                 vapor_concentration=0.025e-9, saturation_concentration=0,
+                 vapor_molecular_weight=0.2, vapor_radius=1.6e-9,
+                 vapor_density=1400, vapor_attachment=1,
+                 particle_formation_rate=0, loss_rate=0, coagulation=True,
+                 kernel_tolerance=1e-6):
+        self.radius = np.asarray(radius, dtype=float)
+        ratios = self.radius[1:] / self.radius[:-1]
+        if self.radius.ndim != 1 or self.radius.size < 2 or not np.allclose(
+                ratios, ratios[0], rtol=1e-9, atol=0) or ratios[0] <= 1:
+            raise ValueError('radius must be an increasing geometric grid')
+        self.environment = (ArrayEnvironment() if environment is None
+                            else environment)
+        if self.environment.mean_free_path().size != 1:
+            raise ValueError('environment must be a single gas state')
+        self.particle_density = particle_density
+        self.volume = 4 / 3 * np.pi * self.radius**3
+        self.log_widths = np.full(self.radius.size, np.log10(ratios[0]))
+        edges = np.sqrt(ratios[0])
+        self.widths = self.radius * (edges - 1 / edges)
+        self.particle_formation_rate = particle_formation_rate
+        self.loss_rate = np.broadcast_to(
+            np.asarray(loss_rate, dtype=float), self.radius.shape)
+        self.coagulation = coagulation
+        self.kernel_tolerance = kernel_tolerance
+        self._model = (_kernel_model(self.radius, self.environment,
+                                     particle_density, kernel_tolerance)
+                       if coagulation else None)
+
+        # the growth speed depends only on radius, so the upwind transfer
+        # rates (1/s) out of each bin through its upper (up) and lower
+        # (down) edge are fixed for the run
+        speed = self.growth_speed(
+            self.radius[:-1] * edges, vapor_concentration,
+            saturation_concentration, vapor_molecular_weight, vapor_radius,
+            vapor_density, vapor_attachment)
+        self._up = np.append(np.maximum(speed, 0) / self.widths[:-1], 0)
+        self._down = np.insert(np.maximum(-speed, 0) / self.widths[1:], 0, 0)
+        self.rhs_calls = 0
+
+    @mie_profile.staged('condensation rates')
+    def growth_speed(self, radius, vapor_concentration,
+                     saturation_concentration=0, vapor_molecular_weight=0.2,
+                     vapor_radius=1.6e-9, vapor_density=1400,
+                     vapor_attachment=1):
+        """ Condensation growth dr/dt (m/s) at radius (m), particula's vapor
+        flux over 4 pi r^2 vapor_density
+        """
+        temperature = self.environment.temperature
+        particle_mass = 4 / 3 * np.pi * radius**3 * self.particle_density
+        reduced_weight = (vapor_molecular_weight * particle_mass
+                          * AVOGADRO_NUMBER
+                          / (vapor_molecular_weight
+                             + particle_mass * AVOGADRO_NUMBER))
+        speed = np.sqrt(8 * GAS_CONSTANT * temperature
+                        / (np.pi * reduced_weight)) / 4
+        enhancement = ((vapor_radius + radius) / radius)**2
+        knudsen = self.environment.mean_free_path() / radius
+        alpha = vapor_attachment
+        fuchs_sutugin = (knudsen * alpha * (1 + knudsen)
+                         / (knudsen**2 + knudsen + 0.283 * knudsen * alpha
+                            + 0.75 * alpha))
+        # mass flux / (4 pi r^2 rho), the area cancels
+        return (enhancement * alpha * speed * fuchs_sutugin
+                * (vapor_concentration - saturation_concentration)
+                / vapor_density)
+
+    @mie_profile.staged('coagulation rates')
+    def coagulation_rates(self, number):
+        """ Coagulation gain (1/m^3/s) of each bin and loss coefficient
+        (1/s), the loss rate being loss coefficient * number
+        """
+        model = self._model
+        n = number.size
+        self.rhs_calls += 1
+        u, v = model['u'], model['v']
+        loss = u @ (v.T @ number)
+
+        band = model['band']
+        offset = len(band) - 1
+        padded = np.concatenate((np.zeros(offset), number))
+        partners = np.lib.stride_tricks.sliding_window_view(
+            padded, n)[::-1]  # row d is number[i - d]
+        pairs = band * partners
+        pairs *= number
+        # per target group, the shares to the lower and the upper bin
+        lower_sum, upper_sum = np.split(model['group_weights'] @ pairs, 2)
+        gain = np.zeros(n + model['group_shift'][-1] + 2)
+        for shift, low, high in zip(model['group_shift'], lower_sum,
+                                    upper_sum):
+            gain[shift:shift + n] += low
+            gain[shift + 1:shift + 1 + n] += high
+
+        # pairs further apart split over bins i and i + 1, summed over the
+        # partners j <= i - far with cumulative sums of the factors
+        far = model['far_offset']
+        if far < n:
+            moments = np.stack((number, number * self.volume), -1)
+            partial = np.cumsum(
+                v[:n - far, :, None] * moments[:n - far, None], 0)
+            sums = np.einsum('ir,irk->ik', u[far:], partial)
+            to_upper = number[far:] * sums[:, 1] / (
+                self.volume[far:] * (model['ratio'] - 1))
+            gain[far:n] += number[far:] * sums[:, 0] - to_upper
+            gain[far + 1:n + 1] += to_upper
+        gain[n - 1] += gain[n:].sum()
+        return gain[:n], loss
+
+    @mie_profile.staged('time step')
+    def _step(self, number, dt):
+        """ One linearly implicit Euler step: condensation, coagulation
+        loss and first order losses implicit, coagulation gain explicit
+        """
+        diagonal = 1 + dt * (self._up + self._down + self.loss_rate)
+        source = number.copy()
+        source[0] += dt * self.particle_formation_rate
+        if self.coagulation:
+            gain, loss = self.coagulation_rates(number)
+            diagonal += dt * loss
+            source += dt * gain
+        matrix = np.zeros((3, number.size))
+        matrix[0, 1:] = -dt * self._down[1:]
+        matrix[1] = diagonal
+        matrix[2, :-1] = -dt * self._up[:-1]
+        return solve_banded((1, 1), matrix, source, overwrite_ab=True,
+                            overwrite_b=True, check_finite=False)
+
+    def simulate(self, number, output_times, start_time=0, rtol=1e-3,
+                 atol=None, first_step=1.0, max_step=np.inf):
+        """ Yield (time, number) at each of output_times (s), from number at
+        start_time.
+
+        Each step is compared with two half steps; the step is accepted
+        when the RMS difference, weighted by atol + rtol * |number|, is
+        below 1, and the Richardson extrapolation of the two (second
+        order, clipped at 0) is kept. atol defaults to 1e-3 * rtol * the
+        largest initial bin, or the particles formed in first_step, or
+        1 per m^3, whichever is largest (so a run from no particles has a
+        scale). A step whose error is not finite is rejected; RuntimeError
+        when the step no longer advances the time. Only the current
+        distribution is held.
+        """
+        number = np.asarray(number, dtype=float).copy()
+        if atol is None:
+            atol = 1e-3 * rtol * max(
+                number.max(), self.particle_formation_rate * first_step, 1)
+        time = start_time
+        dt = first_step
+        for output_time in np.sort(np.atleast_1d(output_times)):
+            while time < output_time:
+                dt = min(dt, max_step)
+                step = min(dt, output_time - time)
+                coarse = self._step(number, step)
+                fine = self._step(self._step(number, step / 2), step / 2)
+                error = np.sqrt(np.mean(
+                    ((fine - coarse) / (atol + rtol * np.abs(fine)))**2))
+                if not np.isfinite(error):
+                    error = np.inf
+                # local error of the Euler pair is O(dt^2)
+                new_dt = step * min(5, max(0.2, 0.9 / np.sqrt(max(error,
+                                                                  1e-10))))
+                if error <= 1:
+                    mie_profile.count('accepted_steps')
+                    clipped = step < dt
+                    time = output_time if clipped else time + step
+                    number = np.maximum(2 * fine - coarse, 0)
+                    # a step shortened to hit an output does not shrink dt
+                    dt = max(dt, new_dt) if clipped else new_dt
+                else:
+                    mie_profile.count('rejected_steps')
+                    dt = new_dt
+                    if time + dt <= time:
+                        raise RuntimeError(
+                            'step size underflow at t = {} s'.format(time))
+            yield output_time, number.copy()
@@ -0,0 +1,298 @@
+""" Table of AIOMFAC-web results for many mixtures and temperatures.
+
+activity_and_CCNc reads one species of one AIOMFAC output file with
+pd.read_csv(..., skiprows=101, nrows=50) and the column names typed in,
+so every file needs its own offsets. `read_aiomfac` finds the blocks of an
+output file itself (the viscosity block and one block per component or
+ion, each with its name and column header) and `ActivityTable` ingests
+any number of files, parsed in parallel on a ProcessPoolExecutor, into
+one directory:
+
+    rows.npy    one record per composition point and species (ROW_FIELDS),
+                sorted by mixture, species, temperature and composition
+    meta.json   mixture and species names, and the ingested files
+
+rows.npy is opened memory-mapped and every (mixture, species) is one
+block found by binary search, so queries never touch the text files.
+The composition of a point is the mass fraction of the mixture's first
+component (water in AIOMFAC-web mixtures), the quantity the notebook
+works with. `interpolate` gives any column, e.g. the activity coefficient
+(a_coeff_x or a_coeff_m) or the activity (a_x or a_m), at arrays of
+temperatures and compositions: linear in composition at the tabulated
+temperatures and linear in temperature between them.
+
+Example:
+    table = ActivityTable('aiomfac_table')
+    table.ingest(glob.glob('AIOMFAC_output_*.txt'))
+    mass_fraction_water = np.logspace(-3, 0, 1000)
+    a_water = table.water_activity('Water + (Na+) + (Cl-)', 298.15,
+                                   mass_fraction_water)
+    gamma = table.interpolate('Water + (Na+) + (Cl-)', 'Water', 298.15,
+                              mass_fraction_water, 'activity_coefficient')
+"""
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+ROW_FIELDS = [('mixture', np.int32), ('species', np.int32),
+              ('temperature', float), ('composition', float),
+              ('point', np.int32), ('relative_humidity', float),
+              ('mass_fraction', float), ('mole_fraction', float),
+              ('molality', float), ('activity_coefficient', float),
+              ('activity', float), ('log10_viscosity', float),
+              ('basis', 'U1'), ('flag', np.int16)]
+
+_MIXTURE = re.compile(r"Mixture name:\s*'(.*)'")
+_SPECIES = re.compile(r"^(\w+)'s name\s*:\s*'(.*)'")
+
+
+def _blocks(lines):
+    """ (title line, column names, data lines) of each table of an output
+    file; a table is a 'no.  T_[K] ...' header between dashed lines
+    """
+    for i, line in enumerate(lines):
+        if not (line.lstrip().startswith('no.') and 'T_[K]' in line):
+            continue
+        columns = re.split(r'\s{2,}', line.strip())
+        stop = i + 2
+        while (stop < len(lines) and lines[stop].strip()
+               and not lines[stop].startswith('---')):
+            stop += 1
+        title = ''
+        for previous in lines[max(i - 6, 0):i]:
+            if _SPECIES.match(previous):
+                title = previous
+        yield title, columns, lines[i + 2:stop]
+
+
+def read_aiomfac(path):
+    """ Mixture name, species names and the rows (ROW_FIELDS, mixture and
+    species numbered within the file) of one AIOMFAC-web output file
+    """
+    with open(path, encoding='latin-1') as handle:
+        lines = handle.read().splitlines()
+    match = None
+    for line in lines:
+        match = match or _MIXTURE.search(line)
+    if match is None:
+        raise ValueError('{} is not an AIOMFAC output file'.format(path))
+
+    species = []
+    parts = []
+    viscosity = {}
+    for title, columns, data in _blocks(lines):
+        values = np.array(' '.join(data).split(), dtype=float)
+        values = values.reshape(len(data), len(columns))
+        # columns without the species number, e.g. a_coeff_x(01) -> a_coeff_x
+        table = {re.sub(r'\(\d+\)$', '', name): column
+                 for name, column in zip(columns, values.T)}
+        if not title:
+            viscosity = dict(zip(table['no.'].astype(int),
+                                 table['log10(eta/[Pa.s])']))
+            continue
+        species.append(_SPECIES.match(title).group(2))
+        basis = 'x' if 'a_x' in table else 'm'
+        rows = np.zeros(len(data), dtype=ROW_FIELDS)
+        rows['species'] = len(species) - 1
+        rows['point'] = table['no.']
+        rows['temperature'] = table['T_[K]']
+        rows['relative_humidity'] = table['RH_[%]']
+        rows['mass_fraction'] = table['w']
+        rows['mole_fraction'] = table['x_i']
+        rows['molality'] = table['m_i']
+        rows['activity_coefficient'] = table['a_coeff_' + basis]
+        rows['activity'] = table['a_' + basis]
+        rows['basis'] = basis
+        rows['flag'] = table['flag']
+        parts.append(rows)
+    if not parts:
+        raise ValueError('no species tables in {}'.format(path))
+
+    rows = np.concatenate(parts)
+    first = dict(zip(parts[0]['point'], parts[0]['mass_fraction']))
+    rows['composition'] = [first.get(point, np.nan) for point in rows['point']]
+    rows['log10_viscosity'] = [viscosity.get(point, np.nan)
+                               for point in rows['point']]
+    return match.group(1), species, rows
+
+
+class ActivityTable:
+    """ AIOMFAC results in directory path (created on the first ingest),
+    memory-mapped on open
+    """
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self._open()
+
+    def _open(self):
+        meta_path = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_path):
+            self.meta = dict(mixtures=[], species=[], files={})
+            self.rows = np.zeros(0, dtype=ROW_FIELDS)
+            return
+        with open(meta_path) as handle:
+            self.meta = json.load(handle)
+        self.rows = np.load(os.path.join(self.path, 'rows.npy'),
+                            mmap_mode='r')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def mixtures(self):
+        return list(self.meta['mixtures'])
+
+    def species(self, mixture):
+        return list(self.meta['species'][self._mixture(mixture)])
+
+    def ingest(self, paths, max_workers=None):
+        """ Parse AIOMFAC output files (in parallel unless max_workers is 1)
+        and add them; files already ingested and unchanged are skipped, and
+        a point of the same mixture, species, temperature and composition
+        replaces the stored one
+        """
+        todo = []
+        for path in np.atleast_1d(paths):
+            path = os.path.abspath(os.fspath(path))
+            status = os.stat(path)
+            if self.meta['files'].get(path) != [status.st_size,
+                                                status.st_mtime_ns]:
+                todo.append((path, [status.st_size, status.st_mtime_ns]))
+        if not todo:
+            return
+        files = [path for path, _ in todo]
+        if max_workers == 1 or len(files) == 1:
+            results = [read_aiomfac(path) for path in files]
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(
+                    read_aiomfac, files,
+                    chunksize=max(len(files) // (4 * (os.cpu_count() or 1)),
+                                  1)))
+
+        parts = [np.asarray(self.rows)]
+        for mixture, species, rows in results:
+            if mixture not in self.meta['mixtures']:
+                self.meta['mixtures'].append(mixture)
+                self.meta['species'].append([])
+            number = self.meta['mixtures'].index(mixture)
+            known = self.meta['species'][number]
+            for name in species:
+                if name not in known:
+                    known.append(name)
+            rows['mixture'] = number
+            rows['species'] = [known.index(species[k])
+                               for k in rows['species']]
+            parts.append(rows)
+        rows = np.concatenate(parts)
+
+        # newest copy of each point, sorted for the block search
+        order = np.lexsort((-np.arange(len(rows)), rows['composition'],
+                            rows['temperature'], rows['species'],
+                            rows['mixture']))
+        rows = rows[order]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = np.any([rows[name][1:] != rows[name][:-1] for name in
+                           ('mixture', 'species', 'temperature',
+                            'composition')], axis=0)
+        for path, status in todo:
+            self.meta['files'][path] = status
+
+        os.makedirs(self.path, exist_ok=True)
+        # the old rows are still mapped, so write new files and swap
+        rows_path = os.path.join(self.path, 'rows.npy')
+        np.save(rows_path + '.tmp.npy', rows[keep])
+        os.replace(rows_path + '.tmp.npy', rows_path)
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as handle:
+            json.dump(self.meta, handle)
+        os.replace(meta_path + '.tmp', meta_path)
+        self._open()
+
+    def _mixture(self, mixture):
+        if isinstance(mixture, str):
+            if mixture not in self.meta['mixtures']:
+                raise KeyError('unknown mixture {!r}'.format(mixture))
+            return self.meta['mixtures'].index(mixture)
+        return int(mixture)
+
+    def select(self, mixture, species):
+        """ Rows of one species of one mixture (names or numbers), sorted
+        by temperature and composition
+        """
+        number = self._mixture(mixture)
+        if isinstance(species, str):
+            names = self.meta['species'][number]
+            if species not in names:
+                raise KeyError('unknown species {!r} of {!r}'.format(
+                    species, self.meta['mixtures'][number]))
+            species = names.index(species)
+        column = self.rows['mixture']
+        low = np.searchsorted(column, number, 'left')
+        high = np.searchsorted(column, number, 'right')
+        column = self.rows['species'][low:high]
+        return np.asarray(self.rows[low + np.searchsorted(column, species,
+                                                          'left'):
+                                    low + np.searchsorted(column, species,
+                                                          'right')])
+
+    def interpolate(self, mixture, species, temperature, composition,
+                    field='activity', include_flagged=False):
+        """ field (a ROW_FIELDS column) of species in mixture at
+        temperature (K) and composition (mass fraction of the first
+        component), broadcast over both. Linear in composition at each
+        tabulated temperature, linear in temperature between them; NaN
+        outside the tabulated range. Points AIOMFAC flagged (non-zero
+        flag) are left out unless include_flagged.
+        """
+        rows = self.select(mixture, species)
+        if not include_flagged:
+            rows = rows[rows['flag'] == 0]
+        temperature, composition = np.broadcast_arrays(
+            np.asarray(temperature, dtype=float),
+            np.asarray(composition, dtype=float))
+        out = np.full(temperature.shape, np.nan)
+        if not len(rows):
+            return out
+        tabulated, first = np.unique(rows['temperature'], return_index=True)
+        bounds = np.append(first, len(rows))
+
+        def at_temperature(j, points):
+            block = rows[bounds[j]:bounds[j + 1]]
+            return np.interp(composition.flat[points], block['composition'],
+                             block[field], left=np.nan, right=np.nan)
+
+        # fractional position among the tabulated temperatures
+        close = 1e-6 * tabulated[-1]
+        inside = np.flatnonzero((temperature >= tabulated[0] - close)
+                                & (temperature <= tabulated[-1] + close))
+        position = np.interp(temperature.flat[inside], tabulated,
+                             np.arange(len(tabulated)))
+        low = np.minimum(np.floor(position).astype(int), len(tabulated) - 1)
+        fraction = position - low
+        # queries grouped by the temperature interval they fall in
+        order = np.argsort(low, kind='stable')
+        starts = np.searchsorted(low[order], np.arange(len(tabulated) + 1))
+        for j in range(len(tabulated)):
+            group = order[starts[j]:starts[j + 1]]
+            if not len(group):
+                continue
+            points, f = inside[group], fraction[group]
+            value = (1 - f) * at_temperature(j, points)
+            upper = f > 0
+            if upper.any():
+                value[upper] += f[upper] * at_temperature(j + 1,
+                                                          points[upper])
+            out.flat[points] = value
+        return out
+
+    def water_activity(self, mixture, temperature, mass_fraction_water,
+                       species='Water'):
+        """ Water activity (a_x of Water) at temperature and water mass
+        fraction, as read from the output file in activity_and_CCNc
+        """
+        return self.interpolate(mixture, species, temperature,
+                                mass_fraction_water, 'activity')
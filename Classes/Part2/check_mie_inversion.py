@@ -0,0 +1,59 @@
+""" Checks of IndexInversion on synthetic scans.
+
+The scans are the forward model of a known index, so every check expects
+that index back: with the default sigma, with a scalar and a per
+wavelength sigma passed to invert, and over a series whose blocks
+include a scan without usable channels (the next block warm-starts from
+the last solved scan).
+
+From the Part2 folder:
+    python check_mie_inversion.py
+"""
+import numpy as np
+
+from mie_inversion import IndexInversion
+
+WAVELENGTH = [450, 550, 700]
+TRUTH = 1.55 + 0.02j
+
+
+def _scans(n_scans=5):
+    dp = np.logspace(np.log10(50), np.log10(800), 30)
+    inversion = IndexInversion(WAVELENGTH, dp)
+    ndp = np.tile(1e3 * np.exp(-np.log(dp / 150)**2), (n_scans, 1))
+    Bsca, Babs = inversion.forward(np.full(n_scans, TRUTH), ndp)
+    return inversion, Bsca, Babs, ndp
+
+
+def _recovered(result, rows=slice(None)):
+    return bool(np.allclose(result['n'][rows], TRUTH.real, atol=1e-3)
+                and np.allclose(result['k'][rows], TRUTH.imag, rtol=1e-2))
+
+
+def check_inversion():
+    """ List of dictionaries with the check name and passed
+    """
+    inversion, Bsca, Babs, ndp = _scans()
+    sigmas = {'default sigma': None,
+              'scalar sigma': (0.5, 0.05),
+              'per wavelength sigma': (0.01 * Bsca[0], 0.01 * Babs[0])}
+    results = [dict(check=name, passed=_recovered(
+        inversion.invert(Bsca, Babs, ndp, sigma=sigma)))
+        for name, sigma in sigmas.items()]
+
+    Bsca[2], Babs[2] = np.nan, np.nan
+    series = inversion.invert_series(Bsca, Babs, ndp, block_size=3,
+                                     sigma=sigmas['per wavelength sigma'])
+    results.append(dict(
+        check='series with an unsolvable scan',
+        passed=_recovered(series, [0, 1, 3, 4])
+        and bool(np.isnan(series['n'][2]))))
+    return results
+
+
+if __name__ == '__main__':
+    results = check_inversion()
+    for result in results:
+        print('{:32} {}'.format(result['check'],
+                                'ok' if result['passed'] else 'FAIL'))
+    raise SystemExit(0 if all(r['passed'] for r in results) else 1)
@@ -0,0 +1,208 @@
+""" Array version of the particula Environment gas properties.
+
+Lec_gas-phase_and_size_dist sets `Environment.temperature` one value at a
+time and converts every result with pint, which costs far more than the
+physics. `ArrayEnvironment` takes numpy arrays of temperature, pressure and
+molecular weight (or pint quantities, converted once when set) and returns
+dynamic viscosity, mean free path, Knudsen number, slip correction and
+particle diffusion coefficient as plain float arrays in SI units, with the
+same formulas as particula. Viscosity and mean free path are kept by the
+environment until its state is set again, and small states (up to
+MAX_SHARED_SIZE values, e.g. the scalar states of AerosolDynamics) are also
+memoized across environments, so repeated states are not recomputed. Large
+states, e.g. a column model whose temperature changes every step, are only
+kept by their own environment, so memory stays at one state.
+
+Example:
+    environment = ArrayEnvironment(
+        temperature=np.arange(100, 500, 10)[:, None],
+        pressure=np.array([0.4, 1, 1.5]) * 101325)
+    environment.mean_free_path() * 1e9  # nm, shape (40, 3)
+    environment.diffusion_coefficient(radius=100e-9)
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+BOLTZMANN_CONSTANT = 1.380649e-23  # J/K
+GAS_CONSTANT = 8.314462618  # J/(mol K)
+MOLECULAR_WEIGHT_AIR = 0.0289644  # kg/mol
+
+# Sutherland's law for air, as particula.constants
+REF_VISCOSITY_AIR_STP = 1.716e-5  # Pa s
+REF_TEMPERATURE_STP = 273.15  # K
+SUTHERLAND_CONSTANT = 110.4  # K
+
+# (state) -> (dynamic viscosity, mean free path), shared by all instances,
+# for states of at most MAX_SHARED_SIZE values and MAX_CACHE_BYTES in all
+_STATE_CACHE = OrderedDict()
+CACHE_STATS = {'hits': 0, 'misses': 0}
+MAX_CACHE = 64
+MAX_SHARED_SIZE = 4096
+MAX_CACHE_BYTES = 2**25
+
+
+def _state_array(value, unit):
+    """ Read-only copy of value in unit, so a state cannot change without
+    going through its setter
+    """
+    value = np.array(_magnitude(value, unit))
+    value.flags.writeable = False
+    return value
+
+
+def _magnitude(value, unit):
+    """ Float array of value in unit; pint quantities are converted,
+    anything else is taken to be in unit already
+    """
+    if hasattr(value, 'to'):
+        value = value.to(unit).magnitude
+    return np.asarray(value, dtype=float)
+
+
+def dynamic_viscosity(temperature,
+                      reference_viscosity=REF_VISCOSITY_AIR_STP,
+                      reference_temperature=REF_TEMPERATURE_STP,
+                      sutherland_constant=SUTHERLAND_CONSTANT):
+    """ Sutherland dynamic viscosity (Pa s) of temperature (K)
+    """
+    return (reference_viscosity
+            * (temperature / reference_temperature)**1.5
+            * (reference_temperature + sutherland_constant)
+            / (temperature + sutherland_constant))
+
+
+def mean_free_path(temperature, pressure, molecular_weight, viscosity,
+                   gas_constant=GAS_CONSTANT):
+    """ Gas mean free path (m), broadcast over all inputs
+    """
+    return (2 * viscosity / pressure) / np.sqrt(
+        8 * molecular_weight / (np.pi * gas_constant * temperature))
+
+
+def clear_cache():
+    """ Drop the memoized gas states
+    """
+    _STATE_CACHE.clear()
+
+
+class ArrayEnvironment:
+    """ Gas state of any shape, broadcast from temperature (K), pressure
+    (Pa) and molecular_weight (kg/mol). Particle properties take a radius
+    (m) that broadcasts against the state shape.
+
+    The state arrays are read-only copies; assign new values (e.g.
+    environment.temperature = temperature + 1) to change them.
+    """
+
+    def __init__(self, temperature=298.15, pressure=101325,
+                 molecular_weight=MOLECULAR_WEIGHT_AIR,
+                 reference_viscosity=REF_VISCOSITY_AIR_STP,
+                 reference_temperature=REF_TEMPERATURE_STP,
+                 sutherland_constant=SUTHERLAND_CONSTANT,
+                 gas_constant=GAS_CONSTANT):
+        self.temperature = temperature
+        self.pressure = pressure
+        self.molecular_weight = molecular_weight
+        self.reference_viscosity = _magnitude(reference_viscosity, 'Pa*s')
+        self.reference_temperature = _magnitude(reference_temperature, 'K')
+        self.sutherland_constant = _magnitude(sutherland_constant, 'K')
+        self.gas_constant = _magnitude(gas_constant, 'J/mol/K')
+
+    # unit checks happen once here, when a state is set
+    @property
+    def temperature(self):
+        return self._temperature
+
+    @temperature.setter
+    def temperature(self, value):
+        self._temperature = _state_array(value, 'K')
+        self._memo = None
+
+    @property
+    def pressure(self):
+        return self._pressure
+
+    @pressure.setter
+    def pressure(self, value):
+        self._pressure = _state_array(value, 'Pa')
+        self._memo = None
+
+    @property
+    def molecular_weight(self):
+        return self._molecular_weight
+
+    @molecular_weight.setter
+    def molecular_weight(self, value):
+        self._molecular_weight = _state_array(value, 'kg/mol')
+        self._memo = None
+
+    def _state(self):
+        """ Memoized (dynamic viscosity, mean free path) of the state
+        """
+        constants = (float(self.reference_viscosity),
+                     float(self.reference_temperature),
+                     float(self.sutherland_constant),
+                     float(self.gas_constant))
+        # the setters clear the memo, so only the constants are compared
+        if self._memo is not None and self._memo[0] == constants:
+            CACHE_STATS['hits'] += 1
+            return self._memo[1]
+        arrays = (self._temperature, self._pressure, self._molecular_weight)
+        key = None
+        if max(value.size for value in arrays) <= MAX_SHARED_SIZE:
+            key = constants + tuple((value.shape, value.tobytes())
+                                    for value in arrays)
+            cached = _STATE_CACHE.get(key)
+            if cached is not None:
+                CACHE_STATS['hits'] += 1
+                _STATE_CACHE.move_to_end(key)
+                self._memo = (constants, cached)
+                return cached
+        CACHE_STATS['misses'] += 1
+        viscosity = dynamic_viscosity(
+            self._temperature, *constants[:3])
+        path = mean_free_path(self._temperature, self._pressure,
+                              self._molecular_weight, viscosity,
+                              constants[3])
+        # broadcast so both have the full state shape
+        viscosity, path = np.broadcast_arrays(viscosity, path)
+        viscosity.flags.writeable = False
+        path.flags.writeable = False
+        self._memo = (constants, (viscosity, path))
+        if key is not None:
+            _STATE_CACHE[key] = (viscosity, path)
+            while len(_STATE_CACHE) > MAX_CACHE or sum(
+                    v.nbytes + p.nbytes
+                    for v, p in _STATE_CACHE.values()) > MAX_CACHE_BYTES:
+                _STATE_CACHE.popitem(last=False)
+        return viscosity, path
+
+    def dynamic_viscosity(self):
+        """ Dynamic viscosity in Pa s
+        """
+        return self._state()[0]
+
+    def mean_free_path(self):
+        """ Mean free path in m
+        """
+        return self._state()[1]
+
+    def knudsen_number(self, radius):
+        """ Knudsen number mean free path / radius
+        """
+        return self.mean_free_path() / _magnitude(radius, 'm')
+
+    def slip_correction(self, radius):
+        """ Cunningham slip correction factor
+        """
+        knudsen = self.knudsen_number(radius)
+        return 1 + knudsen * (1.257 + 0.4 * np.exp(-1.1 / knudsen))
+
+    def diffusion_coefficient(self, radius):
+        """ Particle diffusion coefficient k T Cc / (6 pi mu r) in m^2/s
+        """
+        radius = _magnitude(radius, 'm')
+        mobility = self.slip_correction(radius) / (
+            6 * np.pi * self.dynamic_viscosity() * radius)
+        return BOLTZMANN_CONSTANT * self._temperature * mobility
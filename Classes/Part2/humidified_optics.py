@@ -0,0 +1,266 @@
+""" Optics of humidified aerosol: kappa growth, volume mixed index and Mie.
+
+activity_and_CCNc grows particles with kappa (kappa_a_water_activity,
+radius_sphere) and Lec_Mie computes optics of dry distributions (Mie_SD,
+Mie_Lognormal); `HumidifiedOptics` puts them together. For a dry
+distribution on fixed bins with a kappa per bin, the optics at relative
+humidity RH are those of the wet particles:
+
+    growth factor GF = D_wet / D_dry from kappa-Kohler at saturation RH,
+    with the Kelvin term (kohler.kohler_saturation) unless temperature is
+    None, where GF^3 = 1 + kappa RH / (1 - RH),
+    volume mixed index  m = m_water + (m_dry - m_water) / GF^3.
+
+Nothing is recomputed per time step. Two caches stand between RH and Mie:
+
+- `WetMieTable`: Qext, Qsca and Qback on a grid of wet diameter (log) by
+  dry volume fraction 1 / GF^3, which fixes the mixed index. Built with
+  mie_batch once per dry index, water index and wavelengths and kept in a
+  module cache (CACHE_STATS, clear_cache).
+- per-bin cross sections at a set of RH nodes (uniform in -ln(1 - RH), as
+  growth is), read from the table.
+
+An RH series is then interpolated between nodes and summed over the bins
+with one matrix product per node interval. The dry optics are the RH = 0
+node, so f(RH) = B(RH) / B(dry) is exactly 1 for dry air.
+
+Example:
+    dp = np.logspace(1, 3, 100)  # nm
+    ndp = mie_kernel.lognormal_ndp(dp, 150, 1.6, 1000)[0]
+    humidified = HumidifiedOptics(dp, kappa=0.6, wavelength=[450, 550, 700],
+                                  m_dry=1.54+0.01j)
+    rh = np.clip(np.random.normal(0.6, 0.2, 525600), 0, 0.95)  # a year
+    optics = humidified.optics(rh, ndp)
+    optics['f_sca']  # (525600, 3) scattering enhancement
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+import kohler
+import mie_batch
+import mie_kernel
+import mie_profile
+
+WATER_INDEX = 1.333 + 0j
+TABLE_FIELDS = ('Qext', 'Qsca', 'Qback')
+
+_TABLE_CACHE = OrderedDict()
+CACHE_STATS = {'hits': 0, 'misses': 0}
+MAX_CACHE = 8
+
+
+class WetMieTable:
+    """ Mie efficiencies of volume mixed dry material and water on a
+    log10(diameter) x dry volume fraction grid, per wavelength, with
+    bilinear interpolation. max_error holds the largest absolute error of
+    each field found at the cell centres when it was built; it is set by
+    the sharpest resonances (Qback of large weakly absorbing particles),
+    which mostly average out over a size distribution.
+    """
+
+    @mie_profile.staged('wet table build')
+    def __init__(self, m_dry, wavelength, diameter_range, min_fraction,
+                 m_water=WATER_INDEX, n_medium=1.0, n_size=400,
+                 n_fraction=48):
+        self.m_dry = complex(m_dry)
+        self.m_water = complex(m_water)
+        self.wavelength = np.atleast_1d(np.asarray(wavelength, dtype=float))
+        self.n_medium = n_medium
+        self.log_d = np.linspace(np.log10(diameter_range[0]),
+                                 np.log10(diameter_range[1]), n_size)
+        self.fraction = np.linspace(min_fraction, 1, n_fraction)
+        self.table = self._exact(self.log_d[:, None], self.fraction[None, :])
+
+        centre_d = 0.5 * (self.log_d[1:] + self.log_d[:-1])
+        centre_f = 0.5 * (self.fraction[1:] + self.fraction[:-1])
+        cd, cf = np.meshgrid(centre_d, centre_f, indexing='ij')
+        error = np.abs(self._exact(cd, cf) - self.interpolate(10**cd, cf))
+        self.max_error = dict(zip(TABLE_FIELDS,
+                                  error.max(axis=(0, 1, 2)).tolist()))
+
+    def _exact(self, log_d, fraction):
+        """ TABLE_FIELDS of (..., n_wavelength, fields)
+        """
+        m = self.m_water + (self.m_dry - self.m_water) * fraction
+        q = mie_batch.batch_auto_mie_q(
+            m[..., None], self.wavelength, 10**log_d[..., None],
+            n_medium=self.n_medium)
+        return np.stack([q[name] for name in TABLE_FIELDS], axis=-1)
+
+    def _position(self, value, axis):
+        """ Cell index and fraction inside the cell on a uniform axis
+        """
+        position = (value - axis[0]) / (axis[1] - axis[0])
+        index = np.clip(np.floor(position).astype(int), 0, axis.size - 2)
+        return index, position - index
+
+    def interpolate(self, diameter, fraction):
+        """ TABLE_FIELDS at wet diameter (nm) and dry volume fraction,
+        broadcast together, as (..., n_wavelength, fields)
+        """
+        i, fi = self._position(np.log10(diameter), self.log_d)
+        j, fj = self._position(np.asarray(fraction, dtype=float),
+                               self.fraction)
+        i, fi, j, fj = np.broadcast_arrays(i, fi, j, fj)
+        fi, fj = fi[..., None, None], fj[..., None, None]
+        return ((1 - fi) * ((1 - fj) * self.table[i, j]
+                            + fj * self.table[i, j + 1])
+                + fi * ((1 - fj) * self.table[i + 1, j]
+                        + fj * self.table[i + 1, j + 1]))
+
+
+def wet_mie_table(m_dry, wavelength, diameter_range, min_fraction,
+                  m_water=WATER_INDEX, n_medium=1.0, n_size=400,
+                  n_fraction=48):
+    """ Cached WetMieTable
+    """
+    key = (complex(m_dry), complex(m_water),
+           np.atleast_1d(np.asarray(wavelength, dtype=float)).tobytes(),
+           tuple(float(value) for value in diameter_range),
+           float(min_fraction), float(n_medium), n_size, n_fraction)
+    cached = _TABLE_CACHE.get(key)
+    if cached is not None:
+        CACHE_STATS['hits'] += 1
+        _TABLE_CACHE.move_to_end(key)
+        return cached
+    CACHE_STATS['misses'] += 1
+    table = WetMieTable(m_dry, wavelength, diameter_range, min_fraction,
+                        m_water, n_medium, n_size, n_fraction)
+    _TABLE_CACHE[key] = table
+    while len(_TABLE_CACHE) > MAX_CACHE:
+        _TABLE_CACHE.popitem(last=False)
+    return table
+
+
+def clear_cache():
+    """ Drop the cached Mie tables
+    """
+    _TABLE_CACHE.clear()
+
+
+@mie_profile.staged('growth factor')
+def growth_factor(dp, kappa, rh, temperature=298.15, iterations=60):
+    """ Wet to dry diameter ratio of particles of dry diameter dp (nm) and
+    hygroscopicity kappa at relative humidity rh (0-1, below 1), broadcast
+    over all inputs. With a temperature, the root of kappa-Kohler
+    saturation = rh below the critical diameter, by bisection; without,
+    the flat surface value (1 + kappa rh / (1 - rh))^(1/3).
+    """
+    dp, kappa, rh = np.broadcast_arrays(np.asarray(dp, dtype=float),
+                                        np.asarray(kappa, dtype=float),
+                                        np.asarray(rh, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        flat = np.cbrt(1 + kappa * rh / (1 - rh))
+    if temperature is None:
+        return flat
+    # the Kelvin term only lowers the growth, so the root is in [1, flat]
+    dry_radius = dp * 0.5e-9
+    low, high = np.ones(dp.shape), flat.copy()
+    for _ in range(iterations):
+        middle = 0.5 * (low + high)
+        below = kohler.kohler_saturation(middle * dry_radius, dry_radius,
+                                         kappa, temperature) < rh
+        low = np.where(below, middle, low)
+        high = np.where(below, high, middle)
+    return np.where(rh > 0, 0.5 * (low + high), 1.0)
+
+
+class HumidifiedOptics:
+    """ Bext, Bsca and Bback (1/Mm per particle per cc, as MieKernel) of
+    a distribution on dry bins dp (nm) with kappa per bin (or one for
+    all), at the given wavelengths (nm), as functions of RH.
+
+    SMPS has the meaning of MieKernel. RH nodes run from 0 to max_rh,
+    n_rh of them; RH above max_rh gives NaN. The WetMieTable spans the
+    bins from dry to max_rh; n_size and n_fraction are its resolution.
+    """
+
+    @mie_profile.staged('kernel build')
+    def __init__(self, dp, kappa, wavelength, m_dry, m_water=WATER_INDEX,
+                 n_medium=1.0, SMPS=True, temperature=298.15, max_rh=0.98,
+                 n_rh=256, n_size=400, n_fraction=48):
+        self.dp = np.asarray(dp, dtype=float)
+        self.kappa = np.broadcast_to(np.asarray(kappa, dtype=float),
+                                     self.dp.shape)
+        self.wavelength = np.atleast_1d(np.asarray(wavelength, dtype=float))
+        self.temperature = temperature
+        self.max_rh = max_rh
+
+        # RH nodes uniform in -ln(1 - RH), with dry air the first
+        self.rh_nodes = 1 - np.exp(np.linspace(0, np.log(1 - max_rh), n_rh))
+        self.growth = growth_factor(self.dp[None, :], self.kappa[None, :],
+                                    self.rh_nodes[:, None], temperature)
+        self.table = wet_mie_table(
+            m_dry, self.wavelength,
+            (self.dp.min(), self.dp.max() * self.growth.max()),
+            1 / self.growth.max()**3, m_water, n_medium, n_size, n_fraction)
+
+        # per-bin cross sections at the nodes, (n_rh, fields, wl, bins)
+        wet = self.dp * self.growth
+        q = self.table.interpolate(wet, 1 / self.growth**3)
+        # scaling of 1e-6 to cast in units of inverse megameters
+        area = (np.pi * (wet / 2)**2 * 1e-6
+                * mie_kernel._bin_weights(self.dp, SMPS))
+        self.kernel = np.transpose(q * area[..., None, None], (0, 3, 2, 1))
+
+    @mie_profile.staged('distribution integration')
+    def node_optics(self, ndp):
+        """ Bext, Bsca, Bback at the RH nodes, (n_rh, n_wavelength) each
+        (with a leading n_dist axis for an (n_dist, n_bins) ndp)
+        """
+        ndp = np.asarray(ndp, dtype=float)
+        values = ndp @ self.kernel.reshape(-1, self.dp.size).T
+        values = values.reshape(ndp.shape[:-1] + self.kernel.shape[:3])
+        return {name: values[..., k, :] for k, name in
+                enumerate(('Bext', 'Bsca', 'Bback'))}
+
+    @mie_profile.staged('distribution integration')
+    def optics(self, rh, ndp):
+        """ Bext, Bsca, Bback and the enhancements f_ext and f_sca
+        (B / B at RH = 0) for each RH (0-1), as (n_times, n_wavelength).
+
+        ndp is one distribution (n_bins,) for all times, or one per time
+        (n_times, n_bins).
+        """
+        rh = np.atleast_1d(np.asarray(rh, dtype=float))
+        ndp = np.asarray(ndp, dtype=float)
+        valid = (rh >= 0) & (rh <= self.max_rh)
+        position = np.interp(-np.log1p(-np.where(valid, rh, 0)),
+                             -np.log1p(-self.rh_nodes),
+                             np.arange(self.rh_nodes.size))
+        low = np.minimum(np.floor(position).astype(int),
+                         self.rh_nodes.size - 2)
+        fraction = (position - low)[:, None]
+
+        if ndp.ndim == 1:
+            nodes = np.stack(list(self.node_optics(ndp).values()))
+            values = ((1 - fraction) * nodes[:, low]
+                      + fraction * nodes[:, low + 1])
+            dry = nodes[:, :1]
+        else:
+            # times grouped by the RH interval they fall in
+            values = np.empty((3, rh.size, self.wavelength.size))
+            order = np.argsort(low, kind='stable')
+            starts = np.searchsorted(low[order],
+                                     np.arange(self.rh_nodes.size))
+            flat = self.kernel.reshape(self.rh_nodes.size, -1,
+                                       self.dp.size)
+            for j in range(self.rh_nodes.size - 1):
+                group = order[starts[j]:starts[j + 1]]
+                if not len(group):
+                    continue
+                f = fraction[group]
+                mixed = ((1 - f) * (ndp[group] @ flat[j].T)
+                         + f * (ndp[group] @ flat[j + 1].T))
+                values[:, group] = np.moveaxis(mixed.reshape(
+                    len(group), 3, -1), 1, 0)
+            dry = np.moveaxis((ndp @ flat[0].T).reshape(
+                rh.size, 3, -1), 1, 0)
+
+        values[:, ~valid] = np.nan
+        out = dict(zip(('Bext', 'Bsca', 'Bback'), values))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['f_ext'] = out['Bext'] / dry[0]
+            out['f_sca'] = out['Bsca'] / dry[1]
+        return out
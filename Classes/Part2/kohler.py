@@ -0,0 +1,132 @@
+""" Kappa-Kohler curves and critical supersaturation, broadcast over arrays.
+
+activity_and_CCNc builds a 10000 point wet volume grid for every dry
+radius and reads the critical supersaturation off the curve. Here the
+maximum of the kappa-Kohler curve
+    S(r) = a_w(r) exp(r_kelvin / r),  a_w = (1 + kappa V_dry / V_water)^-1
+is found directly: with x = r / r_dry and a = r_kelvin / r_dry, dS/dr = 0 is
+    g(x) = 3 kappa x^4 - a (x^3 - 1) (x^3 - 1 + kappa) = 0,
+which has one root above x = 1 and is solved by safeguarded Newton steps
+in ln(x) for all points at once.
+
+Inputs are plain arrays in SI units (m, K, N/m, kg/mol, kg/m^3) or pint
+quantities, which are converted once on the way in; the kernels only see
+floats.
+
+Example:
+    from particula import u
+    dry_radius = np.logspace(-8.5, -6.5, 1000)[:, None] * u.m
+    kappa = np.linspace(0.05, 1.3, 50)[None, :]
+    radius, supersaturation = critical_supersaturation(
+        dry_radius, kappa, temperature=298.15)
+"""
+import numpy as np
+
+GAS_CONSTANT = 8.314462618  # J/(mol K)
+
+# water, as h2o_kelvin_radius in activity_and_CCNc
+WATER_SURFACE_TENSION = 0.072  # N/m
+WATER_MOLECULAR_WEIGHT = 0.01815  # kg/mol
+WATER_DENSITY = 1000  # kg/m^3
+
+
+def _magnitude(value, unit):
+    """ Float array of value in unit; pint quantities are converted,
+    anything else is taken to be in unit already
+    """
+    if hasattr(value, 'to'):
+        value = value.to(unit).magnitude
+    return np.asarray(value, dtype=float)
+
+
+def kelvin_radius(temperature, surface_tension=WATER_SURFACE_TENSION,
+                  molecular_weight=WATER_MOLECULAR_WEIGHT,
+                  density=WATER_DENSITY):
+    """ Kelvin radius 2 sigma M / (R T rho) in m, array version of
+    kelvin_radius in activity_and_CCNc
+    """
+    temperature = _magnitude(temperature, 'K')
+    surface_tension = _magnitude(surface_tension, 'N/m')
+    molecular_weight = _magnitude(molecular_weight, 'kg/mol')
+    density = _magnitude(density, 'kg/m^3')
+    return 2 * surface_tension * molecular_weight / (
+        GAS_CONSTANT * temperature * density)
+
+
+def kohler_saturation(wet_radius, dry_radius, kappa, temperature, **kwargs):
+    """ Equilibrium saturation ratio over a droplet of wet_radius (m) grown
+    on a dry particle of dry_radius (m), broadcast over all inputs.
+    kwargs are passed to kelvin_radius.
+    """
+    wet_radius = _magnitude(wet_radius, 'm')
+    dry_radius = _magnitude(dry_radius, 'm')
+    kappa = np.asarray(kappa, dtype=float)
+    a = kelvin_radius(temperature, **kwargs)
+    volume_ratio = (wet_radius / dry_radius)**3 - 1  # V_water / V_dry
+    return volume_ratio / (volume_ratio + kappa) * np.exp(a / wet_radius)
+
+
+def _critical_x(kappa, a, tolerance=1e-12, max_iterations=100):
+    """ Root x > 1 of g(x) = 0, solved as F(t) = 0 with t = ln(x) and
+        F = ln(3 kappa) + 4 t - ln(x^3 - 1) - ln(x^3 - 1 + kappa) - ln(a),
+    which decreases from +inf at t = 0 to a slope of -2 for large t, so
+    Newton from the dilute limit x^2 = 3 kappa / a converges in a few steps
+    """
+    log_3_kappa_a = np.log(3 * kappa / a)
+
+    def f(t):
+        u = np.expm1(3 * t)  # x^3 - 1
+        value = log_3_kappa_a + 4 * t - np.log(u) - np.log(u + kappa)
+        slope = 4 - 3 * (u + 1) / u - 3 * (u + 1) / (u + kappa)
+        return value, slope
+
+    low = np.zeros_like(a)
+    high = np.full_like(a, np.inf)
+    t = np.maximum(0.5 * log_3_kappa_a, 1e-3)
+    for _ in range(max_iterations):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value, slope = f(t)
+            step = value / slope
+        low = np.where(value > 0, t, low)
+        high = np.where(value > 0, high, t)
+        t_new = t - step
+        # Newton inside the bracket, bisection (or a unit step up while
+        # there is no upper bound) otherwise
+        outside = ~((t_new >= low) & (t_new <= high))
+        t_new[outside] = np.where(np.isfinite(high[outside]),
+                                  0.5 * (low[outside] + high[outside]),
+                                  low[outside] + 1)
+        done = np.abs(t_new - t) <= tolerance
+        t = t_new
+        if done.all():
+            break
+    return np.exp(t)
+
+
+def critical_supersaturation(dry_radius, kappa, temperature,
+                             surface_tension=WATER_SURFACE_TENSION,
+                             molecular_weight=WATER_MOLECULAR_WEIGHT,
+                             density=WATER_DENSITY):
+    """ Critical wet radius (m) and critical supersaturation (S_c - 1) of
+    the kappa-Kohler curve, broadcast over dry_radius (m), kappa and
+    temperature (K).
+
+    For kappa = 0 (insoluble) the critical point is the dry particle with
+    the Kelvin supersaturation of its radius.
+    """
+    dry_radius = _magnitude(dry_radius, 'm')
+    kappa = np.asarray(kappa, dtype=float)
+    a = kelvin_radius(temperature, surface_tension, molecular_weight,
+                      density)
+    dry_radius, kappa, a = np.broadcast_arrays(dry_radius, kappa, a)
+    a = a / dry_radius
+
+    soluble = kappa > 0
+    x = np.ones_like(a)
+    x[soluble] = _critical_x(kappa[soluble], a[soluble])
+
+    x3 = x**3
+    with np.errstate(invalid='ignore', divide='ignore'):
+        activity = np.where(soluble, (x3 - 1) / (x3 - 1 + kappa), 1.0)
+    saturation = activity * np.exp(a / x)
+    return x * dry_radius, saturation - 1
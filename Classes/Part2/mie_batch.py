@@ -0,0 +1,231 @@
+""" Batched Mie calculations with numpy arrays.
+
+Drop-in replacement for looping over `ps.AutoMieQ` one diameter at a time.
+Diameters, wavelengths and refractive indices are broadcast together, the
+points are sorted by size parameter and split into chunks, and each chunk is
+solved as one padded (points x orders) array problem.
+
+Example:
+    import mie_batch
+    diameter = np.linspace(10, 5000, 500) # nm
+    q = mie_batch.batch_auto_mie_q(1.5+0.001j, 589, diameter)
+    q['Qext'], q['Qsca'], q['Qabs'], q['g'], q['Qback']
+"""
+import numpy as np
+
+import mie_profile
+
+# same order as the tuple returned by ps.AutoMieQ
+MIE_Q_FIELDS = ('Qext', 'Qsca', 'Qabs', 'g', 'Qpr', 'Qback', 'Qratio')
+MIE_C_FIELDS = ('Cext', 'Csca', 'Cabs', 'g', 'Cpr', 'Cback', 'Cratio')
+
+# below this size parameter PyMieScatt.MieQ always uses the Rayleigh limit
+RAYLEIGH_LIMIT = 0.05
+
+
+def mie_nmax(x):
+    """ Number of terms in the Mie series (Wiscombe criterion, as PyMieScatt)
+    """
+    return np.round(2 + x + 4 * np.power(x, 1/3)).astype(int)
+
+
+def batch_mie_ab(m, x, nmax=None):
+    """ Mie coefficients an, bn for arrays of m and x.
+
+    Returns an, bn with shape (len(x), N) padded with zeros past each
+    point's own nmax, and the nmax of each point. N is the largest nmax.
+    """
+    m = np.asarray(m, dtype=complex).ravel()
+    x = np.asarray(x, dtype=float).ravel()
+    m, x = np.broadcast_arrays(m, x)
+    if nmax is None:
+        nmax = mie_nmax(x)
+    nmax = np.broadcast_to(np.asarray(nmax, dtype=int), x.shape)
+    n_terms = int(nmax.max()) if x.size else 0
+    n = np.arange(1, n_terms + 1)
+    valid = n[None, :] <= nmax[:, None]
+
+    mx = m * x
+    # start of the downward recurrence for each point. PyMieScatt starts at
+    # max(nmax, |mx|) + 16, which is not fully converged for large |mx|
+    # (Q off by 1e-5 to 1e-3 above x ~ 30), so the start is pushed 10%
+    # further out. Each point keeps its own start, so a result does not
+    # depend on the other points in its chunk.
+    nmx = np.round(1.1 * np.maximum(nmax, np.abs(mx)) + 16).astype(int)
+
+    with np.errstate(all='ignore'):
+        # B&H Equation 4.89, logarithmic derivatives Dn(mx) and Dn(x)
+        # by downward recurrence, all points of the chunk at once
+        D = np.zeros((x.size, n_terms + 1), dtype=complex)
+        Dx = np.zeros((x.size, n_terms + 1))
+        d_next = np.zeros(x.size, dtype=complex)
+        dx_next = np.zeros(x.size)
+        for i in range(int(nmx.max(initial=0)) - 1, 1, -1):
+            started = i < nmx
+            d_next = np.where(started, i / mx - 1 / (d_next + i / mx), 0)
+            dx_next = np.where(started, i / x - 1 / (dx_next + i / x), 0)
+            if i - 1 <= n_terms:
+                D[:, i - 1] = d_next
+                Dx[:, i - 1] = dx_next
+        D = D[:, 1:]
+        Dx = Dx[:, 1:]
+
+        # Riccati-Bessel functions psi_n(x) and chi_n(x). Upward recurrence
+        # is stable for chi_n, and for psi_n while n <= x. Past that psi_n
+        # comes from the ratio psi_n / psi_(n-1) = 1 / (Dn(x) + n/x), which
+        # stays accurate where psi_n decays (and has no zeros).
+        px = np.zeros((x.size, n_terms))
+        chx = np.zeros((x.size, n_terms))
+        psi_prev, chi_prev = np.sin(x), np.cos(x)
+        psi_prev2, chi_prev2 = np.cos(x), -np.sin(x)
+        for i in range(n_terms):
+            order = i + 1
+            px[:, i] = np.where(
+                order <= x,
+                (2 * order - 1) / x * psi_prev - psi_prev2,
+                psi_prev / (Dx[:, i] + order / x))
+            chx[:, i] = (2 * order - 1) / x * chi_prev - chi_prev2
+            psi_prev2, psi_prev = psi_prev, px[:, i]
+            chi_prev2, chi_prev = chi_prev, chx[:, i]
+        p1x = np.concatenate((np.sin(x)[:, None], px[:, :-1]), axis=1)
+        ch1x = np.concatenate((np.cos(x)[:, None], chx[:, :-1]), axis=1)
+        gsx = px - 1j * chx
+        gs1x = p1x - 1j * ch1x
+
+        da = D / m[:, None] + n[None, :] / x[:, None]
+        db = m[:, None] * D + n[None, :] / x[:, None]
+
+        an = (da * px - p1x) / (da * gsx - gs1x)
+        bn = (db * px - p1x) / (db * gsx - gs1x)
+
+    an = np.where(valid, an, 0)
+    bn = np.where(valid, bn, 0)
+    if mie_profile.enabled():
+        mie_profile.record_series(x, nmax)
+        mie_profile.count('mie_padded_terms', x.size * n_terms)
+    return an, bn, nmax
+
+
+def mie_q_from_ab(an, bn, x):
+    """ Efficiencies from padded an, bn (B&H chapter 4)
+
+    x is the size parameter the series is normalized by. Returns the
+    arrays qext, qsca, qabs, g, qpr, qback, qratio.
+    """
+    n = np.arange(1, an.shape[1] + 1)
+    n1 = 2 * n + 1
+    n2 = n * (n + 2) / (n + 1)
+    n3 = n1 / (n * (n + 1))
+    x2 = x**2
+
+    qext = (2 / x2) * np.sum(n1 * (an.real + bn.real), axis=1)
+    qsca = (2 / x2) * np.sum(n1 * (np.abs(an)**2 + np.abs(bn)**2), axis=1)
+    qabs = qext - qsca
+
+    # next order coefficients, zero past the end of the series
+    an1 = np.concatenate((an[:, 1:], np.zeros((an.shape[0], 1))), axis=1)
+    bn1 = np.concatenate((bn[:, 1:], np.zeros((bn.shape[0], 1))), axis=1)
+    g = (4 / (qsca * x2)) * np.sum(
+        n2 * ((an * np.conj(an1)).real + (bn * np.conj(bn1)).real)
+        + n3 * (an * np.conj(bn)).real, axis=1)
+
+    qpr = qext - qsca * g
+    qback = (1 / x2) * np.abs(np.sum(n1 * (-1.0)**n * (an - bn), axis=1))**2
+    qratio = qback / qsca
+    return qext, qsca, qabs, g, qpr, qback, qratio
+
+
+def _rayleigh_q(m, x):
+    """ Rayleigh limit efficiencies (B&H eqs. 5.8, 5.9, 5.11)
+    """
+    lorentz_lorenz = (m**2 - 1) / (m**2 + 2)
+    qsca = 8 * np.abs(lorentz_lorenz)**2 * x**4 / 3
+    qabs = 4 * x * lorentz_lorenz.imag
+    qext = qsca + qabs
+    return (qext, qsca, qabs, np.zeros_like(x), qext, 1.5 * qsca,
+            np.full_like(x, 1.5))
+
+
+@mie_profile.staged('mie')
+def batch_auto_mie_q(
+        m, wavelength, diameter,
+        n_medium=1.0, crossover=0.01, as_cross_section=False,
+        chunk_size=2048):
+    """ Vectorized ps.AutoMieQ over broadcast m, wavelength and diameter.
+
+    Returns a structured array with the broadcast shape and fields
+    Qext, Qsca, Qabs, g, Qpr, Qback, Qratio (or Cext... when
+    as_cross_section=True). Points below `crossover` (or below 0.05, where
+    MieQ itself switches) use the Rayleigh limit, as AutoMieQ does.
+    Matches AutoMieQ to ~1e-10 relative for x below ~30; above that the
+    difference is AutoMieQ's own recurrence truncation (see batch_mie_ab).
+    """
+    n_medium = np.real(n_medium)
+    m, wavelength, diameter = np.broadcast_arrays(
+        np.asarray(m, dtype=complex),
+        np.asarray(wavelength, dtype=float),
+        np.asarray(diameter, dtype=float))
+    shape = m.shape
+    m_eff = m.ravel() / n_medium
+    x = np.pi * diameter.ravel() * n_medium / wavelength.ravel()
+
+    fields = MIE_C_FIELDS if as_cross_section else MIE_Q_FIELDS
+    out = np.zeros(x.size, dtype=[(name, float) for name in fields])
+    columns = np.zeros((len(fields), x.size))
+    columns[3] = 1.5  # g for x == 0, matches PyMieScatt
+
+    rayleigh = (x > 0) & ((x < crossover) | (x <= RAYLEIGH_LIMIT))
+    if rayleigh.any():
+        columns[:, rayleigh] = _rayleigh_q(m_eff[rayleigh], x[rayleigh])
+        mie_profile.count('rayleigh_points', int(rayleigh.sum()))
+
+    # sort by size parameter so each chunk pads to a similar nmax
+    mie_index = np.flatnonzero((x > 0) & ~rayleigh)
+    mie_index = mie_index[np.argsort(x[mie_index], kind='stable')]
+    for start in range(0, mie_index.size, chunk_size):
+        index = mie_index[start:start + chunk_size]
+        an, bn, nmax = batch_mie_ab(m_eff[index], x[index])
+        columns[:, index] = mie_q_from_ab(an, bn, x[index])
+        if mie_profile.enabled():
+            # work by wavelength and diameter, to find what dominates
+            mie_profile.histogram('wavelength', wavelength.ravel()[index],
+                                  nmax, per_decade=100)
+            mie_profile.histogram('diameter', diameter.ravel()[index],
+                                  nmax, per_decade=100)
+
+    if as_cross_section:
+        area = np.pi * (diameter.ravel() / 2)**2
+        for i in (0, 1, 2, 4, 5, 6):
+            columns[i] *= area
+    for name, column in zip(fields, columns):
+        out[name] = column
+    return out.reshape(shape)
+
+
+def batch_mie_q_with_diameter_range(
+        m, wavelength, n_medium=1.0, diameter_range=(10, 1000), nd=1000,
+        log_d=False):
+    """ Batched version of ps.MieQ_withDiameterRange, same tuple output
+    """
+    if log_d:
+        diameters = np.logspace(
+            np.log10(diameter_range[0]), np.log10(diameter_range[1]), nd)
+    else:
+        diameters = np.linspace(diameter_range[0], diameter_range[1], nd)
+    q = batch_auto_mie_q(m, wavelength, diameters, n_medium=n_medium)
+    return (diameters,) + tuple(q[name] for name in MIE_Q_FIELDS)
+
+
+def batch_mie_q_with_wavelength_range(
+        m, diameter, n_medium=1.0, wavelength_range=(100, 1600), nw=1000,
+        log_w=False):
+    """ Batched version of ps.MieQ_withWavelengthRange, same tuple output
+    """
+    if log_w:
+        wavelengths = np.logspace(
+            np.log10(wavelength_range[0]), np.log10(wavelength_range[1]), nw)
+    else:
+        wavelengths = np.linspace(
+            wavelength_range[0], wavelength_range[1], nw)
+    q = batch_auto_mie_q(m, wavelengths, diameter, n_medium=n_medium)
+    return (wavelengths,) + tuple(q[name] for name in MIE_Q_FIELDS)
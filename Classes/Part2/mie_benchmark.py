@@ -0,0 +1,339 @@
+""" Benchmarks and accuracy checks for the Mie calculations of the lecture.
+
+Each workload of `Lec_Mie_pythonCells.py` (single AutoMieQ calls, the
+diameter scan, the WGM wavelength scan, Mie_Lognormal sweeps,
+ScatteringFunction and MieQCoreShell) is timed at several problem sizes,
+both as the PyMieScatt loop of the lecture ('loop') and with the batched
+modules ('fast'). Wall time, peak memory (tracemalloc) and throughput in
+points/s are appended to a JSON history, and a run is flagged when it is
+slower than the median of the earlier runs on the same machine by more
+than a threshold. The engines run are checked against reference values
+stored in mie_benchmark_reference.json, computed with the PyMieScatt loops.
+
+Everything runs offline. From the Part2 folder:
+    python mie_benchmark.py                     # small and medium sizes
+    python mie_benchmark.py --sizes large --threshold 0.5
+    python mie_benchmark.py --update-reference  # after a deliberate change
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import PyMieScatt as ps
+
+import mie_batch
+import mie_coreshell
+import mie_kernel
+import mie_phase
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HISTORY_PATH = os.path.join(HERE, 'mie_benchmark_history.json')
+REFERENCE_PATH = os.path.join(HERE, 'mie_benchmark_reference.json')
+
+SIZES = {'small': 0, 'medium': 1, 'large': 2}
+
+
+# each workload builds its inputs from a problem size, then 'loop' and
+# 'fast' return the same outputs as a 2D array (field, point)
+def _auto_mie_q_setup(size):
+    return dict(m=1.5 + 0.001j, wavelength=589,
+                diameter=np.linspace(10, 5000, size))
+
+
+def _auto_mie_q_loop(m, wavelength, diameter):
+    return np.array([ps.AutoMieQ(m, wavelength, d) for d in diameter]).T
+
+
+def _auto_mie_q_fast(m, wavelength, diameter):
+    q = mie_batch.batch_auto_mie_q(m, wavelength, diameter)
+    return np.array([q[name] for name in mie_batch.MIE_Q_FIELDS])
+
+
+def _diameter_scan_setup(size):
+    return dict(m=1.5 + 0.5j, wavelength=589, nd=size)
+
+
+def _diameter_scan_loop(m, wavelength, nd):
+    return np.array(ps.MieQ_withDiameterRange(
+        m, wavelength, diameterRange=(10, 10000), nd=nd, logD=False))[1:]
+
+
+def _diameter_scan_fast(m, wavelength, nd):
+    return np.array(mie_batch.batch_mie_q_with_diameter_range(
+        m, wavelength, diameter_range=(10, 10000), nd=nd))[1:]
+
+
+def _wgm_scan_setup(size):
+    return dict(m=1.4 + 0.0001j, diameter=10000, nw=size)
+
+
+def _wgm_scan_loop(m, diameter, nw):
+    return np.array(ps.MieQ_withWavelengthRange(
+        m, diameter, wavelengthRange=(650, 700), nw=nw, logW=False))[1:]
+
+
+def _wgm_scan_fast(m, diameter, nw):
+    return np.array(mie_batch.batch_mie_q_with_wavelength_range(
+        m, diameter, wavelength_range=(650, 700), nw=nw))[1:]
+
+
+def _lognormal_setup(size):
+    return dict(m=1.5 + 0.001j, wavelength=np.linspace(10, 1500, size),
+                geo_mean=200, geo_std_dev=1.5, number_of_particles=2000)
+
+
+def _lognormal_loop(m, wavelength, geo_mean, geo_std_dev,
+                    number_of_particles):
+    return np.array([ps.Mie_Lognormal(
+        m, w, geoStdDev=geo_std_dev, geoMean=geo_mean,
+        numberOfParticles=number_of_particles, numberOfBins=250,
+        upper=1000)[:7] for w in wavelength]).T
+
+
+def _lognormal_fast(m, wavelength, geo_mean, geo_std_dev,
+                    number_of_particles):
+    optics = mie_kernel.kernel_mie_lognormal(
+        m, wavelength, geo_std_dev, geo_mean, number_of_particles,
+        number_of_bins=250, upper=1000)
+    return np.array([optics[name][0] for name in
+                     ('Bext', 'Bsca', 'Babs', 'G', 'Bpr', 'Bback', 'Bratio')])
+
+
+def _scattering_setup(size):
+    return dict(m=1.5 + 0.001j, wavelength=589,
+                diameter=np.linspace(50, 2000, size))
+
+
+def _scattering_loop(m, wavelength, diameter):
+    return np.array([ps.ScatteringFunction(m, wavelength, d)[3]
+                     for d in diameter])
+
+
+def _scattering_fast(m, wavelength, diameter):
+    return mie_phase.batch_scattering_function(m, wavelength, diameter)[3]
+
+
+def _core_shell_setup(size):
+    d_core = np.linspace(20, 300, size)
+    return dict(m_core=1.6 + 0.001j, m_shell=1.45 + 0.001j, wavelength=589,
+                d_core=d_core, d_shell=d_core + 50)
+
+
+def _core_shell_loop(m_core, m_shell, wavelength, d_core, d_shell):
+    return np.array([ps.MieQCoreShell(m_core, m_shell, wavelength, c, s)
+                     for c, s in zip(d_core, d_shell)]).T
+
+
+def _core_shell_fast(m_core, m_shell, wavelength, d_core, d_shell):
+    q = mie_coreshell.batch_core_shell_q(
+        m_core, m_shell, wavelength, d_core, d_shell)
+    return np.array([q[name] for name in mie_batch.MIE_Q_FIELDS])
+
+
+# name: setup, loop, fast, sizes (small, medium, large), reference size,
+# relative tolerance. PyMieScatt truncates its recurrence at large x, so
+# the WGM scan (x ~ 45) and the short wavelengths of the lognormal sweep
+# only agree to about 1e-4 (see mie_batch).
+WORKLOADS = {
+    'auto_mie_q': (_auto_mie_q_setup, _auto_mie_q_loop, _auto_mie_q_fast,
+                   (1, 100, 1000), 50, 1e-4),
+    'diameter_scan': (_diameter_scan_setup, _diameter_scan_loop,
+                      _diameter_scan_fast, (500, 2000, 10000), 200, 1e-4),
+    'wgm_scan': (_wgm_scan_setup, _wgm_scan_loop, _wgm_scan_fast,
+                 (200, 2000, 10000), 200, 1e-3),
+    'mie_lognormal': (_lognormal_setup, _lognormal_loop, _lognormal_fast,
+                      (10, 60, 240), 20, 1e-3),
+    'scattering_function': (_scattering_setup, _scattering_loop,
+                            _scattering_fast, (1, 20, 100), 5, 1e-6),
+    'core_shell': (_core_shell_setup, _core_shell_loop, _core_shell_fast,
+                   (10, 200, 2000), 50, 1e-6),
+}
+ENGINES = ('loop', 'fast')
+
+
+def _points(inputs):
+    """ Number of single particle calculations of a workload
+    """
+    for key in ('diameter', 'd_core', 'wavelength'):
+        if np.ndim(inputs.get(key)) == 1:
+            return len(inputs[key])
+    return inputs.get('nd', inputs.get('nw', 1))
+
+
+def time_workload(name, engine, size, repeat=3):
+    """ Best wall time of `repeat` calls, peak memory of one traced call.
+
+    Returns a dictionary with workload, engine, size, points, seconds,
+    points_per_second and peak_memory_mb.
+    """
+    setup, loop, fast = WORKLOADS[name][:3]
+    call = loop if engine == 'loop' else fast
+    inputs = setup(size)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call(**inputs)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    call(**inputs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    points = _points(inputs)
+    seconds = min(times)
+    return dict(workload=name, engine=engine, size=size, points=points,
+                seconds=seconds, points_per_second=points / seconds,
+                peak_memory_mb=peak / 2**20)
+
+
+def update_reference(path=REFERENCE_PATH):
+    """ Store the PyMieScatt loop results at each reference size
+    """
+    reference = {}
+    for name, (setup, loop, _, _, size, _) in WORKLOADS.items():
+        reference[name] = dict(size=size, values=loop(**setup(size)).tolist())
+    with open(path, 'w') as reference_file:
+        json.dump(reference, reference_file)
+    return reference
+
+
+def check_accuracy(path=REFERENCE_PATH, engines=ENGINES):
+    """ Largest relative error of each of engines against the stored
+    reference.
+
+    Returns a list of dictionaries with workload, engine, max_rel_error,
+    tolerance and passed.
+    """
+    with open(path) as reference_file:
+        reference = json.load(reference_file)
+    results = []
+    for name, (setup, loop, fast, _, _, tolerance) in WORKLOADS.items():
+        expected = np.array(reference[name]['values'])
+        inputs = setup(reference[name]['size'])
+        for engine in engines:
+            call = loop if engine == 'loop' else fast
+            got = call(**inputs)
+            scale = np.maximum(np.abs(expected),
+                               1e-12 * np.abs(expected).max())
+            error = float(np.max(np.abs(got - expected) / scale))
+            results.append(dict(workload=name, engine=engine,
+                                max_rel_error=error, tolerance=tolerance,
+                                passed=error <= tolerance))
+    return results
+
+
+def _machine():
+    """ Identifies the box so timings are only compared on the same one
+    """
+    return dict(host=socket.gethostname(), platform=platform.platform(),
+                python=platform.python_version(), numpy=np.__version__,
+                pymiescatt=ps.__version__)
+
+
+def load_history(path=HISTORY_PATH):
+    if not os.path.exists(path):
+        return []
+    with open(path) as history_file:
+        return json.load(history_file)
+
+
+def find_regressions(timings, history, machine, threshold=0.2):
+    """ Timings slower than the median of earlier runs by more than threshold
+    """
+    regressions = []
+    for timing in timings:
+        earlier = [record['seconds'] for run in history
+                   if run['machine'] == machine
+                   for record in run['timings']
+                   if (record['workload'], record['engine'], record['size'])
+                   == (timing['workload'], timing['engine'], timing['size'])]
+        if not earlier:
+            continue
+        baseline = float(np.median(earlier))
+        if timing['seconds'] > (1 + threshold) * baseline:
+            regressions.append(dict(timing, baseline_seconds=baseline,
+                                    slowdown=timing['seconds'] / baseline))
+    return regressions
+
+
+def run_benchmarks(sizes=('small', 'medium'), workloads=None,
+                   engines=ENGINES, repeat=3, threshold=0.2,
+                   history_path=HISTORY_PATH,
+                   reference_path=REFERENCE_PATH, save=True):
+    """ Time the workloads, check accuracy, compare with the history.
+
+    Returns the run record (also appended to the history when save):
+    timestamp, machine, timings, accuracy, regressions.
+    """
+    workloads = workloads or list(WORKLOADS)
+    timings = []
+    for name in workloads:
+        for size_name in sizes:
+            size = WORKLOADS[name][3][SIZES[size_name]]
+            for engine in engines:
+                timings.append(time_workload(name, engine, size, repeat))
+
+    machine = _machine()
+    history = load_history(history_path)
+    run = dict(timestamp=datetime.now(timezone.utc).isoformat(),
+               machine=machine, timings=timings,
+               accuracy=check_accuracy(reference_path, engines),
+               regressions=find_regressions(timings, history, machine,
+                                            threshold))
+    if save:
+        history.append(run)
+        with open(history_path, 'w') as history_file:
+            json.dump(history, history_file, indent=1)
+    return run
+
+
+def print_report(run):
+    print(f"{'workload':20} {'engine':6} {'size':>6} {'seconds':>10} "
+          f"{'points/s':>12} {'peak MB':>9}")
+    for t in run['timings']:
+        print(f"{t['workload']:20} {t['engine']:6} {t['size']:6d} "
+              f"{t['seconds']:10.4f} {t['points_per_second']:12.1f} "
+              f"{t['peak_memory_mb']:9.2f}")
+    print()
+    for a in run['accuracy']:
+        status = 'ok' if a['passed'] else 'FAIL'
+        print(f"{a['workload']:20} {a['engine']:6} max rel error "
+              f"{a['max_rel_error']:.2e} (tol {a['tolerance']:.0e}) {status}")
+    for r in run['regressions']:
+        print(f"REGRESSION {r['workload']} {r['engine']} size {r['size']}: "
+              f"{r['seconds']:.4f} s vs {r['baseline_seconds']:.4f} s "
+              f"({r['slowdown']:.2f}x)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'],
+                        choices=list(SIZES))
+    parser.add_argument('--workloads', nargs='+', choices=list(WORKLOADS))
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES),
+                        choices=list(ENGINES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown fraction before flagging')
+    parser.add_argument('--history', default=HISTORY_PATH)
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--update-reference', action='store_true')
+    args = parser.parse_args()
+
+    if args.update_reference:
+        update_reference()
+    run = run_benchmarks(args.sizes, args.workloads, args.engines,
+                         args.repeat, args.threshold, args.history,
+                         save=not args.no_save)
+    print_report(run)
+    failed = (run['regressions']
+              or not all(a['passed'] for a in run['accuracy']))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,215 @@
+""" Batched core-shell Mie and effective medium (mixing rule) comparison.
+
+`batch_core_shell_q` is a vectorized ps.MieQCoreShell over broadcast arrays
+of core and shell indices, wavelengths and diameters (d_shell = d_core +
+2 * shell thickness). `mixing_rule_error_map` evaluates the volume mixing,
+Maxwell Garnett and Bruggeman approximations on the same grid and reports
+their error against the exact two-layer solution, so the cheap
+homogeneous-sphere shortcut can be used where it is good enough.
+
+Example:
+    d_core = np.linspace(20, 300, 100)[:, None]
+    thickness = np.linspace(0, 200, 80)[None, :]
+    errors = mixing_rule_error_map(1.95+0.79j, 1.55+0.001j, 550,
+                                   d_core, d_core + 2 * thickness)
+    errors['best_rule'], errors['best_error']
+"""
+import numpy as np
+from scipy.special import jv, yv
+
+import mie_batch
+
+MIXING_RULES = ('volume_mixing', 'maxwell_garnett', 'bruggeman')
+
+
+def _log_derivative(z, nmx, n_terms):
+    """ Dn(z) for n = 1..n_terms by downward recurrence, per point start
+    """
+    D = np.zeros((z.size, n_terms + 1), dtype=complex)
+    d_next = np.zeros(z.size, dtype=complex)
+    for i in range(int(nmx.max(initial=0)) - 1, 1, -1):
+        d_next = np.where(i < nmx, i / z - 1 / (d_next + i / z), 0)
+        if i - 1 <= n_terms:
+            D[:, i - 1] = d_next
+    return D[:, 1:]
+
+
+def batch_core_shell_ab(m_core, m_shell, x_core, x_shell):
+    """ Coated sphere coefficients an, bn (B&H section 8.1), as
+    ps.CoreShell_ab for arrays of points.
+
+    Returns an, bn with shape (n_points, N) padded with zeros past each
+    point's own nmax, and the nmax of each point.
+    """
+    m_core, m_shell, x_core, x_shell = [np.ravel(value) for value in
+                                        np.broadcast_arrays(
+                                            np.asarray(m_core, complex),
+                                            np.asarray(m_shell, complex),
+                                            np.asarray(x_core, float),
+                                            np.asarray(x_shell, float))]
+    m = m_shell / m_core
+    u = m_core * x_core
+    v = m_shell * x_core
+    w = m_shell * x_shell
+
+    nmax = mie_batch.mie_nmax(x_shell)
+    n_terms = int(nmax.max()) if nmax.size else 0
+    n = np.arange(1, n_terms + 1)
+    valid = n[None, :] <= nmax[:, None]
+    mx = np.maximum(np.abs(m_core * x_shell), np.abs(m_shell * x_shell))
+    nmx = np.round(1.1 * np.maximum(nmax, mx) + 16).astype(int)
+
+    with np.errstate(all='ignore'):
+        nu = (n + 0.5)[None, :]
+        sv = np.sqrt(0.5 * np.pi * v)[:, None]
+        sw = np.sqrt(0.5 * np.pi * w)[:, None]
+        sy = np.sqrt(0.5 * np.pi * x_shell)[:, None]
+
+        pv = sv * jv(nu, v[:, None])
+        pw = sw * jv(nu, w[:, None])
+        py = sy * jv(nu, x_shell[:, None])
+        chv = -sv * yv(nu, v[:, None])
+        chw = -sw * yv(nu, w[:, None])
+        chy = -sy * yv(nu, x_shell[:, None])
+
+        p1y = np.concatenate((np.sin(x_shell)[:, None], py[:, :-1]), axis=1)
+        ch1y = np.concatenate((np.cos(x_shell)[:, None], chy[:, :-1]),
+                              axis=1)
+        gsy = py - 1j * chy
+        gs1y = p1y - 1j * ch1y
+
+        # B&H Equation 4.89
+        Du = _log_derivative(u, nmx, n_terms)
+        Dv = _log_derivative(v, nmx, n_terms)
+        Dw = _log_derivative(w, nmx, n_terms)
+
+        uu = m[:, None] * Du - Dv
+        vv = Du / m[:, None] - Dv
+        fv = pv / chv
+
+        dns = ((uu * fv / pw) / (uu * (pw - chw * fv) + (pw / pv) / chv)) + Dw
+        gns = ((vv * fv / pw) / (vv * (pw - chw * fv) + (pw / pv) / chv)) + Dw
+        a1 = dns / m_shell[:, None] + n / x_shell[:, None]
+        b1 = m_shell[:, None] * gns + n / x_shell[:, None]
+
+        an = (py * a1 - p1y) / (gsy * a1 - gs1y)
+        bn = (py * b1 - p1y) / (gsy * b1 - gs1y)
+
+    an = np.where(valid, an, 0)
+    bn = np.where(valid, bn, 0)
+    return an, bn, nmax
+
+
+def batch_core_shell_q(m_core, m_shell, wavelength, d_core, d_shell,
+                       n_medium=1.0, chunk_size=1024):
+    """ Vectorized ps.MieQCoreShell over broadcast inputs.
+
+    Returns a structured array with the broadcast shape and the
+    mie_batch.MIE_Q_FIELDS. Uncoated points (d_core == d_shell), empty
+    cores and equal indices reduce to MieQ of a homogeneous sphere, as in
+    MieQCoreShell.
+    """
+    n_medium = np.real(n_medium)
+    m_core, m_shell, wavelength, d_core, d_shell = np.broadcast_arrays(
+        np.asarray(m_core, dtype=complex), np.asarray(m_shell, dtype=complex),
+        np.asarray(wavelength, dtype=float), np.asarray(d_core, dtype=float),
+        np.asarray(d_shell, dtype=float))
+    shape = m_core.shape
+    m_core, m_shell, wavelength, d_core, d_shell = [
+        value.ravel() for value in
+        (m_core, m_shell, wavelength, d_core, d_shell)]
+    x_core = np.pi * d_core * n_medium / wavelength
+    x_shell = np.pi * d_shell * n_medium / wavelength
+
+    columns = np.zeros((len(mie_batch.MIE_Q_FIELDS), x_shell.size))
+
+    # the homogeneous cases MieQCoreShell hands to MieQ
+    core_only = x_core == x_shell
+    shell_only = ~core_only & ((x_core == 0) | (m_core == m_shell))
+    for mask, m in ((core_only, m_core), (shell_only, m_shell)):
+        if mask.any():
+            q = mie_batch.batch_auto_mie_q(
+                m[mask], wavelength[mask], d_shell[mask], n_medium=n_medium,
+                crossover=0)
+            columns[:, mask] = [q[name] for name in mie_batch.MIE_Q_FIELDS]
+
+    coated = np.flatnonzero(~core_only & ~shell_only)
+    coated = coated[np.argsort(x_shell[coated], kind='stable')]
+    for start in range(0, coated.size, chunk_size):
+        index = coated[start:start + chunk_size]
+        an, bn, _ = batch_core_shell_ab(
+            m_core[index] / n_medium, m_shell[index] / n_medium,
+            x_core[index], x_shell[index])
+        columns[:, index] = mie_batch.mie_q_from_ab(an, bn, x_shell[index])
+
+    out = np.zeros(x_shell.size,
+                   dtype=[(name, float) for name in mie_batch.MIE_Q_FIELDS])
+    for name, column in zip(mie_batch.MIE_Q_FIELDS, columns):
+        out[name] = column
+    return out.reshape(shape)
+
+
+def effective_index(m_core, m_shell, core_volume_fraction, rule):
+    """ Effective refractive index of a core-shell particle.
+
+    rule is one of MIXING_RULES: volume_mixing (volume weighted index),
+    maxwell_garnett (core as inclusion in a shell matrix) or bruggeman
+    (symmetric effective medium).
+    """
+    f = np.asarray(core_volume_fraction, dtype=float)
+    m_core = np.asarray(m_core, dtype=complex)
+    m_shell = np.asarray(m_shell, dtype=complex)
+    if rule == 'volume_mixing':
+        return f * m_core + (1 - f) * m_shell
+    eps_core = m_core**2
+    eps_shell = m_shell**2
+    if rule == 'maxwell_garnett':
+        eps = eps_shell * (eps_core + 2 * eps_shell
+                           + 2 * f * (eps_core - eps_shell)) / (
+            eps_core + 2 * eps_shell - f * (eps_core - eps_shell))
+    elif rule == 'bruggeman':
+        # root of 2 eps^2 - b eps - eps_core eps_shell = 0 with Im(eps) >= 0
+        b = (3 * f - 1) * eps_core + (2 - 3 * f) * eps_shell
+        root = np.sqrt(b**2 + 8 * eps_core * eps_shell)
+        eps = (b + root) / 4
+        other = (b - root) / 4
+        eps = np.where(eps.imag >= other.imag, eps, other)
+    else:
+        raise ValueError(f'unknown mixing rule {rule}, use {MIXING_RULES}')
+    return np.sqrt(eps)
+
+
+def mixing_rule_error_map(m_core, m_shell, wavelength, d_core, d_shell,
+                          n_medium=1.0, fields=('Qext', 'Qsca', 'Qabs')):
+    """ Exact core-shell efficiencies and the error of each mixing rule.
+
+    Returns a dictionary with
+        exact: structured array from batch_core_shell_q
+        approximation: {rule: structured array of the homogeneous sphere}
+        error: {rule: largest relative error over fields}
+        best_rule: name of the most accurate rule at each point
+        best_error: its relative error
+    """
+    exact = batch_core_shell_q(m_core, m_shell, wavelength, d_core, d_shell,
+                               n_medium=n_medium)
+    d_core, d_shell = np.broadcast_arrays(
+        np.asarray(d_core, dtype=float), np.asarray(d_shell, dtype=float))
+    core_volume_fraction = np.divide(
+        d_core**3, d_shell**3, out=np.zeros(d_shell.shape), where=d_shell > 0)
+
+    approximation = {}
+    error = {}
+    for rule in MIXING_RULES:
+        m_eff = effective_index(m_core, m_shell, core_volume_fraction, rule)
+        approximation[rule] = mie_batch.batch_auto_mie_q(
+            m_eff, wavelength, d_shell, n_medium=n_medium, crossover=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = [np.abs(approximation[rule][name] - exact[name])
+                        / np.abs(exact[name]) for name in fields]
+        error[rule] = np.nan_to_num(np.max(relative, axis=0))
+
+    stacked = np.stack([error[rule] for rule in MIXING_RULES])
+    best = np.argmin(stacked, axis=0)
+    return dict(exact=exact, approximation=approximation, error=error,
+                best_rule=np.array(MIXING_RULES)[best],
+                best_error=np.min(stacked, axis=0))
@@ -0,0 +1,260 @@
+""" Complex refractive index retrieval from measured scattering and
+absorption of a measured size distribution.
+
+The forward model is ps.Mie_SD(..., SMPS=True): for a refractive index m,
+Bsca and Babs at each wavelength are the sums over the SMPS bins of the
+cross section times the bin count. The per-bin cross sections only depend
+on m, so they are computed with mie_batch for all wavelengths and bins at
+once and cached on a fine (n, ln k) lattice. The cache is shared by all
+samples, the Jacobian steps and successive time steps, so a day of scans
+with slowly varying composition needs few new Mie evaluations.
+
+The index is assumed the same at all measured wavelengths and is solved by
+Levenberg-Marquardt in (n, ln k), vectorized over samples. Results are
+exact to the lattice resolution (1e-4 in n, 0.1% in k by default).
+
+Example:
+    inversion = IndexInversion([450, 550, 700], dp)
+    # Bsca, Babs (n_scans, 3) and ndp (n_scans, bins)
+    result = inversion.invert(Bsca, Babs, ndp)
+    result['n'], result['k'], result['n_error'], result['converged']
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+import mie_batch
+
+INVERSION_FIELDS = [
+    ('n', float), ('k', float), ('n_error', float), ('k_error', float),
+    ('chi2', float), ('iterations', int), ('converged', bool)]
+
+
+class IndexInversion:
+    """ n, k retrieval for a fixed set of wavelengths and SMPS bins.
+
+    n_bounds and k_bounds limit the search. n_resolution and
+    log_k_resolution are the lattice spacings the forward model is
+    evaluated (and cached) on, jacobian_step is the finite difference step
+    in lattice units. At most max_cache lattice points are kept.
+    """
+
+    def __init__(self, wavelength, dp, n_medium=1.0, n_bounds=(1.3, 2.0),
+                 k_bounds=(1e-5, 1.0), n_resolution=1e-4,
+                 log_k_resolution=1e-3, jacobian_step=10, max_cache=4096):
+        self.wavelength = np.atleast_1d(np.asarray(wavelength, dtype=float))
+        self.dp = np.asarray(dp, dtype=float)
+        self.n_medium = n_medium
+        self.resolution = np.array([n_resolution, log_k_resolution])
+        self.lower = np.round(
+            np.array([n_bounds[0], np.log(k_bounds[0])]) / self.resolution)
+        self.upper = np.round(
+            np.array([n_bounds[1], np.log(k_bounds[1])]) / self.resolution)
+        self.jacobian_step = jacobian_step
+        self.max_cache = max_cache
+        # scaling of 1e-6 to cast in units of inverse megameters
+        self.area = np.pi * (self.dp / 2)**2 * 1e-6
+        self._cache = OrderedDict()
+        self.cache_stats = {'hits': 0, 'misses': 0}
+
+    def _index(self, lattice):
+        """ Complex refractive index of lattice points (n, ln k) in units
+        of the resolution
+        """
+        n, log_k = (lattice * self.resolution).T
+        return n + 1j * np.exp(log_k)
+
+    def _kernels(self, lattice):
+        """ Per-bin Csca and Cabs (n_points, 2, n_wavelength, n_bins) of
+        lattice points, from the cache or one batched Mie call
+        """
+        keys = [tuple(point) for point in lattice.astype(int)]
+        missing = list(dict.fromkeys(key for key in keys
+                                     if key not in self._cache))
+        self.cache_stats['hits'] += len(keys) - len(missing)
+        self.cache_stats['misses'] += len(missing)
+        if missing:
+            m = self._index(np.array(missing, dtype=float))
+            q = mie_batch.batch_auto_mie_q(
+                m[:, None, None], self.wavelength[None, :, None],
+                self.dp[None, None, :], n_medium=self.n_medium)
+            for i, key in enumerate(missing):
+                self._cache[key] = np.stack(
+                    (q['Qsca'][i], q['Qabs'][i])) * self.area
+        kernels = np.empty(
+            (len(keys), 2, self.wavelength.size, self.dp.size))
+        for i, key in enumerate(keys):
+            self._cache.move_to_end(key)
+            kernels[i] = self._cache[key]
+        while len(self._cache) > self.max_cache:
+            self._cache.popitem(last=False)
+        return kernels
+
+    def forward(self, m, ndp):
+        """ Bsca and Babs (1/Mm), each (n_samples, n_wavelength), of m
+        (n_samples,) and ndp (n_samples, n_bins) counts per bin, as
+        ps.Mie_SD(..., SMPS=True). m is rounded to the lattice.
+        """
+        m = np.atleast_1d(np.asarray(m, dtype=complex))
+        ndp = np.atleast_2d(np.asarray(ndp, dtype=float))
+        lattice = np.round(np.stack(
+            (m.real, np.log(m.imag)), axis=-1) / self.resolution)
+        B = np.einsum('sfwb,sb->sfw', self._kernels(lattice), ndp)
+        return B[:, 0], B[:, 1]
+
+    def _model(self, lattice, ndp):
+        """ Stacked [Bsca, Babs] of samples at lattice points
+        """
+        B = np.einsum('sfwb,sb->sfw', self._kernels(lattice), ndp)
+        return B.reshape(len(ndp), -1)
+
+    def invert(self, Bsca, Babs, ndp, guess=1.5 + 0.01j, sigma=None,
+               max_iterations=50):
+        """ n, k of each sample from Bsca, Babs (n_samples, n_wavelength)
+        and ndp (n_samples, n_bins).
+
+        guess is one index or one per sample. sigma is the measurement
+        uncertainty [of Bsca, of Babs], each broadcastable to the shape of
+        its data (a scalar, one value per wavelength or per value); by
+        default 1% of the measured values. Channels whose value is missing
+        (NaN) or whose sigma is not positive are left out of that sample;
+        a sample with fewer than two channels left gets NaN. Returns a
+        structured array of INVERSION_FIELDS, errors are 1 sigma from the
+        Jacobian at the solution. converged is False for samples that
+        stalled (no better lattice point at any damping) or hit
+        max_iterations.
+        """
+        Bsca = np.atleast_2d(np.asarray(Bsca, dtype=float))
+        Babs = np.atleast_2d(np.asarray(Babs, dtype=float))
+        ndp = np.atleast_2d(np.asarray(ndp, dtype=float))
+        if not np.all(np.isfinite(ndp)):
+            raise ValueError('ndp has non-finite values')
+        n_samples = len(ndp)
+        measured = np.concatenate((Bsca, Babs), axis=1)
+        if sigma is None:
+            sigma = 0.01 * np.abs(measured)
+        else:
+            sigma_sca, sigma_abs = sigma
+            sigma = np.concatenate(
+                (np.broadcast_to(sigma_sca, Bsca.shape),
+                 np.broadcast_to(sigma_abs, Babs.shape)), axis=1)
+        # residuals are (model - measured) * weight, 0 for unusable channels
+        usable = np.isfinite(measured) & np.isfinite(sigma) & (sigma > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(usable, 1 / sigma, 0)
+        measured = np.where(usable, measured, 0)
+
+        guess = np.broadcast_to(np.asarray(guess, dtype=complex), n_samples)
+        if not np.all(np.isfinite(guess)) or np.any(guess.imag <= 0):
+            raise ValueError('guess must be finite with k > 0')
+        point = np.clip(np.round(np.stack(
+            (guess.real, np.log(guess.imag)), axis=-1) / self.resolution),
+            self.lower, self.upper)
+        step = self.jacobian_step * np.eye(2)
+        damping = np.full(n_samples, 1e-3)
+        iterations = np.zeros(n_samples, dtype=int)
+        converged = np.zeros(n_samples, dtype=bool)
+        solvable = usable.sum(axis=1) >= 2
+        stopped = ~solvable
+
+        def residual(lattice, active):
+            return (self._model(lattice, ndp[active])
+                    - measured[active]) * weight[active]
+
+        r = residual(point, slice(None))
+        chi2 = np.sum(r**2, axis=1)
+        for _ in range(max_iterations):
+            active = np.flatnonzero(~stopped)
+            if active.size == 0:
+                break
+            iterations[active] += 1
+            # model at the point and one step along n and ln k, one batch
+            probe = np.concatenate(
+                (point[active], point[active] + step[0],
+                 point[active] + step[1]))
+            model = self._model(probe, np.tile(ndp[active], (3, 1)))
+            model = model.reshape(3, active.size, -1)
+            jacobian = np.stack((model[1] - model[0], model[2] - model[0]),
+                                axis=-1) * (weight[active][..., None]
+                                            / self.jacobian_step)
+            r_active = (model[0] - measured[active]) * weight[active]
+
+            jtj = np.einsum('swi,swj->sij', jacobian, jacobian)
+            jtr = np.einsum('swi,sw->si', jacobian, r_active)
+            scaled = jtj + damping[active, None, None] * (
+                np.eye(2) * np.diagonal(jtj, axis1=1, axis2=2)[:, None, :])
+            # 2 x 2 solve per sample; a singular system gives a non-finite
+            # step, which stops that sample instead of raising for all
+            (a, b), (c, d) = scaled[:, 0].T, scaled[:, 1].T
+            with np.errstate(divide='ignore', invalid='ignore'):
+                delta = -np.stack((d * jtr[:, 0] - b * jtr[:, 1],
+                                   a * jtr[:, 1] - c * jtr[:, 0]),
+                                  axis=-1) / (a * d - b * c)[:, None]
+            finite = np.all(np.isfinite(delta), axis=1)
+            delta[~finite] = 0
+            trial = np.clip(point[active] + np.round(delta),
+                            self.lower, self.upper)
+            moved = np.any(trial != point[active], axis=1)
+
+            trial_chi2 = np.sum(residual(trial, active)**2, axis=1)
+            better = moved & (trial_chi2 < chi2[active])
+            point[active[better]] = trial[better]
+            chi2[active[better]] = trial_chi2[better]
+            damping[active] = np.where(better, damping[active] / 10,
+                                       damping[active] * 10)
+            # converged when the step rounds to no lattice move; stalled
+            # (not converged) when the damping is so large that no better
+            # point is nearby, or the step is not finite
+            converged[active] = finite & ~moved
+            stopped[active] = (converged[active] | ~finite
+                               | (damping[active] > 1e8))
+
+        m = self._index(point)
+        out = np.zeros(n_samples, dtype=INVERSION_FIELDS)
+        out['n'] = np.where(solvable, m.real, np.nan)
+        out['k'] = np.where(solvable, m.imag, np.nan)
+        out['chi2'] = np.where(solvable, chi2, np.nan)
+        out['iterations'] = iterations
+        out['converged'] = converged
+
+        # 1 sigma errors from the covariance (J^T J)^-1 at the solution
+        probe = np.concatenate((point, point + step[0], point + step[1]))
+        model = self._model(probe, np.tile(ndp, (3, 1)))
+        model = model.reshape(3, n_samples, -1)
+        jacobian = np.stack((model[1] - model[0], model[2] - model[0]),
+                            axis=-1) * (weight[..., None] / self.jacobian_step)
+        jtj = np.einsum('swi,swj->sij', jacobian, jacobian)
+        with np.errstate(invalid='ignore'):
+            variance = np.diagonal(np.linalg.pinv(jtj), axis1=1, axis2=2)
+            errors = np.sqrt(variance) * self.resolution
+        out['n_error'] = np.where(solvable, errors[:, 0], np.nan)
+        out['k_error'] = errors[:, 1] * out['k']
+        return out
+
+    def invert_series(self, Bsca, Babs, ndp, guess=1.5 + 0.01j, sigma=None,
+                      block_size=60, max_iterations=50):
+        """ invert() over a time series in blocks of block_size scans.
+
+        Each block starts from the solution of the last solved scan before
+        it (warm start); blocks before any solved scan start from guess.
+        """
+        Bsca = np.atleast_2d(np.asarray(Bsca, dtype=float))
+        Babs = np.atleast_2d(np.asarray(Babs, dtype=float))
+        ndp = np.atleast_2d(np.asarray(ndp, dtype=float))
+        out = np.zeros(len(ndp), dtype=INVERSION_FIELDS)
+        for start in range(0, len(ndp), block_size):
+            block = slice(start, start + block_size)
+            block_sigma = None
+            if sigma is not None:
+                block_sigma = [np.broadcast_to(value, measured.shape)[block]
+                               for value, measured in zip(sigma,
+                                                          (Bsca, Babs))]
+            out[block] = self.invert(
+                Bsca[block], Babs[block], ndp[block], guess=guess,
+                sigma=block_sigma, max_iterations=max_iterations)
+            solved = out[block]
+            solved = solved[np.isfinite(solved['n'])
+                            & np.isfinite(solved['k']) & (solved['k'] > 0)]
+            if len(solved):
+                guess = solved[-1]['n'] + 1j * solved[-1]['k']
+        return out
@@ -0,0 +1,254 @@
+""" Kernel-matrix optics for many size distributions at once.
+
+`ps.Mie_SD` and `ps.Mie_Lognormal` recompute the Mie efficiency of every
+bin on every call. Here the per-bin cross sections are computed once as a
+kernel K[wavelength, Dp] and the optics of any number of distributions,
+given as an (n_dist x n_bins) number matrix, are a single matrix product.
+
+Example:
+    dp = np.logspace(0, 3, 250) # nm
+    kernel = MieKernel(1.5+0.001j, np.arange(10, 1500, 25), dp, SMPS=False)
+    ndp = lognormal_ndp(dp, geo_mean=[100, 200, 300], geo_std_dev=1.5,
+                        number_of_particles=2000)
+    optics = kernel.optics(ndp) # optics['Bext'] is (3, n_wavelength)
+
+    optics, info = quadrature_mie_lognormal(1.5+0.01j, [450, 550, 700],
+                                            1.5, [50, 100, 150], 2000)
+    info['relative_error'], info['nodes'], info['mie_calls']
+"""
+import numpy as np
+from numpy.polynomial.hermite import hermgauss
+
+import mie_batch
+import mie_profile
+
+
+def lognormal_ndp(dp, geo_mean, geo_std_dev, number_of_particles):
+    """ Lognormal number distributions on dp, one row per distribution.
+
+    Same form as ps.Mie_Lognormal (a dN/dDp density). geo_mean,
+    geo_std_dev and number_of_particles broadcast to n_dist.
+    """
+    dp = np.asarray(dp, dtype=float)
+    geo_mean, geo_std_dev, number_of_particles = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(geo_mean, dtype=float)),
+        np.atleast_1d(np.asarray(geo_std_dev, dtype=float)),
+        np.atleast_1d(np.asarray(number_of_particles, dtype=float)))
+    log_sigma = np.log(geo_std_dev)[:, None]
+    return (number_of_particles[:, None]
+            / (np.sqrt(2 * np.pi) * log_sigma * dp[None, :])
+            * np.exp(-(np.log(dp[None, :]) - np.log(geo_mean[:, None]))**2
+                     / (2 * log_sigma**2)))
+
+
+def _bin_weights(dp, SMPS):
+    """ Summation weights of each bin, trapezoid in dp when not SMPS
+    """
+    if SMPS:
+        return np.ones_like(dp)
+    weights = np.zeros_like(dp)
+    step = np.diff(dp)
+    weights[:-1] += step / 2
+    weights[1:] += step / 2
+    return weights
+
+
+class MieKernel:
+    """ Per-bin Mie cross sections K[wavelength, Dp] for a fixed bin grid.
+
+    SMPS=True sums the bins like ps.Mie_SD(..., SMPS=True), SMPS=False
+    integrates with the trapezoid rule in dp like ps.Mie_Lognormal.
+    Kernel units are 1/Mm per particle per cc, as in PyMieScatt.
+    """
+
+    @mie_profile.staged('kernel build')
+    def __init__(self, m, wavelength, dp, n_medium=1.0, SMPS=True):
+        self.wavelength = np.atleast_1d(np.asarray(wavelength, dtype=float))
+        self.dp = np.asarray(dp, dtype=float)
+        self.m = m
+        self.SMPS = SMPS
+        q = mie_batch.batch_auto_mie_q(
+            m, self.wavelength[:, None], self.dp[None, :], n_medium=n_medium)
+
+        # scaling of 1e-6 to cast in units of inverse megameters
+        area = np.pi * (self.dp / 2)**2 * 1e-6 * _bin_weights(self.dp, SMPS)
+        self.ext = q['Qext'] * area
+        self.sca = q['Qsca'] * area
+        self.back = q['Qback'] * area
+        self.ratio = q['Qratio'] * area
+        self.g_sca = q['g'] * q['Qsca'] * area
+
+    @mie_profile.staged('distribution integration')
+    def optics(self, ndp):
+        """ Bext, Bsca, Babs, G, Bpr, Bback, Bratio for each distribution.
+
+        ndp is (n_bins,) or (n_dist, n_bins). Each output is (n_dist,
+        n_wavelength), or (n_wavelength,) for a single distribution.
+        """
+        ndp = np.asarray(ndp, dtype=float)
+        single = ndp.ndim == 1
+        ndp = np.atleast_2d(ndp)
+        # one matrix product for all kernels: (n_dist, bins) @ (bins, 5 wl)
+        stacked = np.concatenate(
+            (self.ext, self.sca, self.back, self.ratio, self.g_sca)).T
+        result = ndp @ stacked
+        Bext, Bsca, Bback, Bratio, g_sca = np.split(result, 5, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bigG = g_sca / Bsca
+        optics = dict(Bext=Bext, Bsca=Bsca, Babs=Bext - Bsca, G=bigG,
+                      Bpr=Bext - bigG * Bsca, Bback=Bback, Bratio=Bratio)
+        if single:
+            optics = {key: value[0] for key, value in optics.items()}
+        return optics
+
+
+def kernel_mie_lognormal(
+        m, wavelength, geo_std_dev, geo_mean, number_of_particles,
+        n_medium=1.0, number_of_bins=10000, lower=1, upper=1000):
+    """ ps.Mie_Lognormal for many wavelengths and modes in one call.
+
+    Returns the MieKernel.optics dictionary, each entry
+    (n_modes, n_wavelength). The asymmetry parameter is under 'G' (as
+    ps.Mie_SD), where ps.Mie_Lognormal(asDict=True) has 'bigG'.
+    """
+    dp = np.logspace(np.log10(lower), np.log10(upper), number_of_bins)
+    kernel = MieKernel(m, wavelength, dp, n_medium=n_medium, SMPS=False)
+    ndp = lognormal_ndp(dp, geo_mean, geo_std_dev, number_of_particles)
+    return kernel.optics(ndp)
+
+
+def _lognormal_nodes(geo_mean, geo_std_dev, n_nodes, cutoff):
+    """ Gauss-Hermite diameters (n_dist, n_nodes) and weights for the
+    integral over a lognormal in ln(Dp), the weights of a row sum to 1.
+
+    Far tail nodes whose share of the cross section (weight * Dp^2) is
+    below cutoff are dropped: keep marks the nodes to evaluate, the others
+    have zero weight (and a Dp of geo_mean).
+    """
+    t, w = hermgauss(n_nodes)
+    w = w / np.sqrt(np.pi)
+    log_dp = (np.log(geo_mean)[:, None]
+              + np.sqrt(2) * np.log(geo_std_dev)[:, None] * t[None, :])
+    share = np.log(w)[None, :] + 2 * (log_dp - np.log(geo_mean)[:, None])
+    keep = share >= np.log(cutoff) + share.max(axis=1, keepdims=True)
+    dp = np.where(keep, np.exp(log_dp), geo_mean[:, None])
+    return dp, np.where(keep, w, 0), keep
+
+
+def _quadrature_optics(m, wavelength, geo_mean, geo_std_dev,
+                       number_of_particles, n_medium, n_nodes, cutoff):
+    """ Optics with n_nodes Gauss-Hermite nodes, for 1D arrays of
+    (wavelength, distribution) pairs
+    """
+    dp, weights, keep = _lognormal_nodes(
+        geo_mean, geo_std_dev, n_nodes, cutoff)
+    # Mie of the kept nodes only, the dropped ones stay zero
+    rows = np.nonzero(keep)[0]
+    q = np.zeros(dp.shape, dtype=[(name, float)
+                                  for name in mie_batch.MIE_Q_FIELDS])
+    q[keep] = mie_batch.batch_auto_mie_q(
+        np.broadcast_to(m, dp.shape)[keep], wavelength[rows], dp[keep],
+        n_medium=n_medium)
+    # scaling of 1e-6 to cast in units of inverse megameters
+    area = (np.pi * (dp / 2)**2 * 1e-6 * weights
+            * number_of_particles[:, None])
+    Bext = np.sum(q['Qext'] * area, axis=1)
+    Bsca = np.sum(q['Qsca'] * area, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bigG = np.sum(q['g'] * q['Qsca'] * area, axis=1) / Bsca
+    optics = dict(Bext=Bext, Bsca=Bsca, Babs=Bext - Bsca, G=bigG,
+                  Bpr=Bext - bigG * Bsca,
+                  Bback=np.sum(q['Qback'] * area, axis=1),
+                  Bratio=np.sum(q['Qratio'] * area, axis=1))
+    return optics, int(keep.sum())
+
+
+def _relative_change(error, optics):
+    """ Convergence measure of each (wavelength, distribution) pair: the
+    change of Bext, Bsca and Babs relative to Bext, of Bback relative to
+    itself (it is a small part of Bext) and of G (already relative).
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.max([error['Bext'] / np.abs(optics['Bext']),
+                       error['Bsca'] / np.abs(optics['Bext']),
+                       error['Babs'] / np.abs(optics['Bext']),
+                       error['Bback'] / np.abs(optics['Bback']),
+                       error['G']], axis=0)
+
+
+@mie_profile.staged('quadrature')
+def quadrature_mie_lognormal(
+        m, wavelength, geo_std_dev, geo_mean, number_of_particles,
+        n_medium=1.0, tolerance=1e-3, min_nodes=8, max_nodes=256):
+    """ Lognormal optics by Gauss-Hermite quadrature in ln(Dp).
+
+    Same outputs as kernel_mie_lognormal, but the distribution is not
+    binned or truncated: the lognormal is integrated with n Gauss-Hermite
+    nodes, and n is doubled from min_nodes until the change of Bext, Bsca
+    and Babs (relative to Bext), of Bback (relative to Bback) and of G is
+    below tolerance; Bpr and Bratio are not checked. Each mode and
+    wavelength stops on its own. Modes small against the wavelength
+    converge in a few doublings, though counting every level the Mie
+    calls are only about 3x fewer than a full bin sum; the gain is mostly
+    no upper cutoff and no bin count to choose. Modes much larger than the
+    wavelength converge slowly, as Q oscillates in ln(Dp), and weakly
+    absorbing ones stop unconverged at max_nodes (hermgauss is not
+    accurate much beyond 256 nodes); check info['converged']. Nodes far
+    in the tail that carry less than 1e-3 * tolerance of the cross section
+    are skipped.
+
+    Returns (optics, info), both with entries (n_modes, n_wavelength).
+    info holds error (the absolute change of each output over the last
+    doubling, which estimates the error of the coarser level and is
+    usually pessimistic for the returned one), relative_error, nodes,
+    converged, and mie_calls (total single particle evaluations, all
+    levels).
+
+    The asymmetry parameter is under 'G', as in ps.Mie_SD(asDict=True) and
+    MieKernel.optics; ps.Mie_Lognormal(asDict=True) calls it 'bigG'.
+    """
+    wavelength = np.atleast_1d(np.asarray(wavelength, dtype=float))
+    geo_mean, geo_std_dev, number_of_particles = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(geo_mean, dtype=float)),
+        np.atleast_1d(np.asarray(geo_std_dev, dtype=float)),
+        np.atleast_1d(np.asarray(number_of_particles, dtype=float)))
+    shape = (geo_mean.size, wavelength.size)
+    pairs = [np.broadcast_to(value, shape).ravel() for value in (
+        wavelength[None, :], geo_mean[:, None], geo_std_dev[:, None],
+        number_of_particles[:, None])]
+
+    # nodes carrying less than this share of the cross section are dropped
+    cutoff = 1e-3 * tolerance
+    n_nodes = min_nodes
+    previous, mie_calls = _quadrature_optics(
+        m, *pairs, n_medium, n_nodes, cutoff)
+    optics = {key: value.copy() for key, value in previous.items()}
+    error = {key: np.full(value.size, np.inf)
+             for key, value in previous.items()}
+    nodes = np.full(geo_mean.size * wavelength.size, n_nodes)
+    active = np.arange(nodes.size)
+    while active.size and n_nodes * 2 <= max_nodes:
+        n_nodes *= 2
+        level, calls = _quadrature_optics(
+            m, *[value[active] for value in pairs], n_medium, n_nodes,
+            cutoff)
+        mie_calls += calls
+        for key in optics:
+            error[key][active] = np.abs(level[key] - previous[key])
+            optics[key][active] = level[key]
+        nodes[active] = n_nodes
+        change = np.nan_to_num(_relative_change(
+            {key: value[active] for key, value in error.items()}, level))
+        keep = change > tolerance
+        active = active[keep]
+        previous = {key: value[keep] for key, value in level.items()}
+
+    relative_error = np.nan_to_num(_relative_change(error, optics),
+                                   nan=np.inf)
+    info = dict(error={key: value.reshape(shape)
+                       for key, value in error.items()},
+                relative_error=relative_error.reshape(shape),
+                nodes=nodes.reshape(shape),
+                converged=(relative_error <= tolerance).reshape(shape),
+                mie_calls=int(mie_calls))
+    return {key: value.reshape(shape) for key, value in optics.items()}, info
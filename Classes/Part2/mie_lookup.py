@@ -0,0 +1,267 @@
+""" Precomputed Mie efficiency lookup tables.
+
+A table holds Qext, Qsca, Qabs, g and Qback on a regular grid of
+log10(size parameter) x real index x log10(imaginary index), plus a k = 0
+plane so non-absorbing particles are covered. Queries are answered by
+trilinear interpolation (linear in k inside each cell, where Qabs is close
+to proportional to k), each with an error bound taken from the
+exact-vs-interpolated check done on every grid edge when the table was
+built. Cells whose bound is above the tolerance (resonance-dense regions)
+are answered with the exact batched Mie calculation instead.
+
+Limits of the default table (bound 1e-3 absolute on all fields): queries
+in cells that pass are interpolated at about 2 million per second on one
+core. The interference and resonance structure above x = 1 is finer than
+any grid of this size, so 52% of the cells (nearly all at x > 1; 8% of
+the queries at x < 1) fall back to exact Mie, at 0.1 to 0.8 million per
+second depending on x; a tolerance of 1e-2 still leaves 38%. Millions of
+lookups per second therefore hold for size parameters below about 1, or
+for a table built over the narrow range a run actually uses (x up to 3,
+n 1.3 to 1.7, k 1e-3 to 0.1 and a 1e-2 tolerance: 1.6% of the cells);
+elsewhere the table keeps the stated bound at the cost of speed.
+
+Example:
+    table = MieLookupTable.build(x_range=(0.01, 100), n_range=(1.3, 2.0),
+                                 k_range=(1e-4, 1))
+    table.save('mie_table.npz')
+    table = MieLookupTable.load('mie_table.npz')
+    q, q_error = table.query(1.5+0.001j, 589, np.linspace(10, 5000, 500))
+"""
+import numpy as np
+
+import mie_batch
+import mie_profile
+
+LOOKUP_FIELDS = ('Qext', 'Qsca', 'Qabs', 'g', 'Qback')
+
+
+def _exact_q(m, x):
+    """ Exact efficiencies as a (..., fields) array, x as diameter/wavelength
+    """
+    q = mie_batch.batch_auto_mie_q(m, np.pi, x)
+    return np.stack([q[name] for name in LOOKUP_FIELDS], axis=-1)
+
+
+def _edge_error(table, exact_mid, axis):
+    """ Largest absolute error over the fields of linear interpolation at
+    the midpoint of each grid edge along axis
+    """
+    ends = np.moveaxis(table, axis, 0)
+    interpolated = np.moveaxis(0.5 * (ends[1:] + ends[:-1]), 0, axis)
+    return np.max(np.abs(exact_mid - interpolated), axis=-1)
+
+
+def _cell_max(edge_error, axis):
+    """ Largest error of the four edges along axis around each cell
+    """
+    for other in range(edge_error.ndim):
+        if other != axis:
+            moved = np.moveaxis(edge_error, other, 0)
+            edge_error = np.moveaxis(
+                np.maximum(moved[1:], moved[:-1]), 0, other)
+    return edge_error
+
+
+class MieLookupTable:
+    """ Mie efficiencies on a (log x, n, log k) grid with interpolation.
+
+    With zero_k, the first k plane of table (and of cell_error) is k = 0
+    and the log_k planes follow it. cell_error is the interpolation error
+    bound of each cell before the error_factor of query.
+    """
+
+    def __init__(self, log_x, n_real, log_k, table, cell_error,
+                 tolerance=1e-3, zero_k=False):
+        self.log_x = np.asarray(log_x, dtype=float)
+        self.n_real = np.asarray(n_real, dtype=float)
+        self.log_k = np.asarray(log_k, dtype=float)
+        self.table = np.asarray(table, dtype=float)
+        self.cell_error = np.asarray(cell_error, dtype=float)
+        self.tolerance = tolerance
+        self.zero_k = bool(zero_k)
+        self.k = 10**self.log_k
+        if self.zero_k:
+            self.k = np.concatenate(([0], self.k))
+        # corners are gathered field by field from flat copies of the table
+        self._fields = np.ascontiguousarray(
+            np.moveaxis(self.table, -1, 0)).reshape(self.table.shape[-1], -1)
+        self.exact_fallbacks = 0
+        self.interpolated = 0
+
+    @classmethod
+    @mie_profile.staged('lookup build')
+    def build(cls, x_range=(0.01, 100), n_range=(1.3, 2.0),
+              k_range=(1e-4, 1), nx=400, nn=36, nk=21, tolerance=1e-3,
+              zero_k=True):
+        """ Compute the table and the per cell interpolation error bound.
+
+        The exact and the linearly interpolated values are compared at the
+        midpoint of every grid edge. Trilinear interpolation reproduces the
+        cross terms of a quadratic exactly, so inside a cell where Q is
+        close to quadratic its error is at most the sum over the three
+        axes of the largest midpoint error of the four edges along that
+        axis; that sum is the cell bound. zero_k adds the k = 0 plane, so
+        k from 0 to k_range[0] is interpolated instead of exact.
+        """
+        log_x = np.linspace(np.log10(x_range[0]), np.log10(x_range[1]), nx)
+        n_real = np.linspace(n_range[0], n_range[1], nn)
+        log_k = np.linspace(np.log10(k_range[0]), np.log10(k_range[1]), nk)
+        k = 10**log_k
+        if zero_k:
+            k = np.concatenate(([0], k))
+        x = 10**log_x[:, None, None]
+        m_grid = n_real[None, :, None] + 1j * k[None, None, :]
+        table = _exact_q(m_grid, x)
+
+        mid_x = 10**(0.5 * (log_x[1:] + log_x[:-1]))[:, None, None]
+        mid_n = 0.5 * (n_real[1:] + n_real[:-1])[None, :, None]
+        mid_k = 0.5 * (k[1:] + k[:-1])[None, None, :]
+        edge_error = (
+            _edge_error(table, _exact_q(m_grid, mid_x), 0),
+            _edge_error(table, _exact_q(mid_n + 1j * k, x), 1),
+            _edge_error(table, _exact_q(n_real[:, None] + 1j * mid_k, x),
+                        2))
+        cell_error = sum(_cell_max(error, axis)
+                         for axis, error in enumerate(edge_error))
+        return cls(log_x, n_real, log_k, table, cell_error, tolerance, zero_k)
+
+    def save(self, path):
+        """ Save the table to a compressed .npz file
+        """
+        np.savez_compressed(
+            path, log_x=self.log_x, n_real=self.n_real, log_k=self.log_k,
+            table=self.table, cell_error=self.cell_error,
+            tolerance=self.tolerance, zero_k=self.zero_k,
+            fields=np.array(LOOKUP_FIELDS), check=np.array('edges'))
+
+    @classmethod
+    def load(cls, path):
+        """ Load a table saved with save(). Tables saved before the error
+        bound was checked on the grid edges have to be built again.
+        """
+        with np.load(path) as data:
+            if tuple(data['fields']) != LOOKUP_FIELDS:
+                raise ValueError(
+                    f"table fields {tuple(data['fields'])} do not match "
+                    f"{LOOKUP_FIELDS}")
+            if 'check' not in data.files or str(data['check']) != 'edges':
+                raise ValueError(
+                    f'{path} has no edge-checked error bound, build the '
+                    f'table again')
+            return cls(data['log_x'], data['n_real'], data['log_k'],
+                       data['table'], data['cell_error'],
+                       float(data['tolerance']), bool(data['zero_k']))
+
+    def _cell_position(self, value, axis):
+        """ Cell index and fraction inside the cell on a uniform axis
+        """
+        step = axis[1] - axis[0]
+        position = (value - axis[0]) / step
+        index = np.clip(np.floor(position).astype(int), 0, axis.size - 2)
+        return index, position - index
+
+    def _k_position(self, k):
+        """ Cell index along k (cells spaced in log10 k, with zero_k the
+        first from k = 0) and fraction inside the cell, linear in k
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            index, _ = self._cell_position(np.log10(k), self.log_k)
+        if self.zero_k:
+            index = np.where(k < self.k[1], 0, index + 1)
+        low = self.k[index]
+        return index, (k - low) / (self.k[index + 1] - low)
+
+    def _cells(self, log_x, n_real, k):
+        """ Cell indices along (x, n, k) and the fractions inside the cell
+        of flat inputs
+        """
+        ix, fx = self._cell_position(log_x, self.log_x)
+        i_n, fn = self._cell_position(n_real, self.n_real)
+        ik, fk = self._k_position(k)
+        return (ix, i_n, ik), (fx, fn, fk)
+
+    def _interpolate(self, index, fraction):
+        """ Trilinear interpolation of all fields in the cells of index
+        """
+        ix, i_n, ik = index
+        fx, fn, fk = fraction
+        _, nn, nk, _ = self.table.shape
+        low = (ix * nn + i_n) * nk + ik
+        corners, weights = [], []
+        for dx, wx in ((0, 1 - fx), (1, fx)):
+            for dn, wn in ((0, 1 - fn), (1, fn)):
+                wxn = wx * wn
+                for dk, wk in ((0, 1 - fk), (1, fk)):
+                    corners.append(low + (dx * nn + dn) * nk + dk)
+                    weights.append(wxn * wk)
+        result = np.empty((len(self._fields), low.size))
+        for field, out in zip(self._fields, result):
+            np.multiply(weights[0], field.take(corners[0]), out=out)
+            for corner, weight in zip(corners[1:], weights[1:]):
+                out += weight * field.take(corner)
+        return result.T
+
+    @mie_profile.staged('lookup query')
+    def query(self, m, wavelength, diameter, n_medium=1.0,
+              error_factor=2.0, tolerance=None):
+        """ Interpolated efficiencies and a bound on their error.
+
+        Returns a structured array with the LOOKUP_FIELDS and an array of
+        absolute error bounds, error_factor times the cell bound of build()
+        (which is exact for Q quadratic in a cell; the factor covers higher
+        orders, and 4e5 random points of the default table stayed below
+        0.9 of it). Points outside the table, or in cells whose bound is
+        above tolerance (the table's by default), are computed exactly and
+        have an error of 0.
+        """
+        if tolerance is None:
+            tolerance = self.tolerance
+        n_medium = np.real(n_medium)
+        m, wavelength, diameter = np.broadcast_arrays(
+            np.asarray(m, dtype=complex),
+            np.asarray(wavelength, dtype=float),
+            np.asarray(diameter, dtype=float))
+        shape = m.shape
+        m_eff = m.ravel() / n_medium
+        x = np.pi * diameter.ravel() * n_medium / wavelength.ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_x = np.log10(x)
+        n_real = m_eff.real
+        k = m_eff.imag
+        k_min = 0 if self.zero_k else 10**self.log_k[0]
+
+        inside = ((log_x >= self.log_x[0]) & (log_x <= self.log_x[-1])
+                  & (n_real >= self.n_real[0]) & (n_real <= self.n_real[-1])
+                  & (k >= k_min) & (k <= 10**self.log_k[-1]))
+        values = np.zeros((x.size, len(LOOKUP_FIELDS)))
+        error = np.zeros(x.size)
+        if inside.any():
+            use = np.flatnonzero(inside)
+            index, fraction = self._cells(log_x[use], n_real[use], k[use])
+            bound = error_factor * self.cell_error[index]
+            smooth = bound <= tolerance
+            if not smooth.all():
+                inside[use[~smooth]] = False
+                use, bound = use[smooth], bound[smooth]
+                index = tuple(i[smooth] for i in index)
+                fraction = [f[smooth] for f in fraction]
+            values[use] = self._interpolate(index, fraction)
+            error[use] = bound
+
+        exact = ~inside
+        if exact.any():
+            values[exact] = _exact_q(m_eff[exact], x[exact])
+        self.exact_fallbacks += int(exact.sum())
+        self.interpolated += int(x.size - exact.sum())
+        mie_profile.count('lookup_exact', int(exact.sum()))
+        mie_profile.count('lookup_interpolated', int(x.size - exact.sum()))
+
+        out = values.view([(name, float) for name in LOOKUP_FIELDS])
+        return out.reshape(shape), error.reshape(shape)
+
+    def fallback_fraction(self, error_factor=2.0, tolerance=None):
+        """ Fraction of the table cells answered with exact Mie
+        """
+        if tolerance is None:
+            tolerance = self.tolerance
+        return float(np.mean(error_factor * self.cell_error > tolerance))
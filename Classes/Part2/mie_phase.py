@@ -0,0 +1,200 @@
+""" Batched scattering (phase) functions with cached angular functions.
+
+`ps.ScatteringFunction` recomputes the angular functions pi_n and tau_n for
+every particle and every angle. Here they are computed once per
+(angle grid, maximum order), cached, and the amplitudes S1, S2 of a whole
+array of diameters are two matrix products with the padded Mie coefficients.
+
+Example:
+    theta, SL, SR, SU = batch_scattering_function(
+        1.5+0.001j, 589, np.linspace(50, 2000, 10000))
+    theta, SL, SR, SU = sf_sd(1.5+0.001j, 589, dp, ndp)
+    moments = legendre_moments(theta, SU, 32) # moments[1] is g
+"""
+import numpy as np
+from numpy.polynomial import legendre
+from scipy.integrate import trapezoid
+
+import mie_batch
+import mie_profile
+
+# angle grid -> (pi_n, tau_n) up to the largest order asked for so far
+_ANGULAR_CACHE = {}
+CACHE_STATS = {'hits': 0, 'misses': 0}
+
+
+def mie_pi_tau(mu, nmax):
+    """ Angular functions pi_n(mu), tau_n(mu), shape (nmax, len(mu)).
+
+    Cached per angle grid. A request for fewer orders than already cached
+    is a slice of the cached arrays.
+    """
+    mu = np.asarray(mu, dtype=float)
+    key = (mu.size, mu.tobytes())
+    cached = _ANGULAR_CACHE.get(key)
+    if cached is not None and cached[0].shape[0] >= nmax:
+        CACHE_STATS['hits'] += 1
+        return cached[0][:nmax], cached[1][:nmax]
+    CACHE_STATS['misses'] += 1
+    size = max(nmax, 2)
+    p = np.zeros((size, mu.size))
+    t = np.zeros((size, mu.size))
+    p[0] = 1
+    p[1] = 3 * mu
+    t[0] = mu
+    t[1] = 3.0 * np.cos(2 * np.arccos(mu))
+    for n in range(2, size):
+        p[n] = ((2 * n + 1) * (mu * p[n - 1]) - (n + 1) * p[n - 2]) / n
+        t[n] = (n + 1) * mu * p[n] - (n + 2) * p[n - 1]
+    _ANGULAR_CACHE[key] = (p, t)
+    return p[:nmax], t[:nmax]
+
+
+def clear_angular_cache():
+    """ Drop the cached angular functions
+    """
+    _ANGULAR_CACHE.clear()
+
+
+def _low_frequency_ab(m, x):
+    """ Two term Mie coefficients for x < 0.5 (B&H page 131), as PyMieScatt
+    """
+    m2 = m**2
+    lorentz_lorenz = (m2 - 1) / (m2 + 2)
+    a1 = ((-2j * x**3 / 3) * lorentz_lorenz
+          - (2j * x**5 / 5) * lorentz_lorenz * (m2 - 2) / (m2 + 2)
+          + (4 * x**6 / 9) * lorentz_lorenz**2)
+    a2 = (-1j * x**5 / 15) * (m2 - 1) / (2 * m2 + 3)
+    b1 = (-1j * x**5 / 45) * (m2 - 1)
+    an = np.stack((a1, a2), axis=1)
+    bn = np.stack((b1, np.zeros_like(b1)), axis=1)
+    return an, bn
+
+
+def batch_s1_s2(m, x, mu, chunk_size=2048):
+    """ Amplitude functions S1, S2 with shape (len(x), len(mu)).
+
+    Uses the same coefficients as ps.MieS1S2: the two term low frequency
+    form below x = 0.5 and the full series above.
+    """
+    m, x = np.broadcast_arrays(np.asarray(m, dtype=complex).ravel(),
+                               np.asarray(x, dtype=float).ravel())
+    mu = np.asarray(mu, dtype=float)
+    S1 = np.zeros((x.size, mu.size), dtype=complex)
+    S2 = np.zeros((x.size, mu.size), dtype=complex)
+
+    low = np.flatnonzero((x > 0) & (x < 0.5))
+    if low.size:
+        an, bn = _low_frequency_ab(m[low], x[low])
+        _add_s1_s2(an, bn, mu, S1, S2, low)
+
+    order = np.flatnonzero(x >= 0.5)
+    order = order[np.argsort(x[order], kind='stable')]
+    for start in range(0, order.size, chunk_size):
+        index = order[start:start + chunk_size]
+        an, bn, _ = mie_batch.batch_mie_ab(m[index], x[index])
+        _add_s1_s2(an, bn, mu, S1, S2, index)
+    return S1, S2
+
+
+def _add_s1_s2(an, bn, mu, S1, S2, index):
+    """ S1, S2 rows of index from padded an, bn (B&H eq. 4.74)
+    """
+    n = np.arange(1, an.shape[1] + 1)
+    n2 = (2 * n + 1) / (n * (n + 1))
+    pin, taun = mie_pi_tau(mu, an.shape[1])
+    an = an * n2
+    bn = bn * n2
+    S1[index] = an @ pin + bn @ taun
+    S2[index] = an @ taun + bn @ pin
+
+
+def _angle_grid(min_angle, max_angle, angular_resolution, angle_measure):
+    """ Scattering angles in radians and in the requested measure
+    """
+    steps = int(1 + (max_angle - min_angle) / angular_resolution)
+    theta = np.linspace(min_angle, max_angle, steps) * np.pi / 180
+    if angle_measure in ['radians', 'RADIANS', 'rad', 'RAD']:
+        adjust = np.pi / 180
+    elif angle_measure in ['gradians', 'GRADIANS', 'grad', 'GRAD']:
+        adjust = 1 / 200
+    else:
+        adjust = 1
+    return theta, np.linspace(min_angle, max_angle, steps) * adjust
+
+
+@mie_profile.staged('scattering function')
+def batch_scattering_function(
+        m, wavelength, diameter, n_medium=1.0, min_angle=0, max_angle=180,
+        angular_resolution=0.5, angle_measure='radians'):
+    """ ps.ScatteringFunction for an array of diameters at once.
+
+    Returns measure, SL, SR, SU with SL, SR, SU of shape
+    (len(diameter), n_angles). Only the 'theta' space of PyMieScatt.
+    """
+    n_medium = np.real(n_medium)
+    diameter = np.atleast_1d(np.asarray(diameter, dtype=float))
+    x = np.pi * diameter * n_medium / wavelength
+    theta, measure = _angle_grid(
+        min_angle, max_angle, angular_resolution, angle_measure)
+    S1, S2 = batch_s1_s2(np.asarray(m) / n_medium, x, np.cos(theta))
+    SL = np.abs(S1)**2
+    SR = np.abs(S2)**2
+    return measure, SL, SR, (SL + SR) / 2
+
+
+@mie_profile.staged('distribution integration')
+def sf_sd(m, wavelength, dp, ndp, n_medium=1.0, min_angle=0, max_angle=180,
+          angular_resolution=0.5, angle_measure='radians',
+          normalization=None):
+    """ Distribution weighted scattering function, like ps.SF_SD.
+
+    normalization: None, 'number' (divide by the trapezoid integral of
+    ndp over dp, as SF_SD), 'max' or 'total'.
+    """
+    dp = np.asarray(dp, dtype=float)
+    ndp = np.asarray(ndp, dtype=float)
+    measure, SL, SR, SU = batch_scattering_function(
+        m, wavelength, dp, n_medium=n_medium, min_angle=min_angle,
+        max_angle=max_angle, angular_resolution=angular_resolution,
+        angle_measure=angle_measure)
+    SL, SR, SU = ndp @ SL, ndp @ SR, ndp @ SU
+    if normalization in ['n', 'N', 'number', 'particles']:
+        total = trapezoid(ndp, dp)
+        SL, SR, SU = SL / total, SR / total, SU / total
+    elif normalization in ['m', 'M', 'max', 'MAX']:
+        SL, SR, SU = SL / SL.max(), SR / SR.max(), SU / SU.max()
+    elif normalization in ['t', 'T', 'total', 'TOTAL']:
+        SL = SL / trapezoid(SL, measure)
+        SR = SR / trapezoid(SR, measure)
+        SU = SU / trapezoid(SU, measure)
+    return measure, SL, SR, SU
+
+
+def phase_matrix(S1, S2):
+    """ Phase matrix elements S11, S12, S33, S34 (B&H eq. 4.77)
+    """
+    S11 = 0.5 * (np.abs(S2)**2 + np.abs(S1)**2)
+    S12 = 0.5 * (np.abs(S2)**2 - np.abs(S1)**2)
+    S33 = (np.conj(S2) * S1).real
+    S34 = (S2 * np.conj(S1)).imag
+    return S11, S12, S33, S34
+
+
+def legendre_moments(theta, phase_function, n_moments):
+    """ Legendre moments of a phase function on a theta grid (radians).
+
+    The phase function is normalized so moment 0 is 1, moment 1 is the
+    asymmetry parameter g. Works on the last axis, so a (n, n_angles)
+    array gives (n, n_moments + 1) moments.
+    """
+    mu = np.cos(theta)
+    phase_function = np.asarray(phase_function, dtype=float)
+    vander = legendre.legvander(mu, n_moments)
+    # integrate over mu = cos(theta), d mu = sin(theta) d theta
+    weight = np.sin(theta)
+    norm = trapezoid(phase_function * weight, theta, axis=-1)
+    moments = trapezoid(
+        phase_function[..., None, :] * (vander.T * weight),
+        theta, axis=-1)
+    return moments / norm[..., None]
@@ -0,0 +1,411 @@
+""" Opt-in profiling of the Mie and aerosol dynamics calculations.
+
+Lec_Mie_pythonCells gives no view of where a Mie_Lognormal or Mie_SD sweep
+spends its time: how many AutoMieQ / MieQ calls it makes, at which size
+parameters and series lengths, and how much of it goes to building
+kernels versus integrating distributions; the same holds for the Rates /
+Solver steps of the condensation notebook. The modules here (mie_batch,
+mie_kernel, mie_lookup, mie_phase, mie_sweep, humidified_optics,
+aerosol_dynamics) call the hooks of this module, which do nothing but
+check a module global unless a profile is running. Inside
+
+    with mie_profile.profile() as prof:
+        ...
+
+they collect
+
+- counters (Mie points and series terms, Rayleigh points, lookup table
+  exact fallbacks, accepted and rejected time steps, ...),
+- histograms of the size parameter, wavelength and diameter (log bins,
+  per_decade per decade, each with the count and the summed series
+  length, i.e. the work) and of the series order,
+- the time of each stage (kernel build, distribution integration, time
+  step, ...) by call path, with its own time and that of the stages
+  inside it,
+- the hits and misses of every module cache (a module level CACHE_STATS)
+  during the profile.
+
+pymiescatt=True also wraps PyMieScatt's MieQ, AutoMieQ, Mie_SD and
+Mie_Lognormal while the profile runs, so the calls of the notebook's own
+loops are counted. A run_sweep inside a profile profiles its workers and
+adds their results. `Profile.save_json` writes everything as JSON and
+`Profile.save_folded` the stage times in the folded stack format of
+flamegraph.pl and speedscope (one 'a;b;c microseconds' line per path).
+
+Example:
+    with mie_profile.profile(pymiescatt=True) as prof:
+        ps.Mie_Lognormal(1.5+0.001j, 532, 1.7, 200, 1e5)
+        MieKernel(1.5+0.001j, wavelength, dp).optics(ndp)
+    print(prof.report())
+    prof.counters['MieQ'], prof.histogram('size_parameter')
+    prof.save_json('mie_profile.json')
+    prof.save_folded('mie_profile.folded')  # flamegraph.pl, speedscope
+"""
+import functools
+import json
+import math
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+_ACTIVE = None
+_NULL = nullcontext()
+
+
+def _cache_stats():
+    """ (hits, misses) of each loaded module with a CACHE_STATS dict
+    """
+    stats = {}
+    for name, module in list(sys.modules.items()):
+        cache = None if module is None else vars(module).get('CACHE_STATS')
+        if isinstance(cache, dict) and 'hits' in cache:
+            stats[name] = (cache['hits'], cache['misses'])
+    return stats
+
+
+class Profile:
+    """ Counters, histograms, stage times and cache statistics of one
+    profile (see the module docstring)
+    """
+
+    def __init__(self, name='profile'):
+        self.name = name
+        self.counters = {}
+        self.histograms = {}
+        # call path (tuple of stage names) -> [calls, seconds]
+        self.stages = {}
+        self.caches = {}
+        self._stack = []
+        self._start = None
+        self._stop = None
+        self._cache_start = {}
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._cache_start = _cache_stats()
+        return self
+
+    def stop(self):
+        self._stop = time.perf_counter()
+        self.caches = self._cache_delta()
+        return self
+
+    def wall_time(self):
+        if self._start is None:
+            return 0.0
+        return (self._stop or time.perf_counter()) - self._start
+
+    def _cache_delta(self):
+        caches = {name: dict(entry) for name, entry in self.caches.items()}
+        for name, (hits, misses) in _cache_stats().items():
+            hits0, misses0 = self._cache_start.get(name, (0, 0))
+            entry = caches.setdefault(name, dict(hits=0, misses=0))
+            entry['hits'] += hits - hits0
+            entry['misses'] += misses - misses0
+        return {name: entry for name, entry in caches.items()
+                if entry['hits'] or entry['misses']}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add(self, name, values, weights=None, per_decade=10):
+        """ Add values to histogram name, with per_decade log bins per
+        decade (None: unit bins) and optional weights summed per bin
+        """
+        histogram = self.histograms.setdefault(
+            name, dict(per_decade=per_decade, bins={}))
+        bins = histogram['bins']
+        if np.ndim(values) == 0:
+            if not values > 0 and per_decade:
+                return
+            key = math.floor(math.log10(values) * per_decade if per_decade
+                             else values)
+            entry = bins.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += 1.0 if weights is None else float(weights)
+            return
+        values = np.asarray(values, dtype=float).ravel()
+        weights = (np.ones(values.size) if weights is None else
+                   np.broadcast_to(np.asarray(weights, dtype=float),
+                                   values.shape))
+        keep = values > 0 if per_decade else np.isfinite(values)
+        values = values[keep]
+        index = np.floor(np.log10(values) * per_decade if per_decade
+                         else values).astype(np.int64)
+        keys, inverse = np.unique(index, return_inverse=True)
+        counts = np.bincount(inverse, minlength=keys.size)
+        sums = np.bincount(inverse, weights[keep], minlength=keys.size)
+        for key, n, total in zip(keys.tolist(), counts.tolist(),
+                                 sums.tolist()):
+            entry = bins.setdefault(key, [0, 0.0])
+            entry[0] += n
+            entry[1] += total
+
+    def histogram(self, name):
+        """ Bins of histogram name as a structured array: low, high,
+        count, weight
+        """
+        histogram = self.histograms.get(name, dict(per_decade=None, bins={}))
+        per_decade = histogram['per_decade']
+        keys = np.array(sorted(histogram['bins']), dtype=float)
+        out = np.zeros(keys.size, dtype=[('low', float), ('high', float),
+                                         ('count', np.int64),
+                                         ('weight', float)])
+        if per_decade:
+            out['low'] = 10**(keys / per_decade)
+            out['high'] = 10**((keys + 1) / per_decade)
+        else:
+            out['low'], out['high'] = keys, keys + 1
+        out['count'] = [histogram['bins'][key][0] for key in sorted(
+            histogram['bins'])]
+        out['weight'] = [histogram['bins'][key][1] for key in sorted(
+            histogram['bins'])]
+        return out
+
+    def _enter(self, name):
+        self._stack.append(name)
+        return time.perf_counter()
+
+    def _exit(self, start):
+        entry = self.stages.setdefault(tuple(self._stack), [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.perf_counter() - start
+        self._stack.pop()
+
+    @contextmanager
+    def stage(self, name):
+        start = self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit(start)
+
+    def stage_table(self):
+        """ One row per call path: path, calls, total and self seconds
+        (total less the stages inside), longest self time first
+        """
+        children = {}
+        for path, (_, total) in self.stages.items():
+            children[path[:-1]] = children.get(path[:-1], 0.0) + total
+        rows = [dict(path=list(path), calls=calls, total=total,
+                     self=max(total - children.get(path, 0.0), 0.0))
+                for path, (calls, total) in self.stages.items()]
+        return sorted(rows, key=lambda row: -row['self'])
+
+    def to_dict(self):
+        caches = self._cache_delta() if self._stop is None else self.caches
+        for entry in caches.values():
+            lookups = entry['hits'] + entry['misses']
+            entry['hit_rate'] = entry['hits'] / lookups if lookups else None
+        return dict(
+            name=self.name, wall_time=self.wall_time(),
+            counters=dict(self.counters),
+            histograms={name: dict(per_decade=histogram['per_decade'],
+                                   bins=[[key] + entry for key, entry in
+                                         sorted(histogram['bins'].items())])
+                        for name, histogram in self.histograms.items()},
+            stages=self.stage_table(), caches=caches)
+
+    def merge(self, data, prefix=None):
+        """ Add a profile (to_dict output, e.g. from a worker process);
+        its stages go under prefix (default: the current stage path)
+        """
+        prefix = tuple(self._stack if prefix is None else prefix)
+        for name, n in data['counters'].items():
+            self.count(name, n)
+        for name, histogram in data['histograms'].items():
+            bins = self.histograms.setdefault(name, dict(
+                per_decade=histogram['per_decade'], bins={}))['bins']
+            for key, n, total in histogram['bins']:
+                entry = bins.setdefault(key, [0, 0.0])
+                entry[0] += n
+                entry[1] += total
+        for row in data['stages']:
+            entry = self.stages.setdefault(prefix + tuple(row['path']),
+                                           [0, 0.0])
+            entry[0] += row['calls']
+            entry[1] += row['total']
+        for name, entry in data['caches'].items():
+            mine = self.caches.setdefault(name, dict(hits=0, misses=0))
+            mine['hits'] += entry['hits']
+            mine['misses'] += entry['misses']
+
+    def save_json(self, path):
+        with open(path, 'w') as handle:
+            json.dump(self.to_dict(), handle, indent=1)
+
+    def folded(self):
+        """ Stage self times in microseconds as folded stack lines, under
+        the profile name (whose own time is the time outside all stages)
+        """
+        rows = self.stage_table()
+        outside = self.wall_time() - sum(row['total'] for row in rows
+                                         if len(row['path']) == 1)
+        lines = ['{} {}'.format(self.name, int(round(max(outside, 0) * 1e6)))]
+        lines += ['{} {}'.format(';'.join([self.name] + row['path']),
+                                 int(round(row['self'] * 1e6)))
+                  for row in rows]
+        return '\n'.join(lines) + '\n'
+
+    def save_folded(self, path):
+        with open(path, 'w') as handle:
+            handle.write(self.folded())
+
+    def report(self, n_stages=15):
+        """ Text summary: stages by self time, counters, the size
+        parameter decades with the most work and cache hit rates
+        """
+        lines = ['{}: {:.3f} s'.format(self.name, self.wall_time()),
+                 '{:>10} {:>10} {:>8}  stage'.format('self s', 'total s',
+                                                     'calls')]
+        for row in self.stage_table()[:n_stages]:
+            lines.append('{:10.4f} {:10.4f} {:8d}  {}'.format(
+                row['self'], row['total'], row['calls'],
+                ' > '.join(row['path'])))
+        for name, n in sorted(self.counters.items()):
+            lines.append('{:>28}: {}'.format(name, n))
+        if 'size_parameter' in self.histograms:
+            bins = self.histogram('size_parameter')
+            decades = np.floor(np.log10(bins['low']) + 1e-9)
+            total = bins['weight'].sum()
+            lines.append('series terms by size parameter decade:')
+            for decade in np.unique(decades):
+                share = bins['weight'][decades == decade].sum() / total
+                lines.append('    x in [1e{:.0f}, 1e{:.0f}): {:6.1%}'.format(
+                    decade, decade + 1, share))
+        for name, entry in sorted(self.to_dict()['caches'].items()):
+            # hit_rate is None for a cache that was never looked up
+            rate = ('n/a' if entry['hit_rate'] is None
+                    else '{:.1%}'.format(entry['hit_rate']))
+            lines.append('cache {}: {} hits, {} misses ({})'.format(
+                name, entry['hits'], entry['misses'], rate))
+        return '\n'.join(lines)
+
+
+def enabled():
+    return _ACTIVE is not None
+
+
+def count(name, n=1):
+    if _ACTIVE is not None:
+        _ACTIVE.count(name, n)
+
+
+def histogram(name, values, weights=None, per_decade=10):
+    if _ACTIVE is not None:
+        _ACTIVE.add(name, values, weights, per_decade)
+
+
+def merge(data):
+    """ Add a profile's to_dict output (e.g. from a worker process) to
+    the running profile, under the current stage
+    """
+    if _ACTIVE is not None:
+        _ACTIVE.merge(data)
+
+
+def record_series(x, nmax):
+    """ Mie series solved at size parameters x with nmax terms each
+    """
+    if _ACTIVE is not None:
+        _ACTIVE.count('mie_points', int(np.size(x)))
+        _ACTIVE.count('mie_terms', int(np.sum(nmax)))
+        _ACTIVE.add('size_parameter', x, nmax)
+        _ACTIVE.add('series_order', nmax, per_decade=None)
+
+
+def stage(name):
+    """ Context manager timing a stage, a no-op without a profile
+    """
+    if _ACTIVE is None:
+        return _NULL
+    return _ACTIVE.stage(name)
+
+
+def staged(name):
+    """ Decorator timing each call of a function as stage name
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            active = _ACTIVE
+            if active is None:
+                return function(*args, **kwargs)
+            start = active._enter(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                active._exit(start)
+        return wrapper
+    return decorate
+
+
+def _counted_mie_q(function):
+    @functools.wraps(function)
+    def wrapper(m, wavelength, diameter, nMedium=1.0, *args, **kwargs):
+        if _ACTIVE is not None:
+            _ACTIVE.count('MieQ')
+            x = np.pi * diameter * np.real(nMedium) / wavelength
+            if x < 0.05:
+                _ACTIVE.count('rayleigh_points')
+            elif x > 0:
+                terms = 2 + x + 4 * x**(1 / 3)
+                record_series(x, int(round(terms)))
+                _ACTIVE.add('wavelength', wavelength, terms, 100)
+                _ACTIVE.add('diameter', diameter, terms, 100)
+        return function(m, wavelength, diameter, nMedium, *args, **kwargs)
+    return wrapper
+
+
+def _patch_pymiescatt():
+    """ Wrap PyMieScatt's Mie functions, in its Mie module (where
+    Mie_Lognormal finds them) and its package namespace; returns the undo
+    list
+    """
+    import PyMieScatt
+    import PyMieScatt.Mie
+    undo = []
+    for module in (PyMieScatt.Mie, PyMieScatt):
+        for name in ('MieQ', 'AutoMieQ', 'Mie_SD', 'Mie_Lognormal'):
+            original = vars(module).get(name)
+            if original is None or getattr(original, '_mie_profile', False):
+                continue
+            counted = (_counted_mie_q(original) if name == 'MieQ'
+                       else _counted(name)(original))
+            wrapped = staged(name)(counted)
+            wrapped._mie_profile = True
+            setattr(module, name, wrapped)
+            undo.append((module, name, original))
+    return undo
+
+
+def _counted(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            count(name)
+            return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def profile(name='profile', pymiescatt=False):
+    """ Collect a Profile of the code run inside; with pymiescatt, the
+    PyMieScatt Mie functions are counted and timed too. A profile started
+    inside another one collects on its own until it ends.
+    """
+    global _ACTIVE
+    previous = _ACTIVE
+    result = Profile(name).start()
+    undo = _patch_pymiescatt() if pymiescatt else []
+    _ACTIVE = result
+    try:
+        yield result
+    finally:
+        _ACTIVE = previous
+        for module, attribute, original in undo:
+            setattr(module, attribute, original)
+        result.stop()
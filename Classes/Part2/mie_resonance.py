@@ -0,0 +1,241 @@
+""" Whispering gallery mode (WGM) resonances found from the Mie coefficients.
+
+Near a resonance of order n, a Mie coefficient behaves like
+    a_n = 1 / ((1 + alpha) - i (x - x0) / gamma)
+so the peak of |a_n|^2 sits at a zero of Im(1/a_n) and the half width is
+where |Im(1/a_n)| equals Re(1/a_n). Instead of sampling Qext on a uniform
+wavelength grid (10^5 points to see the high-Q modes), the sign changes of
+Im(1/a_n) and Im(1/b_n) are bracketed on a coarse size parameter grid for
+all orders at once, and the brackets are refined by vectorized regula falsi
+until they are a small fraction of the resonance width.
+
+Example:
+    res = resonance_wavelengths(1.4+0.0001j, 10000, (650, 700))
+    res['wavelength'], res['width'], res['q_factor']
+"""
+import numpy as np
+from scipy.optimize import minimize_scalar
+from scipy.signal import find_peaks
+
+import mie_batch
+
+RESONANCE_FIELDS = [
+    ('order', int), ('mode', 'U2'), ('x', float), ('width_x', float),
+    ('peak', float), ('q_factor', float)]
+
+
+def _inverse_coefficient(m, x, order, mode, max_order):
+    """ 1/a_n (mode 'TM') or 1/b_n (mode 'TE') at each (x, order) pair
+    """
+    an, bn, _ = mie_batch.batch_mie_ab(m, x, nmax=max_order)
+    rows = np.arange(x.size)
+    coefficient = np.where(mode == 'TM', an[rows, order - 1],
+                           bn[rows, order - 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 / coefficient
+
+
+def find_resonances(m, x_range, max_order=None, coarse_step=0.05,
+                    min_peak=0.1, min_q_factor=0, max_iterations=60,
+                    width_tolerance=1e-4):
+    """ Resonance positions and widths in size parameter x.
+
+    Returns a structured array (fields order, mode, x, width_x (FWHM),
+    peak (|a_n|^2 or |b_n|^2 at the peak), q_factor) sorted by x, and the
+    number of single size parameter Mie evaluations used. Crossings with a
+    peak below min_peak are anti-resonances (a_n near 0) or modes so weakly
+    coupled that absorption hides them from the spectrum. Each position is
+    refined until its bracket is below width_tolerance of the half width.
+    """
+    x_low, x_high = x_range
+    if max_order is None:
+        max_order = int(mie_batch.mie_nmax(x_high))
+    n_coarse = max(int(np.ceil((x_high - x_low) / coarse_step)) + 1, 2)
+    x_coarse = np.linspace(x_low, x_high, n_coarse)
+    an, bn, _ = mie_batch.batch_mie_ab(m, x_coarse, nmax=max_order)
+    evaluations = n_coarse
+
+    # brackets where Im(1/coefficient) changes sign, for every order
+    brackets = []
+    for mode, coefficient in (('TM', an), ('TE', bn)):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            imag = (1 / coefficient).imag
+        change = np.signbit(imag[:-1]) != np.signbit(imag[1:])
+        change &= np.isfinite(imag[:-1]) & np.isfinite(imag[1:])
+        index, order = np.nonzero(change)
+        brackets.append((np.full(index.size, mode), order + 1,
+                         x_coarse[index], x_coarse[index + 1]))
+    mode = np.concatenate([b[0] for b in brackets])
+    order = np.concatenate([b[1] for b in brackets])
+    low = np.concatenate([b[2] for b in brackets])
+    high = np.concatenate([b[3] for b in brackets])
+    out = np.zeros(0, dtype=RESONANCE_FIELDS)
+    if low.size == 0:
+        return out, evaluations
+
+    # Illinois (regula falsi) steps on the open brackets, vectorized.
+    # Im(1/a_n) is close to linear in x around a resonance, so a few steps
+    # do. A bracket is done when it is below width_tolerance of the half
+    # width, |Re(1/a_n)| over the slope of Im(1/a_n) across the bracket.
+    f_low = _inverse_coefficient(m, low, order, mode, max_order).imag
+    f_high = _inverse_coefficient(m, high, order, mode, max_order).imag
+    evaluations += 2 * low.size
+    # which end the last step replaced: -1 low, 1 high
+    side = np.zeros(low.size, dtype=int)
+    active = np.arange(low.size)
+    for _ in range(max_iterations):
+        a, b = low[active], high[active]
+        fa, fb = f_low[active], f_high[active]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (fb - fa) / (b - a)
+            x = b - fb / slope
+        # bisect where the secant leaves the bracket
+        x = np.where(np.isfinite(x) & (x > a) & (x < b), x, 0.5 * (a + b))
+        inverse = _inverse_coefficient(m, x, order[active], mode[active],
+                                       max_order)
+        evaluations += active.size
+        fx = inverse.imag
+        with np.errstate(divide='ignore', invalid='ignore'):
+            half_width = np.abs(inverse.real / slope)
+        same = np.signbit(fx) == np.signbit(fa)
+        # Illinois: an end kept twice in a row has its value halved
+        f_high[active] = np.where(same & (side[active] == -1), fb / 2, fb)
+        f_low[active] = np.where(~same & (side[active] == 1), fa / 2, fa)
+        low[active] = np.where(same, x, a)
+        f_low[active] = np.where(same, fx, f_low[active])
+        high[active] = np.where(same, b, x)
+        f_high[active] = np.where(same, f_high[active], fx)
+        side[active] = np.where(same, -1, 1)
+        exact = fx == 0
+        low[active[exact]] = high[active[exact]] = x[exact]
+        size = high[active] - low[active]
+        done = (exact | (size <= width_tolerance * half_width)
+                | (size <= 4 * np.spacing(high[active])))
+        active = active[~done]
+        if active.size == 0:
+            break
+    x0 = 0.5 * (low + high)
+    inverse = _inverse_coefficient(m, x0, order, mode, max_order)
+    evaluations += x0.size
+
+    # half width from the slope of Im(1/a_n); the step is shrunk to well
+    # inside the resonance for high-Q modes
+    step = 1e-6 * x0
+    for _ in range(3):
+        slope = (_inverse_coefficient(m, x0 + step, order, mode,
+                                      max_order).imag
+                 - _inverse_coefficient(m, x0 - step, order, mode,
+                                        max_order).imag) / (2 * step)
+        evaluations += 2 * x0.size
+        with np.errstate(divide='ignore', invalid='ignore'):
+            half_width = np.abs(inverse.real / slope)
+        too_wide = step > half_width / 100
+        if not too_wide.any():
+            break
+        step = np.where(too_wide, half_width / 100, step)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peak = 1 / np.abs(inverse)**2
+        q_factor = x0 / (2 * half_width)
+    keep = ((peak >= min_peak) & np.isfinite(half_width)
+            & (q_factor >= min_q_factor))
+    out = np.zeros(keep.sum(), dtype=RESONANCE_FIELDS)
+    out['order'] = order[keep]
+    out['mode'] = mode[keep]
+    out['x'] = x0[keep]
+    out['width_x'] = 2 * half_width[keep]
+    out['peak'] = peak[keep]
+    out['q_factor'] = q_factor[keep]
+    return np.sort(out, order='x'), evaluations
+
+
+def resonance_wavelengths(m, diameter, wavelength_range, n_medium=1.0,
+                          **kwargs):
+    """ Resonances of one particle in wavelength space.
+
+    Same as find_resonances, with extra fields wavelength and width (FWHM,
+    same units as wavelength), sorted by wavelength.
+    """
+    n_medium = np.real(n_medium)
+    x_range = (np.pi * diameter * n_medium / wavelength_range[1],
+               np.pi * diameter * n_medium / wavelength_range[0])
+    resonances, _ = find_resonances(m / n_medium, x_range, **kwargs)
+    out = np.zeros(resonances.size, dtype=RESONANCE_FIELDS + [
+        ('wavelength', float), ('width', float)])
+    for name, _ in RESONANCE_FIELDS:
+        out[name] = resonances[name]
+    out['wavelength'] = np.pi * diameter * n_medium / resonances['x']
+    out['width'] = out['wavelength'] * resonances['width_x'] / resonances['x']
+    return np.sort(out, order='wavelength')
+
+
+def spectrum_peaks(wavelength, spectrum, prominence=None):
+    """ Peak wavelengths of a measured spectrum (e.g. Qext or scattering)
+    """
+    spectrum = np.asarray(spectrum, dtype=float)
+    if prominence is None:
+        prominence = 0.05 * np.ptp(spectrum)
+    index, _ = find_peaks(spectrum, prominence=prominence)
+    return np.asarray(wavelength)[index]
+
+
+def _peak_mismatch(peak_wavelengths, resonance_x, diameter):
+    """ RMS distance of each measured peak to the nearest resonance
+    """
+    predicted = np.sort(np.pi * diameter / resonance_x)
+    if predicted.size == 0:
+        return np.inf
+    index = np.clip(np.searchsorted(predicted, peak_wavelengths), 1,
+                    predicted.size - 1)
+    nearest = np.minimum(
+        np.abs(peak_wavelengths - predicted[index - 1]),
+        np.abs(peak_wavelengths - predicted[index]))
+    return np.sqrt(np.mean(nearest**2))
+
+
+def fit_diameter_index(peak_wavelengths, diameter_guess, n_range, k=0.0,
+                       diameter_tolerance=0.02, n_grid=21,
+                       min_q_factor=1e3):
+    """ Diameter and real index that best match measured peak positions.
+
+    The resonance size parameters depend only on m, so for each candidate
+    index the resonances are found once and the diameter only rescales
+    them (lambda = pi d / x). Only modes with q_factor >= min_q_factor are
+    matched, as broad modes do not give sharp measured peaks. Peak matching
+    has mode-number aliases, so diameter_guess and n_range should be
+    narrow. Returns a dictionary with diameter, m, and rms_error (same
+    units as the peak wavelengths).
+    """
+    peak_wavelengths = np.sort(np.asarray(peak_wavelengths, dtype=float))
+    d_low = diameter_guess * (1 - diameter_tolerance)
+    d_high = diameter_guess * (1 + diameter_tolerance)
+    x_range = (np.pi * d_low / peak_wavelengths[-1] * 0.99,
+               np.pi * d_high / peak_wavelengths[0] * 1.01)
+
+    def best_diameter(n_real):
+        resonances, _ = find_resonances(
+            n_real + 1j * k, x_range, min_q_factor=min_q_factor)
+        x0 = resonances['x']
+        # the error is piecewise smooth in d, scan then polish
+        diameters = np.linspace(d_low, d_high, 400)
+        errors = [_peak_mismatch(peak_wavelengths, x0, d) for d in diameters]
+        start = int(np.argmin(errors))
+        step = diameters[1] - diameters[0]
+        result = minimize_scalar(
+            lambda d: _peak_mismatch(peak_wavelengths, x0, d),
+            bounds=(max(d_low, diameters[start] - step),
+                    min(d_high, diameters[start] + step)),
+            method='bounded')
+        return result.x, result.fun
+
+    n_values = np.linspace(n_range[0], n_range[1], n_grid)
+    scores = [best_diameter(n)[1] for n in n_values]
+    start = int(np.argmin(scores))
+    n_step = n_values[1] - n_values[0] if n_grid > 1 else 0
+    result = minimize_scalar(
+        lambda n: best_diameter(n)[1],
+        bounds=(max(n_range[0], n_values[start] - n_step),
+                min(n_range[1], n_values[start] + n_step)),
+        method='bounded')
+    diameter, rms_error = best_diameter(result.x)
+    return dict(diameter=diameter, m=result.x + 1j * k, rms_error=rms_error)
@@ -0,0 +1,228 @@
+""" Multi-core parameter sweeps of the PyMieScatt functions.
+
+The parameter grid is the outer product of 1D arrays given as a dictionary.
+The flattened grid is split into chunks that run on a
+`concurrent.futures.ProcessPoolExecutor`. Each worker writes its rows
+straight into a shared result array, which is a memory-mapped file when a
+checkpoint path is given. A sweep that is stopped can then be resumed and
+only the unfinished chunks are computed. Every grid point is computed on its
+own, so the output does not depend on the number of workers.
+
+Example:
+    grid = {'m': [1.5+0.001j, 1.5+0.5j, 2+0.001j],
+            'wavelength': np.arange(10, 1500, 25),
+            'diameter': np.linspace(10, 5000, 500)}
+    result = run_sweep('MieQ', grid, max_workers=8, checkpoint='mieq_sweep')
+    result.sel(field='Qext')
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import xarray as xr
+import PyMieScatt as ps
+
+import mie_profile
+
+MIE_Q_FIELDS = ('Qext', 'Qsca', 'Qabs', 'g', 'Qpr', 'Qback', 'Qratio')
+MIE_B_FIELDS = ('Bext', 'Bsca', 'Babs', 'G', 'Bpr', 'Bback', 'Bratio')
+
+
+def _mie_q(point, fixed):
+    return np.array(ps.MieQ(point['m'], point['wavelength'],
+                            point['diameter'], **fixed))
+
+
+def _mie_q_core_shell(point, fixed):
+    return np.array(ps.MieQCoreShell(
+        point['mCore'], point['mShell'], point['wavelength'],
+        point['dCore'], point['dShell'], **fixed))
+
+
+def _mie_lognormal(point, fixed):
+    return np.array(ps.Mie_Lognormal(
+        point['m'], point['wavelength'], point['geoStdDev'],
+        point['geoMean'], point['numberOfParticles'], **fixed)[:7])
+
+
+def _scattering_function(point, fixed):
+    _, SL, SR, SU = ps.ScatteringFunction(
+        point['m'], point['wavelength'], point['diameter'], **fixed)
+    return np.stack(np.broadcast_arrays(SL, SR, SU))
+
+
+# function name: (callable, names of the first output dimension)
+SWEEP_FUNCTIONS = {
+    'MieQ': (_mie_q, MIE_Q_FIELDS),
+    'MieQCoreShell': (_mie_q_core_shell, MIE_Q_FIELDS),
+    'Mie_Lognormal': (_mie_lognormal, MIE_B_FIELDS),
+    'ScatteringFunction': (_scattering_function, ('SL', 'SR', 'SU')),
+}
+
+
+def _grid_point(grid, shape, flat_index):
+    """ Parameter values of one point of the flattened grid
+    """
+    index = np.unravel_index(flat_index, shape)
+    return {name: values[i].item()
+            for (name, values), i in zip(grid.items(), index)}
+
+
+def _grid_hash(function, grid, fixed, output_shape):
+    """ Hash identifying a sweep, used to match a checkpoint to its grid
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps([function, sorted(fixed.items()),
+                           list(output_shape)], default=str).encode())
+    for name, values in grid.items():
+        sha.update(name.encode())
+        sha.update(np.ascontiguousarray(values).tobytes())
+    return sha.hexdigest()
+
+
+def _open_results(store, shape, mode='r+'):
+    """ Attach to the shared result array, a memmap file or shared memory
+    """
+    kind, name = store
+    if kind == 'memmap':
+        return np.memmap(name, dtype=float, mode=mode, shape=shape), None
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=float, buffer=shm.buf), shm
+
+
+def _run_chunk(function, grid, fixed, store, result_shape, start, stop,
+               profiled=False):
+    """ Worker: compute grid points start:stop and write them in place.
+    Returns start and, when profiled, the profile of the chunk (to_dict)
+    """
+    if profiled:
+        with mie_profile.profile(pymiescatt=True) as profile:
+            with mie_profile.stage('chunk'):
+                _run_chunk(function, grid, fixed, store, result_shape,
+                           start, stop)
+        return start, profile.to_dict()
+    call = SWEEP_FUNCTIONS[function][0]
+    results, shm = _open_results(store, result_shape)
+    grid_shape = tuple(len(values) for values in grid.values())
+    for flat_index in range(start, stop):
+        point = _grid_point(grid, grid_shape, flat_index)
+        results[flat_index] = call(point, fixed)
+    if shm is None:
+        results.flush()
+    else:
+        del results
+        shm.close()
+    return start, None
+
+
+@mie_profile.staged('sweep')
+def run_sweep(function, grid, fixed=None, chunk_size=1000, max_workers=None,
+              checkpoint=None, progress=None):
+    """ Run a PyMieScatt function over the outer product of a grid.
+
+    function is one of SWEEP_FUNCTIONS. grid is a dictionary of 1D arrays
+    named after the function's arguments (e.g. m, wavelength, diameter),
+    fixed holds keyword arguments used at every point (e.g. numberOfBins).
+    checkpoint is a path prefix: results go to '<checkpoint>.dat' and the
+    finished chunks to '<checkpoint>.json', and a rerun with the same grid
+    only computes the chunks that are missing. progress, if given, is
+    called with (chunks done, chunks total). Inside a mie_profile.profile,
+    the chunks are profiled where they run (PyMieScatt calls included) and
+    added to it.
+
+    Returns an xarray DataArray with one dimension per grid entry, then
+    'field' (and 'angle' for ScatteringFunction).
+    """
+    if function not in SWEEP_FUNCTIONS:
+        raise ValueError(
+            f"unknown sweep function {function}, "
+            f"use one of {list(SWEEP_FUNCTIONS)}")
+    fixed = dict(fixed or {})
+    grid = {name: np.atleast_1d(np.asarray(values))
+            for name, values in grid.items()}
+    grid_shape = tuple(len(values) for values in grid.values())
+    n_points = int(np.prod(grid_shape))
+
+    # probe the first point for the output shape
+    probe = SWEEP_FUNCTIONS[function][0](
+        _grid_point(grid, grid_shape, 0), fixed)
+    output_shape = probe.shape
+    result_shape = (n_points,) + output_shape
+
+    starts = list(range(0, n_points, chunk_size))
+    done = set()
+    shm = None
+    if checkpoint is not None:
+        data_path = f'{checkpoint}.dat'
+        state_path = f'{checkpoint}.json'
+        sweep_hash = _grid_hash(function, grid, fixed, output_shape)
+        resume = os.path.exists(state_path) and os.path.exists(data_path)
+        if resume:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+            if (state['hash'] != sweep_hash
+                    or state['chunk_size'] != chunk_size):
+                raise ValueError(
+                    f'checkpoint {checkpoint} belongs to a different sweep')
+            done = set(state['done'])
+        else:
+            state = dict(hash=sweep_hash, chunk_size=chunk_size, done=[])
+            np.memmap(data_path, dtype=float, mode='w+',
+                      shape=result_shape).flush()
+        store = ('memmap', data_path)
+    else:
+        shm = shared_memory.SharedMemory(
+            create=True, size=max(probe.nbytes * n_points, 1))
+        store = ('shm', shm.name)
+
+    def chunk_finished(start, profile=None):
+        done.add(start)
+        if profile is not None:
+            mie_profile.merge(profile)
+        if checkpoint is not None:
+            state['done'] = sorted(done)
+            with open(state_path + '.tmp', 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(state_path + '.tmp', state_path)
+        if progress is not None:
+            progress(len(done), len(starts))
+
+    todo = [start for start in starts if start not in done]
+    profiled = mie_profile.enabled()
+    try:
+        if max_workers == 1:
+            for start in todo:
+                chunk_finished(*_run_chunk(
+                    function, grid, fixed, store, result_shape,
+                    start, min(start + chunk_size, n_points), profiled))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(
+                    _run_chunk, function, grid, fixed, store, result_shape,
+                    start, min(start + chunk_size, n_points), profiled)
+                    for start in todo]
+                for future in as_completed(futures):
+                    chunk_finished(*future.result())
+
+        results, _ = _open_results(store, result_shape, mode='r')
+        values = np.array(results).reshape(grid_shape + output_shape)
+        del results
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    coords = dict(grid)
+    dims = list(grid) + ['field']
+    coords['field'] = list(SWEEP_FUNCTIONS[function][1])
+    if function == 'ScatteringFunction':
+        dims.append('angle')
+        point = _grid_point(grid, grid_shape, 0)
+        coords['angle'] = ps.ScatteringFunction(
+            point['m'], point['wavelength'], point['diameter'], **fixed)[0]
+    return xr.DataArray(values, dims=dims, coords=coords,
+                        attrs=dict(function=function, **{
+                            key: str(value) for key, value in fixed.items()}))
@@ -0,0 +1,193 @@
+""" Streaming dN/dlogDp histograms for single particle size data.
+
+Lec_dNdlogDp keeps every diameter in memory and calls np.histogram for each
+bin set. `SizeHistogram` holds only the per-bin number and volume, accepts
+chunks of diameters as they arrive, and can be merged with histograms
+filled by other processes, rebinned to coarser grids (number and volume
+conserved), and turned into dN/dlogDp and dV/dlogDp at any time.
+
+Bins follow np.histogram: [edge_i, edge_i+1), the last bin includes its
+upper edge. Diameters outside the edges are counted as underflow/overflow.
+
+Example:
+    histogram = SizeHistogram.log_uniform(1, 10000, 500)
+    for chunk in stream: # e.g. arrays of diameters in nm from an OPC
+        histogram.add(chunk)
+    histogram.merge(other_histogram)
+    coarse = histogram.rebin(np.logspace(0, 4, 50))
+    coarse.dn_dlogdp(), coarse.dv_dlogdp(), coarse.pms_total()
+"""
+import numpy as np
+from scipy.integrate import trapezoid
+
+
+class SizeHistogram:
+    """ Fixed-memory number and volume histogram over diameter bin edges.
+
+    For log-uniform edges (see log_uniform) the bin index is computed
+    directly from log10(Dp) instead of a binary search.
+    """
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        if self.edges.ndim != 1 or self.edges.size < 2 or np.any(
+                np.diff(self.edges) <= 0) or self.edges[0] <= 0:
+            raise ValueError('edges must be positive and increasing')
+        self.log_edges = np.log10(self.edges)
+        self.log_widths = np.diff(self.log_edges)
+        self.centers = np.sqrt(self.edges[1:] * self.edges[:-1])
+        self.n_bins = self.edges.size - 1
+        # constant log step when the edges are log-uniform
+        step = self.log_widths.mean()
+        self._log_step = (step if np.allclose(self.log_widths, step,
+                                              rtol=1e-9, atol=0) else None)
+        self._padded_edges = np.concatenate(
+            ([-np.inf], self.edges, [np.inf]))
+        self.number = np.zeros(self.n_bins)
+        self.volume = np.zeros(self.n_bins)
+        self.underflow = 0.0
+        self.overflow = 0.0
+
+    @classmethod
+    def log_uniform(cls, lower, upper, n_bins):
+        """ n_bins log-uniform bins from lower to upper diameter
+        """
+        return cls(np.logspace(np.log10(lower), np.log10(upper), n_bins + 1))
+
+    def _bin_index(self, diameter):
+        """ Bin of each diameter, -1 below and n_bins above the edges
+        """
+        if self._log_step is None:
+            index = np.searchsorted(self.edges, diameter, side='right') - 1
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                position = ((np.log10(diameter) - self.log_edges[0])
+                            / self._log_step)
+            np.floor(position, out=position)
+            # log10 of negative diameters is NaN, those are underflow
+            np.nan_to_num(position, copy=False, nan=-1)
+            index = np.clip(position, -1, self.n_bins).astype(np.intp)
+            # one step correction for rounding at the edges
+            index -= diameter < self._padded_edges[index + 1]
+            index += diameter >= self._padded_edges[index + 2]
+        # the last bin includes its upper edge, as np.histogram
+        index[diameter == self.edges[-1]] = self.n_bins - 1
+        return index
+
+    def add(self, diameter, weights=None):
+        """ Add a chunk of diameters (and optional per-particle weights,
+        e.g. concentration each particle represents). NaN and inf are
+        dropped, as np.histogram does.
+        """
+        diameter = np.asarray(diameter, dtype=float).ravel()
+        if weights is not None:
+            weights = np.broadcast_to(np.asarray(weights, dtype=float),
+                                      diameter.shape)
+        finite = np.isfinite(diameter)
+        if not finite.all():
+            diameter = diameter[finite]
+            weights = None if weights is None else weights[finite]
+        # the two outer bins of the padded index collect under/overflow
+        index = self._bin_index(diameter) + 1
+        number = np.bincount(index, weights, minlength=self.n_bins + 2)
+        volume = diameter**3 * (np.pi / 6)
+        if weights is not None:
+            volume *= weights
+        volume = np.bincount(index, volume, minlength=self.n_bins + 2)
+        self.number += number[1:-1]
+        self.volume += volume[1:-1]
+        self.underflow += number[0]
+        self.overflow += number[-1]
+        return self
+
+    def merge(self, other):
+        """ Add the counts of another histogram with the same edges
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('can only merge histograms with equal edges')
+        self.number += other.number
+        self.volume += other.volume
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def __add__(self, other):
+        return self.copy().merge(other)
+
+    def copy(self):
+        out = SizeHistogram(self.edges)
+        out.number = self.number.copy()
+        out.volume = self.volume.copy()
+        out.underflow = self.underflow
+        out.overflow = self.overflow
+        return out
+
+    def rebin(self, edges):
+        """ New histogram on other edges, number and volume conserved.
+
+        Each old bin is split over the new bins by its overlap in log10(Dp),
+        so when the new edges are a subset of the old (coarser bins) the
+        result is exact. Parts outside the new edges go to under/overflow.
+        """
+        out = SizeHistogram(edges)
+        low = np.maximum(self.log_edges[:-1, None], out.log_edges[None, :-1])
+        high = np.minimum(self.log_edges[1:, None], out.log_edges[None, 1:])
+        fraction = np.clip(high - low, 0, None) / self.log_widths[:, None]
+        out.number = self.number @ fraction
+        out.volume = self.volume @ fraction
+        below = np.clip(out.log_edges[0] - self.log_edges[:-1], 0,
+                        self.log_widths) / self.log_widths
+        above = np.clip(self.log_edges[1:] - out.log_edges[-1], 0,
+                        self.log_widths) / self.log_widths
+        out.underflow = self.underflow + self.number @ below
+        out.overflow = self.overflow + self.number @ above
+        return out
+
+    def dn_dlogdp(self):
+        """ dN/dlogDp of each bin (log10 widths, as Lec_dNdlogDp)
+        """
+        return self.number / self.log_widths
+
+    def dv_dlogdp(self):
+        """ dV/dlogDp of each bin, volume in the diameter units cubed
+        """
+        return self.volume / self.log_widths
+
+    def pdf(self):
+        """ dN/dDp of each bin
+        """
+        return self.number / np.diff(self.edges)
+
+    def pms_total(self):
+        """ Total number in the bins (sum of the bin counts)
+        """
+        return self.number.sum()
+
+    def pms_volume_total(self):
+        """ Total volume in the bins, from the exact particle volumes
+        """
+        return self.volume.sum()
+
+    def pdf_total(self):
+        """ Trapezoid integral of dN/dDp over the bin centres
+        """
+        return trapezoid(self.pdf(), self.centers)
+
+    def pdf_volume_total(self):
+        """ Trapezoid integral of dV/dDp over the bin centres
+        """
+        return trapezoid(self.volume / np.diff(self.edges), self.centers)
+
+    def save(self, path):
+        np.savez_compressed(path, edges=self.edges, number=self.number,
+                            volume=self.volume,
+                            outside=[self.underflow, self.overflow])
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        out = cls(data['edges'])
+        out.number = data['number']
+        out.volume = data['volume']
+        out.underflow, out.overflow = data['outside']
+        return out